@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Import time of the MassiveFold entry points.
+
+Each module of [project.scripts] is imported in a fresh interpreter, several times, and the median time is reported
+with the heavy dependencies the import loaded. Every array task runs `get_batch` and every post treatment runs
+several entry points, so this startup time is paid for each of them.
+
+  python benchmarks/import_time.py
+  python benchmarks/import_time.py --max_ms 150 --history import_times.jsonl
+
+With --max_ms, the script fails when an entry point takes longer to import or loads one of the heavy dependencies.
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["numpy", "pandas", "matplotlib", "seaborn", "scipy", "Bio", "simple_slurm", "tqdm"]
+
+# prints the heavy modules loaded by the import, the import time itself is read from -X importtime
+PROBE = """
+import json, sys
+import {module}
+heavy = {heavy!r}
+print(json.dumps(sorted(name for name in heavy if name in sys.modules)))
+"""
+
+def entry_point_modules(pyproject_path):
+  modules = {}
+  in_scripts = False
+  with open(pyproject_path, "r", encoding="utf-8") as handle:
+    for line in handle:
+      line = line.strip()
+      if line.startswith("["):
+        in_scripts = line == "[project.scripts]"
+        continue
+      match = re.match(r'([\w-]+)\s*=\s*"([\w.]+):\w+"', line)
+      if in_scripts and match:
+        modules[match.group(1)] = match.group(2)
+  return modules
+
+def import_once(module):
+  env = dict(os.environ)
+  env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.join(REPO_DIR, "src"), env.get("PYTHONPATH")]))
+  start = time.perf_counter()
+  completed = subprocess.run(
+    [sys.executable, "-X", "importtime", "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+    env=env,
+    capture_output=True,
+    text=True,
+  )
+  wall_ms = (time.perf_counter() - start) * 1000
+  if completed.returncode != 0:
+    raise RuntimeError(f"Importing {module} failed:\n{completed.stderr.strip().splitlines()[-1]}")
+  # "import time: self [us] | cumulative | imported package", the module itself is the last one
+  import_us = 0
+  for line in completed.stderr.splitlines():
+    fields = line.split("|")
+    if len(fields) == 3 and fields[2].strip() == module:
+      import_us = int(fields[1])
+  return import_us / 1000, wall_ms, json.loads(completed.stdout.strip().splitlines()[-1])
+
+def measure(module, repeat):
+  runs = [import_once(module) for _ in range(repeat)]
+  return {
+    "module": module,
+    "import_ms": round(statistics.median(run[0] for run in runs), 1),
+    "wall_ms": round(statistics.median(run[1] for run in runs), 1),
+    "heavy_modules": runs[0][2],
+  }
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--repeat", type=int, default=5, help="Imports per entry point, the median is kept (default: %(default)s)")
+  parser.add_argument("--max_ms", type=float, default=None, help="Fail above this import time or if a heavy dependency is loaded")
+  parser.add_argument("--history", default=None, help="JSON lines file where the measures are appended")
+  args = parser.parse_args()
+
+  results = {}
+  print(f"{'entry point':<18} {'import (ms)':>12} {'process (ms)':>13}  heavy dependencies")
+  for name, module in entry_point_modules(os.path.join(REPO_DIR, "pyproject.toml")).items():
+    results[name] = measure(module, args.repeat)
+    result = results[name]
+    print(f"{name:<18} {result['import_ms']:>12} {result['wall_ms']:>13}  {', '.join(result['heavy_modules']) or '-'}")
+
+  if args.history:
+    commit = subprocess.run(["git", "-C", REPO_DIR, "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+    with open(args.history, "a", encoding="utf-8") as handle:
+      handle.write(json.dumps({
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit.stdout.strip(),
+        "python": sys.version.split()[0],
+        "results": results,
+      }) + "\n")
+
+  if args.max_ms is None:
+    return 0
+  failed = [
+    name for name, result in results.items()
+    if result["import_ms"] > args.max_ms or result["heavy_modules"]
+  ]
+  if failed:
+    print(f"Too slow to import or loading heavy dependencies: {', '.join(failed)}")
+    return 1
+  return 0
+
+if __name__ == "__main__":
+  raise SystemExit(main())
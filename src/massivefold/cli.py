@@ -4,12 +4,51 @@
 import argparse
 import sys
 
-from massivefold.pipeline import run_pipeline
-from massivefold.pipeline import multirun_pipeline
-from massivefold.pipeline import screening_pipeline
-from massivefold.pipeline import ppi_pipeline
 from massivefold.install import install_workspace
+from massivefold.parallelization.link_files import LINK_MODES
 from massivefold.scheduling import resolve_scheduler
+from massivefold.scheduling.shared_queue import resolve_queue_dir
+from massivefold.scheduling.shared_queue import run_worker
+
+def add_scheduler_arguments(optional_group):
+  optional_group.add_argument(
+    "--scheduler",
+    dest="scheduler",
+    default="auto",
+    choices=["auto", "slurm", "local", "queue"],
+    help="Scheduler selector (default: %(default)s)",
+  )
+  optional_group.add_argument(
+    "--local-workers",
+    dest="local_workers",
+    type=int,
+    default=None,
+    help="Number of job array tasks run concurrently by the local scheduler"
+    " (default: $MASSIVEFOLD_LOCAL_WORKERS or 1)",
+  )
+  optional_group.add_argument(
+    "--queue-dir",
+    dest="queue_dir",
+    default=None,
+    help="Shared directory where the queue scheduler writes the jobs for `massivefold worker`"
+    " (default: $MASSIVEFOLD_QUEUE_DIR)",
+  )
+  optional_group.add_argument(
+    "--max-attempts",
+    dest="max_attempts",
+    type=int,
+    default=None,
+    help="Times a failed task is run by the local and queue schedulers, only the failed task ids are rerun"
+    " (default: $MASSIVEFOLD_MAX_ATTEMPTS or 1)",
+  )
+  optional_group.add_argument(
+    "--retry-backoff",
+    dest="retry_backoff",
+    type=float,
+    default=None,
+    help="Seconds before the first rerun of a failed task, doubled at each attempt"
+    " (default: $MASSIVEFOLD_RETRY_BACKOFF or 60)",
+  )
 
 def add_run_arguments(run_parser):
   # required arguments
@@ -40,27 +79,46 @@ def add_run_arguments(run_parser):
                               help="Only compute alignments, the first step of MassiveFold."
                               " Overwrite MSAs directory by forcing re-computation.")
   run_optional.add_argument("-c", "--calibrate", dest="calibrate", action="store_true",
-                              help="Calibrate --batch_size value. Searches from the previous runs for the same 'fasta'"
-                              " path given in --sequence and uses the longest prediction time found to compute the maximal"
-                              " number of predictions per batch. This maximal number depends on the total time given by"
-                              " --wall_time.")
+                              help="Calibrate --batch_size value from the prediction times of the previous runs, recorded"
+                              " in the prediction_times.json file of the logs directory. The time of each model is taken"
+                              " from the runs of the same sequence, or interpolated on the sequence length from the runs"
+                              " of other sequences, to compute the maximal number of predictions per batch. This maximal"
+                              " number depends on the total time given by --wall_time.")
   run_optional.add_argument("-C", "--calibration_from", dest="calibration_from",
                               help="Path of a previous run to calibrate the batch size from (see --calibrate).")
   run_optional.add_argument("-w", "--wall_time", dest="wall_time", type=float, default=20,
                               help="Total time in hour (default: %(default)s) available for calibration computations.")
+  run_optional.add_argument("--pack", dest="pack", action="store_true",
+                              help="With -c or -C and AFmassive, fill each batch up to --wall_time from the prediction time"
+                              " of each model instead of using --batch_size. The last predictions of several models are"
+                              " run in a same batch.")
+  run_optional.add_argument("--dynamic_tasks", dest="dynamic_tasks", type=int, default=None,
+                              help="Run this number of job array tasks that claim the batches from a queue in the logs"
+                              " directory until it is empty or --wall_time is nearly used, instead of one task per batch."
+                              " Use with a small --batch_size so that fast GPUs run more batches.")
+  run_optional.add_argument("--stop_score", dest="stop_score", type=float, default=None,
+                              help="Stop the run once --stop_count predictions reached this score (ranking score of the"
+                              " tool, e.g. iptm+ptm for multimers): the batches that did not start are skipped.")
+  run_optional.add_argument("--stop_count", dest="stop_count", type=int, default=1,
+                              help="Number of predictions reaching --stop_score to stop the run (default: %(default)s).")
+  run_optional.add_argument("--stop_patience", dest="stop_patience", type=int, default=None,
+                              help="Stop the run when the best score did not improve over this number of finished"
+                              " batches.")
+  run_optional.add_argument("--incremental_post_treatment", dest="incremental_post_treatment", action="store_true",
+                              help="Convert each batch and add it to the global ranking as soon as it ends, the post"
+                              " treatment job then only finalizes the ranking, the ranked files and the plots.")
+  run_optional.add_argument("--link_mode", dest="link_mode", choices=LINK_MODES, default=None,
+                              help="How the post treatment places the outputs of the batches in the run directory,"
+                              " instead of massivefold.link_mode of the parameters file (default: copy). 'move',"
+                              " 'hardlink' and 'reflink' avoid copying the files, 'symlink' keeps the batch directories"
+                              " that the ranked files link to.")
   run_optional.add_argument("-m", "--msas_precomputed", dest="msas_precomputed", 
                               help="Path to directory that contains computed msas.")
   run_optional.add_argument("-n", "--top_n_model", dest="top_n_model",
                               help="Uses the n neural network models with best ranking confidence from this run's path.")
   run_optional.add_argument("-a", "--recompute_msas", dest="recompute_msas", action="store_true",
                               help="Purges previous alignment step and recomputes msas.")
-  run_optional.add_argument(
-    "--scheduler",
-    dest="scheduler",
-    default="auto",
-    choices=["auto", "slurm", "local"],
-    help="Scheduler selector (default: %(default)s)",
-  )
+  add_scheduler_arguments(run_optional)
 
 def add_multirun_arguments(multirun_parser):
   # required arguments
@@ -72,13 +130,7 @@ def add_multirun_arguments(multirun_parser):
 
   # optional arguments
   multirun_optional = multirun_parser.add_argument_group("Optional arguments")
-  multirun_optional.add_argument(
-    "--scheduler",
-    dest="scheduler",
-    default="auto",
-    choices=["auto", "slurm", "local"],
-    help="Scheduler selector (default: %(default)s)",
-  )
+  add_scheduler_arguments(multirun_optional)
 
 def add_install_arguments(install_parser):
   install_parser.add_argument("--alphafold-db", dest="alphafold_databases", default="", help="Path to AlphaFold2 database.")
@@ -114,13 +166,7 @@ def add_screening_arguments(screening_parser):
                                     help="Only compute alignments, the first step of MassiveFold.")
   screening_optional.add_argument("-j", "--jobid", dest="jobid",
                                     help="Jobid of an alignment job to wait for inference, skips the alignments.")
-  screening_optional.add_argument(
-    "--scheduler",
-    dest="scheduler",
-    default="auto",
-    choices=["auto", "slurm", "local"],
-    help="Scheduler selector (default: %(default)s)",
-  )
+  add_scheduler_arguments(screening_optional)
 
 def add_ppi_arguments(ppi_parser):
   # required arguments
@@ -144,13 +190,34 @@ def add_ppi_arguments(ppi_parser):
                               help="Only compute alignments, the first step of MassiveFold.")
   ppi_optional.add_argument("-j", "--jobid", dest="jobid",
                               help="Jobid of an alignment job to wait for inference, skips the alignments.")
-  ppi_optional.add_argument(
-    "--scheduler",
-    dest="scheduler",
-    default="auto",
-    choices=["auto", "slurm", "local"],
-    help="Scheduler selector (default: auto) (default: %(default)s)",
-  )
+  add_scheduler_arguments(ppi_optional)
+
+def add_retry_arguments(retry_parser):
+  # required arguments
+  retry_required = retry_parser.add_argument_group("Required arguments")
+  retry_required.add_argument("-s", "--sequence", dest="sequence", required=True,
+                                help="Path of the sequence(s) of the run to retry, should be a 'fasta' file.")
+  retry_required.add_argument("-r", "--run", dest="run_name", required=True,
+                                help="Name of the run to retry.")
+  retry_required.add_argument("-f", "--parameters", dest="parameters", required=True,
+                                help="Json file's path containing the parameters used for this run.")
+
+  # optional arguments
+  retry_optional = retry_parser.add_argument_group("Optional arguments")
+  retry_optional.add_argument("--split", dest="split", type=int, default=1,
+                                help="Split each batch that reached the walltime into this number of smaller batches"
+                                " (default: %(default)s, no split).")
+  retry_optional.add_argument("--max_batch_attempts", dest="max_batch_attempts", type=int, default=3,
+                                help="Refuse to resubmit batches that already ran this number of times (default: %(default)s).")
+  add_scheduler_arguments(retry_optional)
+
+def add_worker_arguments(worker_parser):
+  worker_parser.add_argument("--queue-dir", dest="queue_dir", default=None,
+                               help="Shared queue directory to serve (default: $MASSIVEFOLD_QUEUE_DIR).")
+  worker_parser.add_argument("--poll-interval", dest="poll_interval", type=float, default=10,
+                               help="Seconds between two checks of the queue when no task is ready (default: %(default)s).")
+  worker_parser.add_argument("--exit-when-empty", dest="exit_when_empty", action="store_true",
+                               help="Stop the worker once every queued job is finished instead of waiting for new ones.")
 
 def build_parser():
   parser = argparse.ArgumentParser(prog="massivefold")
@@ -171,9 +238,16 @@ def build_parser():
   install_parser = subparsers.add_parser("install", help="Create MassiveFold file architecture")
   add_install_arguments(install_parser)
 
+  retry_parser = subparsers.add_parser("retry", help="Resubmit the failed batches of a run and its post treatment")
+  add_retry_arguments(retry_parser)
+
+  worker_parser = subparsers.add_parser("worker", help="Run the jobs of a shared queue (see --scheduler queue)")
+  add_worker_arguments(worker_parser)
+
   return parser
 
 def dispatch_run(args, forwarded_args, scheduler):
+  from massivefold.pipeline import run_pipeline
   print(f"Selected scheduler: {scheduler['name']}")
   try:
     return run_pipeline(args, forwarded_args, scheduler)
@@ -182,6 +256,7 @@ def dispatch_run(args, forwarded_args, scheduler):
     return 1
 
 def dispatch_multirun(args, forwarded_args, scheduler):
+  from massivefold.pipeline import multirun_pipeline
   print(f"Selected scheduler: {scheduler['name']}")
   try:
     return multirun_pipeline(args, forwarded_args, scheduler)
@@ -190,6 +265,7 @@ def dispatch_multirun(args, forwarded_args, scheduler):
     return 1
 
 def dispatch_screen(args, forwarded_args, scheduler):
+  from massivefold.pipeline import screening_pipeline
   print(f"Selected scheduler: {scheduler['name']}")
   try:
     return screening_pipeline(args, forwarded_args, scheduler)
@@ -198,6 +274,7 @@ def dispatch_screen(args, forwarded_args, scheduler):
     return 1
 
 def dispatch_ppi(args, forwarded_args, scheduler):
+  from massivefold.pipeline import ppi_pipeline
   print(f"Selected scheduler: {scheduler['name']}")
   try:
     return ppi_pipeline(args, forwarded_args, scheduler)
@@ -205,11 +282,39 @@ def dispatch_ppi(args, forwarded_args, scheduler):
     print(error)
     return 1
 
+def dispatch_retry(args, forwarded_args, scheduler):
+  from massivefold.pipeline import retry_pipeline
+  print(f"Selected scheduler: {scheduler['name']}")
+  try:
+    return retry_pipeline(args, forwarded_args, scheduler)
+  except RuntimeError as error:
+    print(error)
+    return 1
+
+def wait_for_scheduler(scheduler):
+  # backends running jobs in this process (local) only return once they are all finished
+  return scheduler["wait_all"]()
+
 def dispatch_install(args):
   return install_workspace(args)
 
+def dispatch_worker(args):
+  queue_dir = resolve_queue_dir(args.queue_dir)
+  if queue_dir is None:
+    print("No queue directory, use --queue-dir or set $MASSIVEFOLD_QUEUE_DIR.")
+    return 2
+  return run_worker(queue_dir, args.poll_interval, args.exit_when_empty)
+
+def scheduler_options(args):
+  return {
+    "local_workers": getattr(args, "local_workers", None),
+    "queue_dir": getattr(args, "queue_dir", None),
+    "max_attempts": getattr(args, "max_attempts", None),
+    "retry_backoff": getattr(args, "retry_backoff", None),
+  }
+
 def resolve_selected_scheduler(args):
-  scheduler, error = resolve_scheduler(args.scheduler)
+  scheduler, error = resolve_scheduler(args.scheduler, scheduler_options(args))
   if error:
     print(error)
     return None, 2
@@ -224,25 +329,33 @@ def main(argv=None):
     parser.print_help()
     return 0
 
-  if args.command in ["run", "multirun", "screen", "ppi"]:
+  if args.command in ["run", "multirun", "screen", "ppi", "retry"]:
     scheduler, status = resolve_selected_scheduler(args)
     if status != 0:
       return status
 
     if args.command == "run":
-      return dispatch_run(args, unknown, scheduler)
+      status = dispatch_run(args, unknown, scheduler)
     if args.command == "multirun":
-      return dispatch_multirun(args, unknown, scheduler)
+      status = dispatch_multirun(args, unknown, scheduler)
     elif args.command == "screen":
-      return dispatch_screen(args, unknown, scheduler)
+      status = dispatch_screen(args, unknown, scheduler)
     elif args.command == "ppi":
-      return dispatch_ppi(args, unknown, scheduler)
+      status = dispatch_ppi(args, unknown, scheduler)
+    elif args.command == "retry":
+      status = dispatch_retry(args, unknown, scheduler)
+    return max(status, wait_for_scheduler(scheduler))
 
   if args.command == "install":
     if unknown:
       print("Ignoring extra arguments:", " ".join(unknown))
     return dispatch_install(args)
 
+  if args.command == "worker":
+    if unknown:
+      print("Ignoring extra arguments:", " ".join(unknown))
+    return dispatch_worker(args)
+
   parser.print_help()
   return 1
 
@@ -6,10 +6,24 @@ import pandas as pd
 from concurrent.futures import ProcessPoolExecutor
 import pickle
 import json
+import time
+
+from massivefold.parallelization.prediction_scores import cached_scores
+from massivefold.parallelization.prediction_scores import pickle_scores
+from massivefold.parallelization.prediction_scores import read_scores
+from massivefold.parallelization.prediction_scores import record_scores
+
+# full pickles can weigh hundreds of MB, the number of them loaded at the same time is bounded
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
 
 parser = argparse.ArgumentParser(allow_abbrev=False)
 parser.add_argument('--target_run', help='Path of the unfinished run you want to get the scores', required=True)
 parser.add_argument('--verbose', choices=['ranking_confidence', 'ptm', 'iptm'], help='If you want scores to be displayed and which one')
+parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Number of pickles loaded at the same time'
+' (default: %(default)s)')
+parser.add_argument('--watch', action='store_true', help='Keep polling the run directory, the new pickles are read as'
+' the predictions end and the rankings are updated, until interrupted')
+parser.add_argument('--interval', type=float, default=60, help='With --watch, seconds between two polls (default: %(default)s)')
 
 def create_ranking(df_ranking, model_type='multimer'):
   ranking_metrics = [ ranking  for ranking in df_ranking.columns if ranking.startswith('ranking_') ]
@@ -29,51 +43,80 @@ def create_ranking(df_ranking, model_type='multimer'):
     every_ranking[metric] = ranking
   return every_ranking
 
-def extract_scores(pkl_file):
-  with open(pkl_file, 'rb') as pkl:
-    data = pickle.load(pkl)
-  keys = list(data.keys())
-  
-  if 'iptm' in keys: 
-    return {'ranking_ptm': data['ptm'], 'ranking_iptm': data['iptm'], 'ranking_debug': data['ranking_confidence']}
+# scores needed for the rankings, the pickle is loaded when they are not all recorded
+RANKING_SCORES = ('ptm', 'ranking_confidence')
+
+def ranking_scores(scores):
+  if 'iptm' in scores:
+    return {'ranking_ptm': scores['ptm'], 'ranking_iptm': scores['iptm'], 'ranking_debug': scores['ranking_confidence']}
   else:
-    return {'ranking_ptm': data['ptm'], 'ranking_debug': data['ranking_confidence']}
+    return {'ranking_ptm': scores['ptm'], 'ranking_debug': scores['ranking_confidence']}
+
+def finished_pickle_scores(pkl_file):
+  # a pickle still being written is read again at the next poll
+  try:
+    return pickle_scores(pkl_file)
+  except (EOFError, pickle.UnpicklingError):
+    return None
+
+def pickles_dir(path, files):
+  return path if any(file.endswith('.pkl') for file in files) else os.path.join(path, './light_pkl')
+
+def list_files(path):
+  return [ entry.name for entry in os.scandir(path) ] if os.path.isdir(path) else []
 
 def associate_pdb_pkl(path):
-  pkl_presence = [ i for i in os.listdir(path) if i.endswith('.pkl') ]
-  if pkl_presence:
-    pkl_dir = path
-  else:
-    pkl_dir = os.path.join(path, './light_pkl')
-  pdb = [ file for file in os.listdir(path) if file.endswith('.pdb') and f'result_model{file.split("model")[1].replace(".pdb", "")}.pkl' in os.listdir(pkl_dir) ]
-  model = [ f'model{file.split("model")[1].replace(".pdb", "")}' for file in pdb  if f'result_model{file.split("model")[1].replace(".pdb", "")}.pkl' in os.listdir(pkl_dir) ]
-  pkl = [ f'result_model{file.split("model")[1].replace(".pdb", "")}.pkl' for file in pdb  if f'result_model{file.split("model")[1].replace(".pdb", "")}.pkl' in os.listdir(pkl_dir) ]
+  # each directory is listed once, the pickles are then looked up in a set
+  files = list_files(path)
+  pkl_files = set(list_files(pickles_dir(path, files)))
+  model, pdb, pkl = [], [], []
+  for file in files:
+    if not file.endswith('.pdb') or 'model' not in file:
+      continue
+    model_name = f'model{file.split("model")[1].replace(".pdb", "")}'
+    if f'result_{model_name}.pkl' in pkl_files:
+      model.append(model_name)
+      pdb.append(file)
+      pkl.append(f'result_{model_name}.pkl')
 
   df = pd.DataFrame({'model': model, 'pdb': pdb, 'pkl': pkl})
   return df
 
-def get_all_scores(df, path):
-  pkl_presence = [ i for i in os.listdir(path) if i.endswith('.pkl') ]
-  if pkl_presence:
-    pkl_dir = path
+def load_all_scores(pkls, workers=1, extract=pickle_scores):
+  # the scores recorded next to the pickles are used first, the other pickles are loaded then recorded
+  if not pkls:
+    return []
+  pkl_dir = os.path.dirname(pkls[0])
+  table = read_scores(pkl_dir)
+  recorded = [ cached_scores(table, pkl, RANKING_SCORES) for pkl in pkls ]
+  to_load = [ pkl for pkl, scores in zip(pkls, recorded) if scores is None ]
+  # only the scalars are sent back from the worker processes, not the arrays of the pickles
+  if workers <= 1 or len(to_load) <= 1:
+    loaded = list(map(extract, to_load))
   else:
-    pkl_dir = os.path.join(path, './light_pkl')
-  pkls = [ f"{pkl_dir}/{pkl}" for pkl in df['pkl'] ]
-  results = list(map(extract_scores, pkls))
-  """
-  with ProcessPoolExecutor() as executor:
-    results = list(executor.map(extract_scores, pkls))
-  """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      loaded = list(executor.map(extract, to_load, chunksize=max(1, len(to_load) // (workers * 4))))
+  loaded = dict(zip(to_load, loaded))
+  record_scores(pkl_dir, { os.path.basename(pkl): scores for pkl, scores in loaded.items() if scores is not None })
+  return [ scores if scores is not None else loaded[pkl] for pkl, scores in zip(pkls, recorded) ]
+
+def scores_table(df, results):
   keys = list(results[0].keys())
   df_scores = pd.DataFrame()
   for score_type in keys:
     scores = [ i[score_type] for i in results ]
     df_scores[score_type] = scores
-  
-  df_with_scores = pd.concat([df, df_scores], axis = 1)
+
+  df_with_scores = pd.concat([df.reset_index(drop=True), df_scores], axis = 1)
   df_with_scores['model'] = df_with_scores['model'].apply(replace_version)
   return df_with_scores
 
+def get_all_scores(df, path, workers=1):
+  pkl_dir = pickles_dir(path, list_files(path))
+  pkls = [ f"{pkl_dir}/{pkl}" for pkl in df['pkl'] ]
+  results = [ ranking_scores(scores) for scores in load_all_scores(pkls, workers) ]
+  return scores_table(df, results)
+
 def replace_version(row):
   if 'multimer' in row and 'v' not in row:
     parts = row.split('multimer')
@@ -81,23 +124,52 @@ def replace_version(row):
     return new_row
   return row
 
-if __name__ == "__main__":
+def model_type(path):
+  is_multimer = any(file.endswith('.pdb') and 'multimer' in file for file in list_files(path))
+  return 'multimer' if is_multimer else 'monomer'
+
+def write_rankings(target_run, rankings):
+  # written then renamed, the rankings of a watched run can be read at any time
+  for ranking in rankings:
+    ranking_file = f'{target_run}/{ranking}.json'
+    with open(f'{ranking_file}.tmp', 'w') as json_ranking:
+      json.dump(rankings[ranking], json_ranking, indent=4)
+    os.replace(f'{ranking_file}.tmp', ranking_file)
+
+def watch_run(target_run, workers=1, interval=60):
+  scores = {}
+  while True:
+    df_association = associate_pdb_pkl(target_run)
+    new = df_association[~df_association['pkl'].isin(scores)]
+    if not new.empty:
+      pkl_dir = pickles_dir(target_run, list_files(target_run))
+      results = load_all_scores([ f"{pkl_dir}/{pkl}" for pkl in new['pkl'] ], workers, finished_pickle_scores)
+      finished = { pkl: ranking_scores(result) for pkl, result in zip(new['pkl'], results) if result is not None }
+      scores.update(finished)
+      if finished:
+        scored = df_association[df_association['pkl'].isin(scores)]
+        df_scored = scores_table(scored, [ scores[pkl] for pkl in scored['pkl'] ])
+        write_rankings(target_run, create_ranking(df_scored, model_type(target_run)))
+        print(f"{len(scores)} predictions ranked in {target_run}", flush=True)
+    time.sleep(interval)
+
+def main():
   args = parser.parse_args()
+  if args.watch:
+    try:
+      watch_run(args.target_run, args.workers, args.interval)
+    except KeyboardInterrupt:
+      pass
+    return
   df_association = associate_pdb_pkl(args.target_run)
-  df_scored = get_all_scores(df_association, args.target_run)
-  pdb = [ i for i in os.listdir(args.target_run) if i.endswith('.pdb') ]
-  is_multimer = False
-  for name in pdb:
-    if 'multimer' in name:
-      is_multimer = True    
-  rankings = create_ranking(df_scored, is_multimer) 
+  df_scored = get_all_scores(df_association, args.target_run, args.workers)
+  rankings = create_ranking(df_scored, model_type(args.target_run))
   print(rankings)
   if args.verbose:
     score = f"ranking_{args.verbose}" if args.verbose != 'ranking_confidence' else 'ranking_debug'
-    key = score.split('_')[1]
-    key = key if key != 'debug' else 'iptm+ptm'
+    key = list(rankings[score].keys())[0]
     print(json.dumps(rankings[score][key], indent=4))
-  for ranking in rankings:
-    with open(f'{args.target_run}/{ranking}.json', 'w') as json_ranking:
-      json.dump(rankings[ranking], json_ranking, indent=4)
-  
+  write_rankings(args.target_run, rankings)
+
+if __name__ == "__main__":
+  main()
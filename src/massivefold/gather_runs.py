@@ -4,9 +4,22 @@ import os
 import json
 import sys
 import argparse
-import numpy as np
-import pandas as pd
-from shutil import copy as cp, rmtree as rm
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from shutil import rmtree as rm
+
+from massivefold.parallelization.link_files import LINK_MODES
+from massivefold.parallelization.link_files import place_file
+from massivefold.parallelization.organize_outputs import post_treatment_threads
+from massivefold.utils import read_json
+from massivefold.utils import write_json
+
+# the runs are not modified by the gathering, their files are never moved
+GATHER_MODES = [ mode for mode in LINK_MODES if mode != 'move' ] + ['manifest']
+MANIFEST_FILE = 'gathered_files.json'
+# runs already gathered by --incremental, with the fingerprint of their ranking files and their scores
+GATHER_STATE = 'gather_state.json'
+GATHER_OPTIONS = ['include_pickles', 'exclude_confidences', 'include_rank', 'numbered_prefix', 'link_mode']
 
 parser = argparse.ArgumentParser(allow_abbrev=False)
 parser.add_argument('--runs_path', help='Path to the runs you want to gather', required=True)
@@ -23,6 +36,19 @@ parser.add_argument('--include_rank', help="Include a ranking (ambiguous for tie
 " in the name of the ranked files, also provides a mapping from original files to the gathered files.", required=False, action='store_true')
 parser.add_argument('--numbered_prefix', help="Word prefixing each structure name followed by a identifying number in the following format:"
 " <PREFIX>_<N>_<STRUCTURE_NAME> (e.g. Model_6_afm_basic_model_1_multimer_v3_pred_1.pdb for --numbered_prefix Model)" ,required=False)
+parser.add_argument('--link_mode', choices=GATHER_MODES, default='copy', help="How the files of the runs are gathered in"
+" <OUTPUT_PATH> (default: copy). 'hardlink', 'reflink' and 'symlink' do not copy the files, 'manifest' only writes the"
+f" rankings and a {MANIFEST_FILE} file mapping each gathered file name to the file of its run.")
+parser.add_argument('--threads', type=int, default=post_treatment_threads(), help="Number of runs whose rankings are"
+" read, and of files gathered, at the same time (default: %(default)s).")
+parser.add_argument('--campaign', help="Gather each sequence directory of the output directory set in --runs_path,"
+" in <OUTPUT_PATH>/<SEQUENCE> if --output_path is set, otherwise in <RUNS_PATH>/<SEQUENCE>/all_pdbs.", required=False,
+action='store_true')
+parser.add_argument('--parallel_sequences', type=int, default=4, help="With --campaign, number of sequences gathered at"
+" the same time (default: %(default)s).")
+parser.add_argument('--incremental', help=f"Keep a {GATHER_STATE} file in <OUTPUT_PATH> so that the next gathering only"
+" reads the runs that are new or whose rankings changed, and only gathers their files.", required=False,
+action='store_true')
 
 def global_rank_to_json(ranking, output_path):
   map_pred_run = dict(zip(list(ranking["parameters"] + "_" + ranking["model_name"]), list(ranking['parameters'])))
@@ -45,14 +71,17 @@ def global_rank_to_json(ranking, output_path):
 
   return map_pred_run
 
-def create_prediction_filename_map(all_runs_path, runs):
-  prediction_filename_map = {}
-  for run in runs:
-    path = os.path.join(all_runs_path, run)
-    ranked_preds = [ pred for pred in os.listdir(path) if pred.startswith('ranked_') ]
-    prediction_filename_map[run] = {}
-    for ranked_pred in ranked_preds:
-      unranked_pred = ranked_pred.split('_', 2)[-1]
+def ranked_prediction_index(run_path):
+  # ranked files of a run by rank, and by rank and name of their prediction with or without its relaxation prefix
+  index = {'files': set(), 'ranks': {}, 'predictions': {}}
+  with os.scandir(run_path) as entries:
+    for entry in entries:
+      ranked_pred = entry.name
+      if not ranked_pred.startswith('ranked_') or ranked_pred.count('_') < 2 or not entry.is_file():
+        continue
+      index['files'].add(ranked_pred)
+      rank, unranked_pred = ranked_pred.split('_', 2)[1:]
+      index['ranks'].setdefault(rank, []).append(ranked_pred)
       corrected_pred = ranked_pred.replace('relaxed', 'unrelaxed').split('_', 2)[-1] \
         if '_relaxed' in ranked_pred else unranked_pred
       aliases = set()
@@ -64,9 +93,12 @@ def create_prediction_filename_map(all_runs_path, runs):
             aliases.add(candidate_stem[len(relaxation_prefix):])
 
       for alias in aliases:
-        prediction_filename_map[run].setdefault(alias, []).append(ranked_pred)
+        index['predictions'].setdefault((rank, alias), []).append(ranked_pred)
+  return index
 
-  return prediction_filename_map
+def create_prediction_filename_map(all_runs_path, runs, threads=1):
+  return dict(zip(runs, map_in_pool(
+    lambda run: ranked_prediction_index(os.path.join(all_runs_path, run)), runs, threads)))
 
 def find_single_run_predictions(all_runs_path: str, run_name: str, ordered_names: list, prediction_filename_map=None):
   """
@@ -104,15 +136,15 @@ def find_single_run_predictions(all_runs_path: str, run_name: str, ordered_names
   # reconstitute full filenames
   do_not_exist = []
   full_filenames = []
-  run_prediction_map = prediction_filename_map.get(run_name, {}) if prediction_filename_map else {}
+  run_index = prediction_filename_map.get(run_name) if prediction_filename_map else None
+  if run_index is None:
+    run_index = ranked_prediction_index(os.path.join(all_runs_path, run_name))
   if is_alphafold2:
-    all_preds = os.listdir(os.path.join(all_runs_path, run_name))
     for i, pred in enumerate(ordered_names):
-      prefix = f"ranked_{str(i)}_"
       suffix = f"{pred}.pdb"
-      matches = [ mapped_pred for mapped_pred in run_prediction_map.get(pred, []) if mapped_pred.startswith(prefix) ]
+      matches = run_index['predictions'].get((str(i), pred), [])
       if not matches:
-        matches = [ i for i in all_preds if i.startswith(prefix) and i.endswith(suffix) ]
+        matches = [ ranked_pred for ranked_pred in run_index['ranks'].get(str(i), []) if ranked_pred.endswith(suffix) ]
       if len(matches) == 0 or len(matches) > 1:
         do_not_exist.append(f"(ranked_{str(i)} => {pred})")
       else:
@@ -121,47 +153,92 @@ def find_single_run_predictions(all_runs_path: str, run_name: str, ordered_names
     full_filenames = [ f"ranked_{i}_{pred}.cif" for i, pred in enumerate(ordered_names) ]
   
   # check if these reconstituted files exist
-  does_file_exist = lambda x: os.path.isfile(os.path.join(all_runs_path, run_name, x))
+  does_file_exist = lambda x: x in run_index['files']
   do_not_exist.extend([ pred for pred in full_filenames if not does_file_exist(pred) ])
   assert not do_not_exist, f'Some files ({len(do_not_exist)}) for run {run_name} were not found: {", ".join(do_not_exist)}'
 
   return full_filenames
 
-def rank_all(all_runs_path, all_runs, output_path, ranking_type="debug", prediction_filename_map=None):
-  runs = [ os.path.join(all_runs_path, run) for run in all_runs ]
-
-  all_models = pd.DataFrame()
-  os.makedirs(output_path, exist_ok=True)
-
-  #ranked_per_run = {}
-  for run in runs:
-    single_run_models = pd.DataFrame()
-    ranking_path = os.path.join(run, f'ranking_debug.json')
-    run_score_path = os.path.join(run, f'ranking_{ranking_type}.json')
-    with open(ranking_path, 'r') as local_ranking_file:
-      local_rank = json.load(local_ranking_file)
-
-    model_names = local_rank["order"]
-    score_ranking = json.load(open(run_score_path, 'r'))
+def map_in_pool(function, items, threads=1):
+  # results in the order of the items, the first error is raised once the running calls ended
+  if threads <= 1 or len(items) <= 1:
+    return [ function(item) for item in items ]
+  with ThreadPoolExecutor(max_workers=threads) as executor:
+    return list(executor.map(function, items))
+
+def load_run_rankings(all_runs_path, run, ranking_types, prediction_filename_map=None):
+  # all the scores of a run as columns, each of its ranking files is read once
+  with open(os.path.join(all_runs_path, run, 'ranking_debug.json'), 'r') as local_ranking_file:
+    local_rank = json.load(local_ranking_file)
+  model_names = local_rank["order"]
+  try:
+    predictions = find_single_run_predictions(all_runs_path, run, model_names, prediction_filename_map)
+  except AssertionError as e:
+    print(f"Assertion error: {str(e)[:300]}...")
+    sys.exit()
+
+  run_ranking = {'file': predictions}
+  for ranking_type in ranking_types:
+    run_score_path = os.path.join(all_runs_path, run, f'ranking_{ranking_type}.json')
+    if ranking_type == 'debug':
+      score_ranking = local_rank
+    elif os.path.isfile(run_score_path):
+      score_ranking = json.load(open(run_score_path, 'r'))
+    else:
+      continue
     ranking_key_score = list(score_ranking.keys())[0]
-    scores = [ score_ranking[ranking_key_score][model] for model in model_names ]
+    if ranking_key_score in run_ranking:
+      continue
+    run_ranking[ranking_key_score] = [ score_ranking[ranking_key_score][model] for model in model_names ]
+    if ranking_type == 'debug':
+      run_ranking['parameters'] = [run] * len(model_names)
+      run_ranking['model_name'] = model_names
+  return run_ranking
+
+def concat_run_rankings(run_rankings):
+  import pandas as pd
+  # a metric is kept when every run has it, the table is built once from the columns of all the runs
+  columns = [ column for column in run_rankings[0] if all(column in run_ranking for run_ranking in run_rankings) ]
+  for column in dict.fromkeys(column for run_ranking in run_rankings for column in run_ranking):
+    if column not in columns:
+      print(f"No ranking for {column} metric.")
+  return pd.DataFrame({
+    column: [ value for run_ranking in run_rankings for value in run_ranking[column] ] for column in columns
+  })
+
+def gather_file(source, destination, link_mode):
+  # with --link_mode manifest, the gathered file is only mapped to the file of its run
+  if link_mode == 'manifest':
+    if not os.path.isfile(source):
+      raise FileNotFoundError(f"No such file or directory: '{source}'")
+  else:
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    place_file(source, destination, link_mode)
+  return os.path.realpath(source)
+
+def gather_files(to_gather, link_mode, threads=1):
+  # (source, destination, message) to gather, a missing source is an error without message and ignored otherwise
+  def gather(file_to_gather):
+    source, destination, missing_message = file_to_gather
     try:
-      predictions = find_single_run_predictions(all_runs_path, run, model_names, prediction_filename_map)
-    except AssertionError as e:
-      print(f"Assertion error: {str(e)[:300]}...")
-      sys.exit()
-    single_run_models['file'] = predictions
-    single_run_models[ranking_key_score] = scores
-    parameter_set = os.path.basename(os.path.normpath(run))
-    single_run_models['parameters'] = parameter_set
-    single_run_models["model_name"] = model_names
-    #ranked_per_run[os.path.basename(run)] = single_run_models
-    all_models = pd.concat([all_models, single_run_models], axis=0)
-
-  #return ranked_per_run
-  return all_models
-
-def copy_confidence_file(all_runs_path, output_path, run_name, prediction_old_file, model_name, gathered_structure_file):
+      return destination, gather_file(source, destination, link_mode)
+    except FileNotFoundError:
+      if missing_message is None:
+        raise
+      if missing_message:
+        print(missing_message)
+      return destination, None
+  gathered = map_in_pool(gather, to_gather, threads)
+  return { destination: source for destination, source in gathered if source is not None }
+
+def gathered_files(output_path, manifest):
+  return { os.path.relpath(destination, output_path): source for destination, source in manifest.items() }
+
+def write_manifest(output_path, gathered):
+  with open(os.path.join(output_path, MANIFEST_FILE), 'w') as fileout:
+    fileout.write(json.dumps(gathered, indent=4))
+
+def find_confidence_file(all_runs_path, output_path, run_name, prediction_old_file, model_name, gathered_structure_file):
   confidence_path = os.path.join(all_runs_path, run_name, "confidences")
   if not os.path.isdir(confidence_path):
     return
@@ -182,9 +259,8 @@ def copy_confidence_file(all_runs_path, output_path, run_name, prediction_old_fi
     return
 
   gathered_confidence_path = os.path.join(output_path, "confidences")
-  os.makedirs(gathered_confidence_path, exist_ok=True)
   gathered_confidence_file = os.path.splitext(gathered_structure_file)[0] + ".json"
-  cp(old_confidence_path, os.path.join(gathered_confidence_path, gathered_confidence_file))
+  return old_confidence_path, os.path.join(gathered_confidence_path, gathered_confidence_file)
 
 def move_and_rename(
     all_runs_path,
@@ -193,12 +269,16 @@ def move_and_rename(
     ranking,
     do_include_pickles,
     do_exclude_confidences,
-    do_include_rank):
+    do_include_rank,
+    link_mode='copy',
+    threads=1):
+  import pandas as pd
 
   output_folder = os.path.basename(output_path)
   score_key = ranking.columns[1]
   global_rank_order = ranking.to_dict(orient="records")
   models, runs, predictions, scores, mapped_names = [], [], [], [], []
+  to_gather = []
   for i, prediction in enumerate(global_rank_order):
     run_name = prediction["parameters"]
     prediction_old_file = prediction["file"]
@@ -209,10 +289,7 @@ def move_and_rename(
     if i == 0:
       features_old_name = os.path.join(all_runs_path, run_name, "features.pkl")
       features_new_name = os.path.join(output_path, "features.pkl")
-      try:
-        cp(features_old_name, features_new_name)
-      except FileNotFoundError:
-        print(f'features.pkl not found in {run_name} run')
+      to_gather.append((features_old_name, features_new_name, f'features.pkl not found in {run_name} run'))
 
     # copy the predictions
     old_pdb_path = os.path.join(all_runs_path, run_name, prediction_old_file)
@@ -233,9 +310,12 @@ def move_and_rename(
     mapped_names.append(os.path.basename(pdb_file))
 
     new_pdb_path = os.path.join(output_path, pdb_file)
-    cp(old_pdb_path, new_pdb_path)
+    to_gather.append((old_pdb_path, new_pdb_path, None))
     if not do_exclude_confidences:
-      copy_confidence_file(all_runs_path, output_path, run_name, prediction_old_file, model_name, pdb_file)
+      confidence_file = find_confidence_file(
+        all_runs_path, output_path, run_name, prediction_old_file, model_name, pdb_file)
+      if confidence_file:
+        to_gather.append(confidence_file + (None,))
 
     if do_include_pickles:
       prediction_name = prediction["parameters"]  + "_" + prediction["model_name"]
@@ -245,10 +325,10 @@ def move_and_rename(
 
       old_pkl_path = os.path.join(pickles_path, f"result_{prediction['model_name']}.pkl")
       new_pkl_path = os.path.join(output_path, f"{prediction_name}.pkl")
-      try:
-        cp(old_pkl_path, new_pkl_path)
-      except:
-        pass
+      to_gather.append((old_pkl_path, new_pkl_path, ''))
+
+  # the files are gathered several at a time once all of them are listed
+  manifest = gather_files(to_gather, link_mode, threads)
 
   mapping = pd.DataFrame(
       {"model": models, "run": runs, "prediction": predictions, score_key: scores, "mapped_name": mapped_names}
@@ -262,11 +342,15 @@ def move_and_rename(
   mapping = mapping.merge(to_merge, left_on=["run", "prediction"], right_on=["parameters", "file"]).drop(columns=["parameters", "file"])
 
   mapping.to_csv(os.path.join(output_path, f'ranking_{output_folder}.csv'), index=False)
-def check_all_runs(all_runs_path, ignored_directories, ranking_type='debug'):
+  return manifest
+
+def check_all_runs(all_runs_path, ignored_directories, ranking_type='debug', unchanged_runs=()):
   considered_runs = []
 
   for run in os.listdir(all_runs_path):
-    if run not in ignored_directories:
+    if run in unchanged_runs:
+      considered_runs.append(run)
+    elif run not in ignored_directories:
       ranking_path = os.path.join(all_runs_path, run, f'ranking_{ranking_type}.json')
       if os.path.isfile(ranking_path):
         try:
@@ -280,21 +364,16 @@ def check_all_runs(all_runs_path, ignored_directories, ranking_type='debug'):
   print(f"These are the {len(considered_runs)} following runs gathered in the output:\n{formated_runs}\n")
   return considered_runs
 
-def create_global_ranking(runs, runs_path, output_path, ranking_types, prediction_filename_map=None):
-  all_metrics_ranking = None
-  for i, ranking_type in enumerate(ranking_types):
-    try:
-      ranking_per_run = rank_all(runs_path, runs, output_path, ranking_type, prediction_filename_map)
-      if all_metrics_ranking is None:
-        all_metrics_ranking = ranking_per_run.copy()
-      else:
-        all_metrics_ranking = all_metrics_ranking.merge(
-          rank_all(runs_path, runs, output_path, ranking_type, prediction_filename_map),
-          on=["file", "parameters", "model_name"]
-        )
-    except FileNotFoundError as e:
-      print(f"No ranking for {ranking_type} metric.")
-
+def metrics_ranking(runs, runs_path, output_path, ranking_types, prediction_filename_map=None, threads=1):
+  os.makedirs(output_path, exist_ok=True)
+  run_rankings = map_in_pool(
+    lambda run: load_run_rankings(runs_path, run, ranking_types, prediction_filename_map), runs, threads)
+  return concat_run_rankings(run_rankings)
+
+def create_global_ranking(
+    runs, runs_path, output_path, ranking_types, prediction_filename_map=None, all_metrics_ranking=None, threads=1):
+  if all_metrics_ranking is None:
+    all_metrics_ranking = metrics_ranking(runs, runs_path, output_path, ranking_types, prediction_filename_map, threads)
   run_names = all_metrics_ranking["parameters"].unique().tolist()
 
   if "iptm" in all_metrics_ranking:
@@ -329,11 +408,11 @@ def create_global_ranking(runs, runs_path, output_path, ranking_types, predictio
   all_runs_ranking = all_metrics_ranking.sort_values(
     scores_to_order, ascending=False, ignore_index=True
   )
+  # tied predictions share the rank of the first of them
+  first_of_ties = all_runs_ranking[scores_to_order].ne(all_runs_ranking[scores_to_order].shift()).any(axis=1)
   all_runs_ranking["global_rank"] = (
-      all_runs_ranking.reset_index()
-      .groupby(scores_to_order)["index"]
-      .transform("min") + 1
-  ).astype(int)
+    first_of_ties * (all_runs_ranking.index + 1)
+  ).cummax().astype(int)
 
   columns_order = ['global_rank', common_key_score, 'parameters', 'file', "model_name"]
   ordering_score.remove(common_key_score)
@@ -342,10 +421,99 @@ def create_global_ranking(runs, runs_path, output_path, ranking_types, predictio
   print(whole_prediction_ranking)
   return whole_prediction_ranking
 
-def main():
-  args = parser.parse_args()
-  runs_path = args.runs_path
-  output_path = args.output_path
+def load_gather_state(output_path, options):
+  # a gathering made without --incremental or with other options is made again from scratch
+  state_path = os.path.join(output_path, GATHER_STATE)
+  if os.path.isfile(state_path):
+    state = read_json(state_path)
+    if state['options'] == options:
+      return state
+  return {'options': options, 'runs': {}, 'files': {}}
+
+def run_fingerprint(run_path, ranking_types, previous=None):
+  # the ranking files are only read again when their modification time or size changed
+  files = {}
+  for ranking_type in ranking_types:
+    ranking_path = os.path.join(run_path, f'ranking_{ranking_type}.json')
+    if os.path.isfile(ranking_path):
+      ranking_stat = os.stat(ranking_path)
+      files[ranking_type] = [ranking_stat.st_mtime, ranking_stat.st_size]
+  if previous and previous['files'] == files:
+    return previous
+  digest = hashlib.sha256()
+  for ranking_type in sorted(files):
+    with open(os.path.join(run_path, f'ranking_{ranking_type}.json'), 'rb') as ranking_file:
+      digest.update(ranking_type.encode() + ranking_file.read())
+  return {'files': files, 'hash': digest.hexdigest()}
+
+def incremental_metrics_ranking(runs_path, ignored_dir, output_path, ranking_types, state, threads=1):
+  candidates = [
+    run for run in os.listdir(runs_path)
+    if run not in ignored_dir and os.path.isfile(os.path.join(runs_path, run, 'ranking_debug.json'))
+  ]
+  fingerprints = {
+    run: run_fingerprint(os.path.join(runs_path, run), ranking_types, state['runs'].get(run, {}).get('fingerprint'))
+    for run in candidates
+  }
+  unchanged = [
+    run for run in candidates
+    if run in state['runs'] and state['runs'][run]['fingerprint']['hash'] == fingerprints[run]['hash']
+  ]
+  runs = check_all_runs(runs_path, ignored_dir, unchanged_runs=unchanged)
+  assert runs, "There should be at least one run to gather"
+  changed = [ run for run in runs if run not in unchanged ]
+  print(f"{len(unchanged)} runs already gathered, reading the {len(changed)} new or changed runs\n")
+
+  os.makedirs(output_path, exist_ok=True)
+  prediction_filename_map = create_prediction_filename_map(runs_path, changed, threads)
+  changed_rankings = map_in_pool(
+    lambda run: load_run_rankings(runs_path, run, ranking_types, prediction_filename_map), changed, threads)
+  run_rankings = dict(zip(changed, changed_rankings))
+  for run in unchanged:
+    run_rankings[run] = state['runs'][run]['ranking']
+  state['runs'] = { run: {'fingerprint': fingerprints[run], 'ranking': run_rankings[run]} for run in runs }
+  all_metrics_ranking = concat_run_rankings([ run_rankings[run] for run in runs ])
+  return all_metrics_ranking, changed
+
+def update_gathered_files(runs_path, output_path, gathered, state, changed_runs, link_mode, threads=1):
+  # the files of the new or changed runs are gathered, the other ones are only renamed if their name changed
+  changed_paths = tuple(os.path.join(os.path.realpath(os.path.join(runs_path, run)), '') for run in changed_runs)
+  kept, previous_names = [], {}
+  for name, source in state['files'].items():
+    if gathered.get(name) == source and not source.startswith(changed_paths):
+      kept.append(name)
+    elif not source.startswith(changed_paths):
+      previous_names[source] = name
+
+  # renamed files are moved aside first, their new name can be the previous name of another file
+  to_rename = {
+    name: previous_names.pop(source) for name, source in gathered.items()
+    if name not in kept and source in previous_names
+    and os.path.lexists(os.path.join(output_path, previous_names[source]))
+  }
+  renaming_path = os.path.join(output_path, '.renaming')
+  os.makedirs(renaming_path, exist_ok=True)
+  for i, previous_name in enumerate(to_rename.values()):
+    os.replace(os.path.join(output_path, previous_name), os.path.join(renaming_path, str(i)))
+  for i, name in enumerate(to_rename):
+    os.makedirs(os.path.dirname(os.path.join(output_path, name)), exist_ok=True)
+    os.replace(os.path.join(renaming_path, str(i)), os.path.join(output_path, name))
+  os.rmdir(renaming_path)
+
+  to_gather = [
+    (source, os.path.join(output_path, name), None) for name, source in gathered.items()
+    if name not in kept and name not in to_rename
+  ]
+  gather_files(to_gather, link_mode, threads)
+  renamed = set(to_rename.values())
+  removed = [ name for name in state['files'] if name not in gathered and name not in renamed ]
+  for name in removed:
+    if os.path.lexists(os.path.join(output_path, name)):
+      os.remove(os.path.join(output_path, name))
+  print(f"{len(to_gather)} files gathered, {len(to_rename)} renamed, {len(kept)} unchanged and {len(removed)} removed")
+
+def gather_sequence(runs_path, output_path, args):
+  import pandas as pd
   is_output_path_set = output_path is not None
   if not output_path:
     output_path = os.path.join(runs_path, 'all_pdbs')
@@ -359,14 +527,25 @@ def main():
   if ignored_dir:
     print(f"The following directories are ignored:\n{' - '.join(ignored_dir)}\n")
 
-  if os.path.exists(output_path) and not args.only_ranking:
+  state = None
+  if args.incremental:
+    state = load_gather_state(output_path, { option: getattr(args, option) for option in GATHER_OPTIONS })
+
+  if os.path.exists(output_path) and not args.only_ranking and not (state and state['runs']):
     print(f'{output_path} from previous iterations exists, deleting it then repeat.')
     rm(output_path)
 
-  runs = check_all_runs(runs_path, ignored_dir)
-  assert runs, "There should be at least one run to gather"
-  prediction_filename_map = create_prediction_filename_map(runs_path, runs)
-  whole_prediction_ranking = create_global_ranking(runs, runs_path, output_path, ranking_types, prediction_filename_map)
+  if state is None:
+    runs = check_all_runs(runs_path, ignored_dir)
+    assert runs, "There should be at least one run to gather"
+    prediction_filename_map = create_prediction_filename_map(runs_path, runs, args.threads)
+    whole_prediction_ranking = create_global_ranking(
+      runs, runs_path, output_path, ranking_types, prediction_filename_map, threads=args.threads)
+  else:
+    all_metrics_ranking, changed_runs = incremental_metrics_ranking(
+      runs_path, ignored_dir, output_path, ranking_types, state, args.threads)
+    whole_prediction_ranking = create_global_ranking(
+      None, runs_path, output_path, ranking_types, all_metrics_ranking=all_metrics_ranking)
   if not args.only_ranking:
     file_index = whole_prediction_ranking.columns.tolist().index("file")
     whole_prediction_ranking["extension"] = '.' + whole_prediction_ranking["file"].str.split('.').str[1]
@@ -416,17 +595,80 @@ def main():
       print("Pickle files are also included in the gathering.")
     if not args.exclude_confidences:
       print("Confidence files are also included in the gathering.")
-    move_and_rename(
+    if args.link_mode == 'manifest':
+      print(f"Only the rankings and {os.path.join(output_path, MANIFEST_FILE)} are written, the files stay in the runs.")
+    elif args.link_mode != 'copy':
+      print(f"The files of the runs are gathered with {args.link_mode}s.")
+    # an incremental gathering first lists the files, then only gathers the ones that changed
+    manifest = move_and_rename(
       runs_path,
       pred_run_map,
       output_path,
       whole_prediction_ranking,
       args.include_pickles,
       args.exclude_confidences,
-      args.include_rank
+      args.include_rank,
+      'manifest' if state is not None else args.link_mode,
+      args.threads
     )
+    gathered = gathered_files(output_path, manifest)
+    if state is not None:
+      if args.link_mode != 'manifest':
+        update_gathered_files(runs_path, output_path, gathered, state, changed_runs, args.link_mode, args.threads)
+      state['files'] = gathered
+      write_json(os.path.join(output_path, GATHER_STATE), state)
+    if args.link_mode == 'manifest':
+      write_manifest(output_path, gathered)
   elif os.path.exists(output_path):
     rm(output_path)
 
+def campaign_sequences(output_root):
+  # the sequence directories are the ones containing at least one post treated run
+  sequences = []
+  for sequence in sorted(os.listdir(output_root)):
+    sequence_path = os.path.join(output_root, sequence)
+    if not os.path.isdir(sequence_path):
+      continue
+    if any(os.path.isfile(os.path.join(sequence_path, run, 'ranking_debug.json')) for run in os.listdir(sequence_path)):
+      sequences.append(sequence)
+  return sequences
+
+def gather_campaign(args):
+  sequences = campaign_sequences(args.runs_path)
+  assert sequences, f"There should be at least one sequence with runs to gather in {args.runs_path}"
+  print(f"Gathering the {len(sequences)} sequences of {args.runs_path}, {args.parallel_sequences} at a time:\n"
+        f"{' - '.join(sequences)}\n")
+  failed = []
+  with ProcessPoolExecutor(max_workers=args.parallel_sequences) as executor:
+    futures = {
+      sequence: executor.submit(
+        gather_sequence,
+        os.path.join(args.runs_path, sequence),
+        os.path.join(args.output_path, sequence) if args.output_path else None,
+        args)
+      for sequence in sequences
+    }
+    for sequence, future in futures.items():
+      # a sequence whose runs can not be gathered does not stop the others
+      try:
+        future.result()
+      except (Exception, SystemExit) as e:
+        print(f"Gathering of {sequence} failed: {e}")
+        failed.append(sequence)
+  if failed:
+    print(f"{len(failed)} sequences not gathered: {' - '.join(failed)}")
+    sys.exit(1)
+
+def main():
+  args = parser.parse_args()
+  if args.incremental and args.only_ranking:
+    parser.error("--incremental updates a previous gathering, it can not be used with --only_ranking")
+  if args.threads < 1 or args.parallel_sequences < 1:
+    parser.error("--threads and --parallel_sequences should be at least 1")
+  if args.campaign:
+    gather_campaign(args)
+  else:
+    gather_sequence(args.runs_path, args.output_path, args)
+
 if __name__ == "__main__":
   main()
@@ -1,20 +1,17 @@
 #!/usr/bin/env python
 
-import numpy as np
-import pandas as pd
 import os
 import sys
 import pickle
 import json
 import argparse
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
-from scipy.stats import gaussian_kde
 import shutil
-from matplotlib.lines import Line2D
-import seaborn as sns
 
-from .plots.colabfold_plots import plot_msa_v2, plot_plddts, plot_confidence, plot_paes, plot_plddt_legend
+from massivefold.parallelization.array_store import has_store
+from massivefold.parallelization.array_store import read_arrays
+from massivefold.parallelization.array_store import read_index
+
+# numpy, pandas, matplotlib and seaborn are imported by the plots using them, a post treatment only draws a few plots
 
 def parse_csv(value):
   if value is None:
@@ -31,7 +28,22 @@ def extract_top_predictions(input_path, top_n_predictions):
 
   return top_pred
   
+def arrays_index(jobname):
+  # read once for all the predictions plotted from the array store of the run
+  return read_index(jobname) if has_store(jobname) else None
+
+def load_prediction_result(jobname, pred, pkl_dir=None, index=None):
+  # the pickles of a run lightened with --pickle_size arrays are replaced by its array store
+  pkl_file = f'{pkl_dir or jobname}/result_{pred}.pkl'
+  if not os.path.isfile(pkl_file) and (index is not None or has_store(jobname)):
+    return read_arrays(jobname, pred, index)
+  with open(pkl_file, "rb") as results_file:
+    return pickle.load(results_file)
+
 def CF_PAEs(input_path, top_n_predictions, action, output_path, image_format):
+  import numpy as np
+  import matplotlib.pyplot as plt
+  from .plots.colabfold_plots import plot_paes
   all_models_pae = []
   jobname = input_path
   preds_to_plot = extract_top_predictions(input_path, top_n_predictions)
@@ -41,9 +53,9 @@ def CF_PAEs(input_path, top_n_predictions, action, output_path, image_format):
   if os.path.isdir(light_pkl) and len(os.listdir(light_pkl)) != 0:
     pkl_dir = light_pkl
   
+  index = arrays_index(jobname)
   for pred in preds_to_plot:
-    with open(f'{pkl_dir}/result_{pred}.pkl', "rb") as pkl_file:
-      data = pickle.load(pkl_file)
+    data = load_prediction_result(jobname, pred, pkl_dir, index)
     all_models_pae.append(np.asarray(data['predicted_aligned_error']))
   plot_paes(all_models_pae)
   if action == "save":
@@ -54,12 +66,15 @@ def CF_PAEs(input_path, top_n_predictions, action, output_path, image_format):
     plt.show()
     
 def CF_plddts(input_path, top_n_predictions, action, output_path, image_format):
+  import numpy as np
+  import matplotlib.pyplot as plt
+  from .plots.colabfold_plots import plot_plddts
   all_models_plddt = []
   jobname = input_path
   preds_to_plot = extract_top_predictions(input_path, top_n_predictions)
+  index = arrays_index(jobname)
   for pred in preds_to_plot:
-    with open(f'{jobname}/result_{pred}.pkl', "rb") as pkl_file:
-      data = pickle.load(pkl_file)
+    data = load_prediction_result(jobname, pred, index=index)
     all_models_plddt.append(np.asarray(data['plddt']))
   plot_plddts(all_models_plddt)
   if action == "save":
@@ -69,14 +84,14 @@ def CF_plddts(input_path, top_n_predictions, action, output_path, image_format):
   if action == "show":
     plt.show()
 
-def MF_DM_dual_plddt_PAE(prediction, rank, input_path, action, output_path, image_format):
+def MF_DM_dual_plddt_PAE(prediction, rank, input_path, action, output_path, image_format, index=None):
+  import matplotlib.pyplot as plt
   jobname = input_path
   pkl_dir = jobname
   light_pkl = f'{jobname}/light_pkl'
   if os.path.isdir(light_pkl) and len(os.listdir(light_pkl)) != 0:
     pkl_dir = light_pkl
-  with open(f'{pkl_dir}/result_{prediction}.pkl', "rb") as results_file:
-    results = pickle.load(results_file)
+  results = load_prediction_result(jobname, prediction, pkl_dir, index)
 
   pae_outputs = {}
   pae_outputs["test"] = (results["predicted_aligned_error"], results['max_predicted_aligned_error'])
@@ -107,15 +122,18 @@ def MF_DM_dual_plddt_PAE(prediction, rank, input_path, action, output_path, imag
 
 def call_dual(input_path, top_n_predictions, action, output_path, image_format):
   preds_to_plot = extract_top_predictions(input_path, top_n_predictions)
+  index = arrays_index(input_path)
   for i, pred in enumerate(preds_to_plot):
-    MF_DM_dual_plddt_PAE(pred, i, input_path, action, output_path, image_format)
+    MF_DM_dual_plddt_PAE(pred, i, input_path, action, output_path, image_format, index)
   
 def MF_indiv_plddt(input_path, top_n_predictions, action, output_path, image_format):
+  import matplotlib.pyplot as plt
+  from .plots.colabfold_plots import plot_confidence
   jobname = input_path
   preds_to_plot = extract_top_predictions(input_path, top_n_predictions)
+  index = arrays_index(jobname)
   for i, pred in enumerate(preds_to_plot):
-    with open(f'{jobname}/result_{pred}.pkl', "rb") as pkl_file:
-      data = pickle.load(pkl_file)
+    data = load_prediction_result(jobname, pred, index=index)
     plot_confidence(data['plddt'])
     plt.title(f'rank_{i}_{pred} predicted lDDT')
     if action == "save":
@@ -126,6 +144,8 @@ def MF_indiv_plddt(input_path, top_n_predictions, action, output_path, image_for
       plt.show()
             
 def MF_coverage(input_path, action, output_path, image_format):
+  import matplotlib.pyplot as plt
+  from .plots.colabfold_plots import plot_msa_v2
   jobname = input_path
   if os.path.isfile(f'{jobname}/features.pkl'):
     with open(f'{jobname}/features.pkl', 'rb') as f:
@@ -139,6 +159,7 @@ def MF_coverage(input_path, action, output_path, image_format):
       plt.show()
 
 def MF_score_histogram(scores, action, output_path, image_format):
+  import matplotlib.pyplot as plt
   try:
     scores = scores['iptm+ptm']
   except KeyError:
@@ -156,6 +177,9 @@ def MF_score_histogram(scores, action, output_path, image_format):
     plt.close(histogram)
 
 def MF_versions_density(scores, action=None, output_path=None, image_format=None, given_ax=None):
+  import pandas as pd
+  import matplotlib.pyplot as plt
+  import seaborn as sns
   try:
     scores = scores['iptm+ptm']
   except KeyError:
@@ -190,6 +214,8 @@ def MF_versions_density(scores, action=None, output_path=None, image_format=None
     plt.close(kde_versions)
 
 def MF_models_scores(scores, action=None, output_path=None, image_format=None, given_ax=None):
+  import pandas as pd
+  import matplotlib.pyplot as plt
   try:
     scores = scores['iptm+ptm']
     s_type = 'iptm+ptm'
@@ -293,6 +319,8 @@ def MF_legacy_recycle_extraction(log):
   return recycle_logs
 
 def MF_distribution_comparison(run_names=None, given_ax=None, input_path=None, runs_to_compare=None, image_format=None):
+  import pandas as pd
+  import matplotlib.pyplot as plt
   fig, ax = plt.subplots()
   
   if input_path is not None and runs_to_compare is not None:
@@ -462,11 +490,12 @@ def MF_recycling_pred_to_batch(batches_file):
   for batch in batches_to_model:
     start = int(batches_to_model[batch]['start'])
     end = int(batches_to_model[batch]['end'])
-    model = batches_to_model[batch]['model']
-    if not model in model_to_batch:
-      model_to_batch[model] = {}
-    pred_to_batch = {pred: batch for pred in range(start, end + 1)}
-    model_to_batch[model].update(pred_to_batch)
+    # packed batches (massivefold run --pack) run several models
+    for model in batches_to_model[batch]['model'].split(','):
+      if not model in model_to_batch:
+        model_to_batch[model] = {}
+      pred_to_batch = {pred: batch for pred in range(start, end + 1)}
+      model_to_batch[model].update(pred_to_batch)
   return model_to_batch
 
 def MF_recycling_plot(
@@ -481,6 +510,9 @@ def MF_recycling_plot(
     output_path,
     image_format,
     given_ax=None):
+  import numpy as np
+  import matplotlib.pyplot as plt
+  import matplotlib.ticker as ticker
  
   if not given_ax:
     fig, ax1 = plt.subplots()
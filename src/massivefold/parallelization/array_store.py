@@ -0,0 +1,99 @@
+import os
+import shutil
+
+from massivefold.utils import read_json
+from massivefold.utils import write_json
+
+# per-residue pLDDT and PAE of all the predictions of a run, each stacked in a single file read as a memory map:
+#   <run>/arrays/plddt.bin   float32 pLDDT of the predictions, one after the other
+#   <run>/arrays/pae.bin     flattened PAE matrices, in float32, float16 or uint8 steps of pae_precision Å
+#   <run>/arrays/index.json  offsets and sizes of the arrays of each prediction, with its scores
+ARRAYS_DIR = 'arrays'
+INDEX_FILE = 'index.json'
+PLDDT_FILE = 'plddt.bin'
+PAE_FILE = 'pae.bin'
+PAE_FORMATS = ['float32', 'float16', 'uint8']
+
+def store_path(directory):
+  return os.path.join(directory, ARRAYS_DIR)
+
+def has_store(directory):
+  return os.path.isfile(os.path.join(store_path(directory), INDEX_FILE))
+
+def quantize_pae(pae, pae_format='float16', precision=0.25):
+  import numpy as np
+  if pae_format == 'uint8':
+    return np.clip(np.rint(np.asarray(pae, dtype='float32') / precision), 0, 255).astype('uint8')
+  return np.asarray(pae, dtype=pae_format)
+
+def prediction_arrays(result, pae_format='float16', precision=0.25):
+  # arrays of a result pickle as they are stored
+  import numpy as np
+  arrays = {'plddt': np.asarray(result['plddt'], dtype='float32').ravel()}
+  if result.get('predicted_aligned_error') is not None:
+    arrays['pae'] = quantize_pae(result['predicted_aligned_error'], pae_format, precision)
+  return arrays
+
+def create_store(directory, pae_format='float16', precision=0.25):
+  path = store_path(directory)
+  if os.path.isdir(path):
+    shutil.rmtree(path)
+  os.makedirs(path)
+  return {
+    'path': path,
+    'plddt_file': open(os.path.join(path, PLDDT_FILE), 'wb'),
+    'pae_file': open(os.path.join(path, PAE_FILE), 'wb'),
+    'plddt_size': 0,
+    'pae_size': 0,
+    'index': {
+      'pae_format': pae_format,
+      'pae_precision': precision if pae_format == 'uint8' else None,
+      'predictions': {},
+    },
+  }
+
+def add_prediction(store, prediction, arrays, scores=None):
+  entry = dict(scores or {})
+  entry['residues'] = len(arrays['plddt'])
+  entry['plddt_offset'] = store['plddt_size']
+  arrays['plddt'].tofile(store['plddt_file'])
+  store['plddt_size'] += len(arrays['plddt'])
+  if 'pae' in arrays:
+    # the PAE of AlphaFold3 is per token, not always the size of the pLDDT
+    entry['pae_residues'] = arrays['pae'].shape[0]
+    entry['pae_offset'] = store['pae_size']
+    arrays['pae'].tofile(store['pae_file'])
+    store['pae_size'] += arrays['pae'].size
+  store['index']['predictions'][prediction] = entry
+
+def close_store(store):
+  # the index is written last, a store without index is not complete
+  store['plddt_file'].close()
+  store['pae_file'].close()
+  write_json(os.path.join(store['path'], INDEX_FILE), store['index'])
+  return store['index']
+
+def read_index(directory):
+  return read_json(os.path.join(store_path(directory), INDEX_FILE))
+
+def read_arrays(directory, prediction, index=None):
+  # same keys as a result pickle, only the slices of the prediction are read from the files
+  import numpy as np
+  if index is None:
+    index = read_index(directory)
+  entry = index['predictions'][prediction]
+  residues = entry['residues']
+  result = {
+    key: value for key, value in entry.items() if not key.endswith('_offset') and key not in ['residues', 'pae_residues']
+  }
+  plddt = np.memmap(os.path.join(store_path(directory), PLDDT_FILE), dtype='float32', mode='r')
+  result['plddt'] = np.array(plddt[entry['plddt_offset']:entry['plddt_offset'] + residues])
+  if 'pae_offset' in entry:
+    pae = np.memmap(os.path.join(store_path(directory), PAE_FILE), dtype=index['pae_format'], mode='r')
+    pae_residues = entry['pae_residues']
+    pae = pae[entry['pae_offset']:entry['pae_offset'] + pae_residues * pae_residues].reshape(pae_residues, pae_residues)
+    pae = pae.astype('float32')
+    if index['pae_format'] == 'uint8':
+      pae *= index['pae_precision']
+    result['predicted_aligned_error'] = pae
+  return result
@@ -3,12 +3,15 @@
 import argparse
 import math
 import json
-import numpy as np
-import pandas as pd
 from copy import deepcopy
+import glob
 import sys
 import os
 
+# batches per manifest file, each file is as wide as its longest batch (e.g. a long SMILES)
+MANIFEST_SHARD_SIZE = 10000
+MANIFEST_HEADER_SIZE = 64
+
 def parse_csv(value):
   if value is None:
     return None
@@ -16,7 +19,29 @@ def parse_csv(value):
     return []
   return [item.strip() for item in value.split(',') if item.strip()]
 
+def parse_batch_sizes(value):
+  # "multimer_v1:10,model_1_multimer_v3:20": batch size of a model, or of the models whose name ends with a suffix
+  batch_sizes = {}
+  for item in parse_csv(value) or []:
+    key, _, size = item.partition(':')
+    if not key.strip() or not size.strip().isdigit() or int(size) < 1:
+      raise ValueError(f"Batch size '{item}' should be <model or suffix>:<positive number of predictions>")
+    batch_sizes[key.strip()] = int(size)
+  return batch_sizes
+
+def model_batch_sizes(batch_size, batch_sizes, all_models):
+  # size of each model: its own, else the one of its longest matching suffix, else the default batch_size
+  sizes = {}
+  for model in all_models:
+    matching = [key for key in batch_sizes if model == key or model.endswith(f"_{key}")]
+    sizes[model] = batch_sizes[max(matching, key=len)] if matching else batch_size
+  return sizes
+
 def batches_per_model(preds_per_model, batch_size):
+  # with a map of the batch size of each model, the batches of each model
+  if isinstance(batch_size, dict):
+    return {model: batches_per_model(preds_per_model, size) for model, size in batch_size.items()}
+  import numpy as np
   batch_nb = math.ceil(preds_per_model/batch_size)
   batch_sizes = []
   for _ in range(1, batch_nb+1):
@@ -34,7 +59,28 @@ def batches_per_model(preds_per_model, batch_size):
   }
   return one_model_batches
 
+def split_batch(batches, batch_id, parts):
+  """Split batch_id in place into parts sub-batches, the first keeps batch_id and the others get new ids."""
+  batch = batches[batch_id]
+  start, end = int(batch['start']), int(batch['end'])
+  sub_size = math.ceil((end - start + 1) / max(1, min(parts, end - start + 1)))
+  value_type = type(batch['start'])
+  next_id = max(int(i) for i in batches) + 1
+
+  new_ids = []
+  for i, sub_start in enumerate(range(start, end + 1, sub_size)):
+    sub_batch = dict(batch, start=value_type(sub_start), end=value_type(min(sub_start + sub_size - 1, end)))
+    if i == 0:
+      batches[batch_id] = sub_batch
+    else:
+      batches[str(next_id)] = sub_batch
+      new_ids.append(str(next_id))
+      next_id += 1
+  return new_ids
+
 def batches_per_ligand(ligands, preds_per_model):
+  import numpy as np
+  import pandas as pd
   df = pd.read_csv(ligands)
   multiple_types = []
 
@@ -68,13 +114,58 @@ def batches_per_ligand(ligands, preds_per_model):
 
   return batches
 
+def pack_batches(preds_per_model, all_models, prediction_times, wall_time, add_excess=0.1):
+  # fill each task up to the wall time from the time of a prediction of each model (in seconds)
+  task_time = wall_time * 60 * 60
+  slowest = max(prediction_times.values())
+  cost = {model: prediction_times.get(model, slowest) * (1 + add_excess) for model in all_models}
+
+  full_tasks, leftovers = [], []
+  for model in all_models:
+    capacity = max(1, math.floor(task_time / cost[model]))
+    start = 0
+    while preds_per_model - start >= capacity:
+      full_tasks.append({'models': [model], 'start': start, 'end': start + capacity - 1})
+      start += capacity
+    if start < preds_per_model:
+      leftovers.append((model, start, preds_per_model - 1))
+
+  # first fit of the last predictions of each model: a task runs several models on the same prediction range,
+  # so the shortest ranges open the tasks and the longer ones fill them, keeping the rest of their predictions
+  # for another task; the slowest models go first for a same range
+  shared_tasks = []
+  while leftovers:
+    leftovers.sort(key=lambda item: (-item[1], -cost[item[0]]))
+    model, start, end = leftovers.pop(0)
+    for task in shared_tasks:
+      needed = (task['end'] - task['start'] + 1) * cost[model]
+      if task['end'] == end and task['start'] >= start and task['time'] + needed <= task_time:
+        task['models'].append(model)
+        task['time'] += needed
+        if task['start'] > start:
+          leftovers.append((model, start, task['start'] - 1))
+        break
+    else:
+      shared_tasks.append({'models': [model], 'start': start, 'end': end, 'time': (end - start + 1) * cost[model]})
+
+  return {
+    str(i): {
+      'start': str(task['start']),
+      'end': str(task['end']),
+      'model': ','.join(model for model in all_models if model in task['models'])
+    }
+    for i, task in enumerate(full_tasks + shared_tasks)
+  }
+
 def batches_all_models(batches_unit, all_models):
+  # batches_unit are the batches of a model, the same for all of them, or a map of the batches of each model
+  per_model = all(model in batches_unit for model in all_models)
   batches = {}
-  for i, model in enumerate(all_models):
-    unadded_batch = deepcopy(batches_unit)
-    for batch in unadded_batch:
+  for model in all_models:
+    unadded_batch = deepcopy(batches_unit[model] if per_model else batches_unit)
+    for batch in sorted(unadded_batch):
       unadded_batch[batch].update({'model': model})
-      batches[str(batch+i*len(batches_unit)-1)] = unadded_batch[batch]
+      batches[str(len(batches))] = unadded_batch[batch]
 
   return batches
 
@@ -92,6 +183,61 @@ def detect_model_preset(fasta_file):
       break
   return model_preset
 
+def manifest_path(batches_file, shard):
+  return f"{os.path.splitext(batches_file)[0]}.{shard}.idx"
+
+def manifest_files(batches_file):
+  return sorted(glob.glob(glob.escape(os.path.splitext(batches_file)[0]) + ".*.idx"))
+
+def write_manifest(batches, batches_file):
+  # fixed width records next to the batches file: a task seeks to its own batch instead of parsing all of them
+  for path in manifest_files(batches_file):
+    os.remove(path)
+  if not batches or not all(batch_id.isdigit() for batch_id in batches):
+    return []
+  batch_number = max(int(batch_id) for batch_id in batches) + 1
+  paths = []
+  for first in range(0, batch_number, MANIFEST_SHARD_SIZE):
+    records = [
+      json.dumps(batches.get(str(batch_id)), separators=(",", ":"))
+      for batch_id in range(first, min(first + MANIFEST_SHARD_SIZE, batch_number))
+    ]
+    width = max(len(record) for record in records) + 1
+    path = manifest_path(batches_file, first // MANIFEST_SHARD_SIZE)
+    with open(path, "w", encoding="ascii") as handle:
+      handle.write(f"massivefold_batches {width} {first} {len(records)}".ljust(MANIFEST_HEADER_SIZE - 1) + "\n")
+      handle.writelines(record.ljust(width - 1) + "\n" for record in records)
+    paths.append(path)
+  return paths
+
+def read_manifest_batch(batches_file, batch_id):
+  # None when there is no up to date manifest for this batches file, KeyError when the batch does not exist
+  if not str(batch_id).isdigit():
+    return None
+  batch_number = int(batch_id)
+  path = manifest_path(batches_file, batch_number // MANIFEST_SHARD_SIZE)
+  try:
+    if os.path.getmtime(path) < os.path.getmtime(batches_file):
+      return None
+  except OSError:
+    return None
+  with open(path, "rb") as handle:
+    _, width, first, count = handle.read(MANIFEST_HEADER_SIZE).split()
+    width, first, count = int(width), int(first), int(count)
+    if not first <= batch_number < first + count:
+      raise KeyError(batch_id)
+    handle.seek(MANIFEST_HEADER_SIZE + (batch_number - first) * width)
+    batch = json.loads(handle.read(width))
+  if batch is None:
+    raise KeyError(batch_id)
+  return batch
+
+def write_batches(batches, batches_file):
+  with open(batches_file, "w", encoding="utf-8") as json_output:
+    json.dump(batches, json_output, indent=4)
+  write_manifest(batches, batches_file)
+  return batches_file
+
 def main(
   predictions_per_model,
   batch_size,
@@ -156,6 +302,10 @@ def main(
   print(f"Running {predictions_per_model} predictions on each of the {len(model_names)} models")
   print(f"Total prediction number: {predictions_per_model * len(model_names)}")
 
+  batch_sizes = parse_batch_sizes(all_params['massivefold'].get('batch_sizes', ''))
+  if batch_sizes:
+    batch_size = model_batch_sizes(batch_size, batch_sizes, model_names)
+
   if not to_screen:
     # Divide the predictions in batches 
     per_model_batches = batches_per_model(preds_per_model=predictions_per_model, batch_size=batch_size)
@@ -164,8 +314,7 @@ def main(
   else:
     all_model_batches = batches_per_ligand(to_screen, predictions_per_model)
 
-  with open(f"{sequence_name}_{run_name}_batches.json", "w") as json_output:
-    json.dump(all_model_batches, json_output, indent=4)
+  write_batches(all_model_batches, f"{sequence_name}_{run_name}_batches.json")
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
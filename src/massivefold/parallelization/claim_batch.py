@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+import time
+
+from massivefold.parallelization import early_stop
+from massivefold.utils import queue_lock
+from massivefold.utils import read_json
+from massivefold.utils import write_json
+
+# a task stops claiming batches that would end in the last part of its wall time
+WALL_TIME_MARGIN = 0.05
+
+parser = argparse.ArgumentParser(
+  description="Claim the batches of a prediction queue (massivefold run --dynamic_tasks) from the job array tasks.")
+parser.add_argument('--queue', required=True, help='Prediction queue file of the run, in its logs directory.')
+parser.add_argument('--task', default=None, help='Claim the next batch for this task id and print its batch id.')
+parser.add_argument('--done', default=None, help='Batch id whose run is finished.')
+parser.add_argument('--exit_code', type=int, default=0, help='Exit code of the run of the --done batch.')
+parser.add_argument('--early_stop', default=None, help='Stop condition file of the run, no batch is claimed once reached.')
+
+def queue_path(logs_run_dir, sequence_name, run_name):
+  return os.path.join(logs_run_dir, f"{sequence_name}_{run_name}_queue.json")
+
+def batch_entry(batch):
+  models = batch['model'].split(',') if 'model' in batch else []
+  return {
+    'state': 'PENDING',
+    'model': batch.get('model', ''),
+    'predictions': (int(batch['end']) - int(batch['start']) + 1) * max(1, len(models)),
+  }
+
+def create_queue(batches, queue_file, wall_time, task_number):
+  queue = {
+    'wall_time': wall_time,
+    'task_number': task_number,
+    # number of tasks of the job array running the queue
+    'array_size': min(task_number, len(batches)),
+    'tasks': {},
+    'batches': {batch_id: batch_entry(batch) for batch_id, batch in batches.items()},
+  }
+  with queue_lock(os.path.dirname(queue_file)):
+    write_json(queue_file, queue)
+  return queue_file
+
+def requeue(queue_file, batch_ids, batches):
+  # new attempt of some batches (massivefold retry): the tasks of the new job array start a new wall time
+  with queue_lock(os.path.dirname(queue_file)):
+    queue = read_json(queue_file)
+    for batch_id in batch_ids:
+      queue['batches'][batch_id] = batch_entry(batches[batch_id])
+    queue['tasks'] = {}
+    queue['array_size'] = min(queue['task_number'], len(batch_ids))
+    write_json(queue_file, queue)
+  return queue['task_number']
+
+def times_per_prediction(queue):
+  # time per prediction of the finished batches, per model and for all of them (None)
+  durations, predictions = {None: 0}, {None: 0}
+  for entry in queue['batches'].values():
+    if entry['state'] != 'COMPLETED':
+      continue
+    for key in [entry['model'], None]:
+      durations[key] = durations.get(key, 0) + entry['duration']
+      predictions[key] = predictions.get(key, 0) + entry['predictions']
+  return {key: durations[key] / predictions[key] for key in durations if predictions[key]}
+
+def estimated_duration(times, batch):
+  # time per prediction of the same models when some of their batches are finished
+  time_per_prediction = times.get(batch['model'], times.get(None, 0))
+  return time_per_prediction * batch['predictions']
+
+def claim(queue_file, task_id):
+  """Return the claimed batch id, or None and the batches left that do not fit in the wall time of any task."""
+  with queue_lock(os.path.dirname(queue_file)):
+    queue = read_json(queue_file)
+    now = time.time()
+    # no task will have more time than a task that starts, it takes the next batch whatever its estimate
+    starting = str(task_id) not in queue['tasks']
+    task = queue['tasks'].setdefault(str(task_id), {'start': now})
+    deadline = None
+    if queue['wall_time'] and not starting:
+      deadline = task['start'] + queue['wall_time'] * 60 * 60 * (1 - WALL_TIME_MARGIN)
+    times = times_per_prediction(queue) if deadline is not None else {}
+    claimed, skipped = None, []
+    for batch_id in sorted(queue['batches'], key=int):
+      batch = queue['batches'][batch_id]
+      if batch['state'] != 'PENDING':
+        continue
+      if deadline is not None and now + estimated_duration(times, batch) > deadline:
+        skipped.append(batch_id)
+        continue
+      batch.update({'state': 'RUNNING', 'task': str(task_id), 'start': now})
+      claimed = batch_id
+      break
+    abandoned = []
+    all_started = len(queue['tasks']) >= queue.get('array_size', queue['task_number'])
+    running = any(batch['state'] == 'RUNNING' for batch in queue['batches'].values())
+    if claimed is None and skipped and all_started and not running:
+      # the last task to run can not fit them either, they are failed for massivefold retry instead of left pending
+      for batch_id in skipped:
+        queue['batches'][batch_id].update({'state': 'FAILED', 'reason': 'longer than the remaining wall time'})
+      abandoned = skipped
+    write_json(queue_file, queue)
+  return claimed, abandoned
+
+def finish(queue_file, batch_id, exit_code):
+  with queue_lock(os.path.dirname(queue_file)):
+    queue = read_json(queue_file)
+    batch = queue['batches'][batch_id]
+    batch.update({
+      'state': 'COMPLETED' if exit_code == 0 else 'FAILED',
+      'exit_code': exit_code,
+      'duration': time.time() - batch['start'],
+    })
+    write_json(queue_file, queue)
+  return queue
+
+def main():
+  args = parser.parse_args()
+  if args.done is not None:
+    queue = finish(args.queue, args.done, args.exit_code)
+    pending = sum(1 for batch in queue['batches'].values() if batch['state'] == 'PENDING')
+    print(f"Batch {args.done} finished with exit code {args.exit_code}, {pending} batches left in the queue", file=sys.stderr)
+    return 0
+  if args.task is None:
+    parser.error("either --task or --done is required")
+  if args.early_stop and early_stop.stop_reached(args.early_stop):
+    print(f"Stop condition of the run reached, no batch for task {args.task}", file=sys.stderr)
+    return 1
+  batch_id, abandoned = claim(args.queue, args.task)
+  if abandoned:
+    print(f"Batches {', '.join(abandoned)} are estimated longer than the remaining wall time of the tasks, they are"
+          f" not run, resubmit them with massivefold retry", file=sys.stderr)
+    return 2
+  if batch_id is None:
+    print(f"No batch left for task {args.task} in {args.queue}", file=sys.stderr)
+    return 1
+  print(batch_id)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -139,6 +139,7 @@ def main(
 
   all_params[f"{tool_code}_run"] = preset_dict | all_params[f"{tool_code}_run"]
   run_params.update(all_params['massivefold'])
+  run_params.setdefault('link_mode', 'copy')
   run_params.update(all_params['custom_params'])
   run_params.update(all_params[f'{tool_code}_run'])
   run_params.update(all_params['plots'])
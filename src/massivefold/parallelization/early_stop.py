@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+
+from massivefold.utils import queue_lock
+from massivefold.utils import read_json
+from massivefold.utils import write_json
+
+parser = argparse.ArgumentParser(
+  description="Stop condition of a run (massivefold run --stop_score/--stop_patience), evaluated by the job array tasks.")
+parser.add_argument('--condition', required=True, help='Stop condition file of the run, in its logs directory.')
+parser.add_argument(
+  '--check',
+  action='store_true',
+  help='Exit with 1 if the stop condition is reached, the remaining batches of the run are then skipped.')
+parser.add_argument('--batch_id', default=None, help='Batch whose scores are added to the stop condition.')
+parser.add_argument('--batch_dir', default=None, help='Output directory of the --batch_id batch.')
+
+def condition_path(logs_run_dir, sequence_name, run_name):
+  return os.path.join(logs_run_dir, f"{sequence_name}_{run_name}_early_stop.json")
+
+def create_condition(condition_file, min_score=None, min_count=1, patience=None):
+  condition = {
+    'min_score': min_score,
+    'min_count': min_count,
+    'patience': patience,
+    'batches': {},
+    'best': None,
+    'batches_without_improvement': 0,
+    'stopped': False,
+    'reason': '',
+  }
+  with queue_lock(os.path.dirname(condition_file)):
+    write_json(condition_file, condition)
+  return condition_file
+
+def afmassive_scores(batch_dir):
+  # ranking_debug.json of AFmassive: {"iptm+ptm": {prediction: score}, "order": [...]}, plddts for monomers
+  for ranking_file in glob.glob(os.path.join(batch_dir, '*', 'ranking_debug.json')):
+    ranking = json.load(open(ranking_file, 'r'))
+    score_key = next(key for key in ranking if key != 'order')
+    return list(ranking[score_key].values())
+  return None
+
+def colabfold_scores(batch_dir):
+  # same score as the ranking made by unifier: 0.8*iptm + 0.2*ptm for multimers, mean plddt for monomers
+  scores = []
+  # the files are moved in the sequence directory of the batch when it was converted with --link_mode move
+  scores_files = glob.glob(os.path.join(batch_dir, '*_scores_rank_*.json'))
+  for scores_file in scores_files or glob.glob(os.path.join(batch_dir, '*', '*_scores_rank_*.json')):
+    content = json.load(open(scores_file, 'r'))
+    if 'iptm' in content:
+      scores.append(0.8 * content['iptm'] + 0.2 * content['ptm'])
+    elif content.get('plddt'):
+      scores.append(sum(content['plddt']) / len(content['plddt']))
+  return scores or None
+
+def alphafold3_scores(batch_dir):
+  for ranking_file in glob.glob(os.path.join(batch_dir, '*_ranking_scores.csv')):
+    with open(ranking_file, 'r', newline='') as handle:
+      return [float(row['ranking_score']) for row in csv.DictReader(handle)]
+  return None
+
+def batch_scores(batch_dir):
+  # scores of the predictions of a finished batch, None if the batch did not write its ranking
+  for scores in (afmassive_scores, colabfold_scores, alphafold3_scores):
+    found = scores(batch_dir)
+    if found is not None:
+      return found
+  return None
+
+def evaluate(condition):
+  above = sum(batch['above'] for batch in condition['batches'].values())
+  if condition['min_score'] is not None and above >= condition['min_count']:
+    return f"{above} predictions scored at least {condition['min_score']}"
+  if condition['patience'] and condition['batches_without_improvement'] >= condition['patience']:
+    return f"best score {condition['best']} not improved over {condition['batches_without_improvement']} batches"
+  return ''
+
+def record_batch(condition_file, batch_id, scores):
+  with queue_lock(os.path.dirname(condition_file)):
+    condition = read_json(condition_file)
+    best = max(scores)
+    # batches are counted in the order they finish, a batch run again only updates its scores
+    if str(batch_id) not in condition['batches']:
+      if condition['best'] is None or best > condition['best']:
+        condition['batches_without_improvement'] = 0
+      else:
+        condition['batches_without_improvement'] += 1
+    if condition['best'] is None or best > condition['best']:
+      condition['best'] = best
+    min_score = condition['min_score']
+    condition['batches'][str(batch_id)] = {
+      'best': best,
+      'predictions': len(scores),
+      'above': 0 if min_score is None else sum(1 for score in scores if score >= min_score),
+    }
+    if not condition['stopped']:
+      condition['reason'] = evaluate(condition)
+      condition['stopped'] = bool(condition['reason'])
+    write_json(condition_file, condition)
+  return condition
+
+def stop_reached(condition_file):
+  if not os.path.isfile(condition_file):
+    return False
+  return read_json(condition_file)['stopped']
+
+def main():
+  args = parser.parse_args()
+  if args.batch_id is not None:
+    if args.batch_dir is None:
+      parser.error("--batch_id requires --batch_dir")
+    scores = batch_scores(args.batch_dir)
+    if not scores:
+      print(f"No ranking found in {args.batch_dir}, batch {args.batch_id} is not added to the stop condition",
+            file=sys.stderr)
+      return 0
+    condition = record_batch(args.condition, args.batch_id, scores)
+    print(f"Batch {args.batch_id}: best score {max(scores)}, best of the run {condition['best']}", file=sys.stderr)
+    if condition['stopped']:
+      print(f"Stop condition reached: {condition['reason']}, the remaining batches are skipped", file=sys.stderr)
+    return 0
+  if args.check:
+    if stop_reached(args.condition):
+      print(f"Stop condition reached: {read_json(args.condition)['reason']}", file=sys.stderr)
+      return 1
+    return 0
+  parser.error("either --check or --batch_id is required")
+
+if __name__ == "__main__":
+  sys.exit(main())
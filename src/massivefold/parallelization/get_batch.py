@@ -2,6 +2,10 @@
 
 import argparse
 import json
+import re
+import shlex
+
+from massivefold.parallelization.batching import read_manifest_batch
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--batch_id', default='', required=True, help='Task id or batch number from which the element are retrieved.')
@@ -9,25 +13,41 @@ parser.add_argument(
   '--element',
   default='all',
   choices=['all', 'start', 'end', 'model'],
-  required=True,
   help='Select the element (start, end or model) that is retrieved by the script.')
 parser.add_argument('--json_path', default='./batches.json', required=True, help='Path of the json from which the element are retrieved.')
+parser.add_argument(
+  '--shell',
+  action='store_true',
+  help='Print all the elements of the batch as batch_<element>=<value> lines, to be evaluated by the shell.')
 
-def get_single_element(batch_id, element, json_path):
-  with open(json_path, 'r') as f:
-    all_batches = json.load(f)
+def load_batch(batch_id, json_path):
+  # the indexed manifest written next to the json file avoids parsing all the batches for a single one
+  try:
+    batch = read_manifest_batch(json_path, batch_id)
+    if batch is None:
+      with open(json_path, 'r') as f:
+        batch = json.load(f)[batch_id]
+  except KeyError:
+    raise ValueError(f"No batch {batch_id} in {json_path}.")
+  return batch
 
+def get_single_element(batch, batch_id, element):
   try:
-    print(all_batches[batch_id][element])
+    print(batch[element])
   except KeyError:
     raise ValueError(f"Either no batch {batch_id} or no element '{element}' for this batch.")
 
-def get_all_elements(all_batches, batch_id, element):
+def get_all_elements(batch, batch_id):
   for element in ['start', 'end', 'model']:
-    try:
-      print(all_batches[batch_id][element])
-    except KeyError:
-      raise ValueError(f"Either no batch {batch_id} or no element '{element}' for this batch.")
+    get_single_element(batch, batch_id, element)
+
+def get_shell_elements(batch):
+  for element, value in batch.items():
+    if not re.fullmatch(r'\w+', element):
+      continue
+    if not isinstance(value, str):
+      value = json.dumps(value)
+    print(f"batch_{element}={shlex.quote(value)}")
 
 def main():
   args = parser.parse_args()
@@ -39,13 +59,13 @@ def main():
   if element not in ['start', 'end', 'model', 'all']:
     raise ValueError('--element is either start, end or model.')
 
-  with open(json_path, 'r') as f:
-    all_batches = json.load(f)
-
-  if element != 'all':
-    get_single_element(batch_id, element, json_path)
+  batch = load_batch(batch_id, json_path)
+  if args.shell:
+    get_shell_elements(batch)
+  elif element != 'all':
+    get_single_element(batch, batch_id, element)
   else:
-    get_all_elements(all_batches, batch_id, element)
+    get_all_elements(batch, batch_id)
 
 if __name__ == "__main__":
   main()
@@ -6,98 +6,173 @@ import os
 import sys
 import shutil
 import argparse
-import numpy as np
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from massivefold.parallelization.array_store import PAE_FORMATS
+from massivefold.parallelization.array_store import add_prediction
+from massivefold.parallelization.array_store import close_store
+from massivefold.parallelization.array_store import create_store
+from massivefold.parallelization.array_store import prediction_arrays
+from massivefold.parallelization.array_store import store_path
+from massivefold.parallelization.organize_outputs import post_treatment_threads
+from massivefold.parallelization.prediction_scores import pickle_stat
+from massivefold.parallelization.prediction_scores import record_scores
+from massivefold.parallelization.prediction_scores import scalar_scores
+
+# a file being rewritten takes about its size in memory, and as much for its new content
+MEMORY_FACTOR = 2
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+
+def default_max_memory():
+  # half of the memory of the node, in GB
+  try:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2 / 1024 ** 3
+  except (ValueError, OSError):
+    return None
 
 parser = argparse.ArgumentParser()
 parser.add_argument('path_to_output')
 parser.add_argument('--pickle_size', 
                     default="full",
-                    choices=["full", "light", "custom", "delete"],
-                    help='How to treat the stored pickles in the output.',
+                    choices=["full", "light", "custom", "delete", "arrays"],
+                    help="How to treat the stored pickles in the output. 'arrays' stores the pLDDT and PAE of all the "
+                    "predictions in a few memory mapped files of the arrays directory instead of the pickles.",
                     required=True)
 parser.add_argument('--parameters', help="Json file containing the parameters for custom pickle size (--pickle_size=custom).")
 parser.add_argument('--keep_full_pickles',  action="store_true")
+parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                    help='Number of pickles or AlphaFold3 batch files rewritten at the same time (default: %(default)s).')
+parser.add_argument('--max_memory', type=float, default=default_max_memory(),
+                    help='Memory in GB that the files rewritten at the same time can use, estimated from their size '
+                    '(default: half of the memory of the node).')
+parser.add_argument('--pae_format', default='float16', choices=PAE_FORMATS,
+                    help="With --pickle_size arrays, type of the stored PAE values (default: %(default)s).")
+parser.add_argument('--pae_precision', type=float, default=0.25,
+                    help="With --pae_format uint8, step in Å of the stored PAE values, up to 255 steps (default: %(default)s).")
+
+def print_progress(done, total):
+  # hand-made progress bar
+  bar_length = 50
+  progress = done / total
+  filled = int(progress * bar_length)
+  bar = "█" * filled + "-" * (bar_length - filled)
+  percent = int(progress * 100)
+  print(f"\r|{bar}| {percent:3d}% ({done}/{total})", end="", flush=True)
+
+def run_bounded(function, tasks, workers=1, max_memory=None, on_result=None):
+  # tasks are (file size, arguments), a file is only read once the memory of the ones being rewritten allows it
+  # on_result handles each result as it comes, instead of keeping them all
+  total = len(tasks)
+  results = []
+  if workers <= 1 or total <= 1:
+    for size, arguments in tasks:
+      result = function(*arguments)
+      results.append(on_result(result) if on_result else result)
+      print_progress(len(results), total)
+    print()
+    return results
+
+  memory_limit = max_memory * 1024 ** 3 if max_memory else None
+  pending = list(reversed(tasks))
+  running = {}
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    while pending or running:
+      while pending and len(running) < workers and (
+        not running or memory_limit is None
+        or sum(running.values()) + pending[-1][0] * MEMORY_FACTOR <= memory_limit
+      ):
+        size, arguments = pending.pop()
+        running[executor.submit(function, *arguments)] = size * MEMORY_FACTOR
+      done, _ = wait(running, return_when=FIRST_COMPLETED)
+      for future in done:
+        del running[future]
+        results.append(on_result(future.result()) if on_result else future.result())
+        print_progress(len(results), total)
+  print()
+  return results
 
-def extract_af3_batch_input_msas(directory: str, json_files: list):
-
-  entity_count = {}
+def write_msas_templates(directory: str, data: dict):
+  # extract msas/templates from first json batch and write it to .a3m/mmcif files
+  entity_count = { list(data["sequences"][nseq].keys())[0]: 0 for nseq in range(len(data["sequences"])) }
   msas_templates_paths = {}
+  for seq_ind, seq in enumerate(data["sequences"]):
+    entity = list(seq.keys())[0]
+    entity_count[entity] += 1
+    msas_templates_paths[f"{entity}_{entity_count[entity]}"] = { }
+    msas_templates_paths[f"{entity}_{entity_count[entity]}"]["templates"] = {}
+
+    # first the msas
+    for msas in ["unpairedMsa", "pairedMsa"]:
+      # skip chains with no alignments (ligands)
+      if not msas in data["sequences"][seq_ind][entity] or not data["sequences"][seq_ind][entity][msas]:
+        continue
+      fileout = os.path.abspath(os.path.join(directory, f"{entity}_{entity_count[entity]}_{msas}.a3m"))
+      msas_templates_paths[f"{entity}_{entity_count[entity]}"][msas] = fileout
+      with open(fileout, 'w') as msas_file:
+        msas_file.write(data["sequences"][seq_ind][entity][msas])
+    # then the templates
+    if not "templates" in data["sequences"][seq_ind][entity] or not data["sequences"][seq_ind][entity]["templates"]:
+      continue
+    templates = data["sequences"][seq_ind][entity]["templates"]
+    msas_templates_paths[f"{entity}_{entity_count[entity]}"]["templates"] = {}
+    for n, template in enumerate(templates):
+      if not template["mmcif"]:
+        continue
+      fileout = os.path.abspath(os.path.join(directory, f"{entity}_{entity_count[entity]}_template_{n}.mmcif"))
+      msas_templates_paths[f"{entity}_{entity_count[entity]}"]["templates"][n] = fileout
+      with open(fileout, 'w') as template_file:
+        template_file.write(data["sequences"][seq_ind][entity]["templates"][n]["mmcif"])
+  return msas_templates_paths
+
+def reference_msas_templates(filename: str, msas_templates_paths: dict):
+  with open(filename, 'r') as batch_file:
+    data = json.load(batch_file)
+
+  # reference the .a3m/mmcif paths in the right entities fields
+  entity_count = { list(data["sequences"][nseq].keys())[0]: 0 for nseq in range(len(data["sequences"])) }
+  for seq_ind, seq in enumerate(data["sequences"]):
+    entity = list(seq.keys())[0]
+    entity_count[entity] += 1
+    # first the msas
+    for msas in ["unpairedMsa", "pairedMsa"]:
+      if not msas in data["sequences"][seq_ind][entity] or not data["sequences"][seq_ind][entity][msas]:
+        continue
+      data["sequences"][seq_ind][entity][msas] = ""
+      path_of_msas = os.path.abspath(msas_templates_paths[f"{entity}_{entity_count[entity]}"][msas])
+      data["sequences"][seq_ind][entity][f"{msas}Path"] = path_of_msas
+
+    # then the templates
+    if not "templates" in data["sequences"][seq_ind][entity] or not data["sequences"][seq_ind][entity]["templates"]:
+      continue
+    templates = data["sequences"][seq_ind][entity]["templates"]
+    for n, template in enumerate(templates):
+      # ignore if templates are already indexed
+      if "mmcifPath" in templates[n] and templates[n]["mmcifPath"] and not templates[n]["mmcif"]:
+        continue
+      data["sequences"][seq_ind][entity]["templates"][n]["mmcif"] = ""
+      path_of_mmcif = os.path.abspath(msas_templates_paths[f"{entity}_{entity_count[entity]}"]["templates"][n])
+      data["sequences"][seq_ind][entity]["templates"][n]["mmcifPath"] = path_of_mmcif
+
+  # without their msas and templates, the batch files are small enough to be written without indentation
+  with open(filename, 'w') as batch_file:
+    json.dump(data, batch_file)
+  return filename
+
+def extract_af3_batch_input_msas(directory: str, json_files: list, workers=1, max_memory=None):
   total = len(json_files)
   print(f"Now processing {total} af3 batch files in {directory}")
-  for file_ind, file in enumerate(json_files):
-
-    filename = os.path.join(directory, file)
-    data = json.load(open(filename, 'r'))
-    with open(filename, 'r') as batch_file:
-      data = json.load(batch_file)
-
-    # extract msas/templates from first json batch and write it to .a3m/mmcif files
-    if file_ind == 0:
-      entity_count.update({ list(data["sequences"][nseq].keys())[0]: 0 for nseq in range(len(data["sequences"])) })
-      for seq_ind, seq in enumerate(data["sequences"]):
-        entity = list(seq.keys())[0]
-        entity_count[entity] += 1
-        msas_templates_paths[f"{entity}_{entity_count[entity]}"] = { }
-        msas_templates_paths[f"{entity}_{entity_count[entity]}"]["templates"] = {}
-
-        # first the msas
-        for msas in ["unpairedMsa", "pairedMsa"]:
-          # skip chains with no alignments (ligands)
-          if not msas in data["sequences"][seq_ind][entity] or not data["sequences"][seq_ind][entity][msas]:
-            continue
-          fileout = os.path.abspath(os.path.join(directory, f"{entity}_{entity_count[entity]}_{msas}.a3m"))
-          msas_templates_paths[f"{entity}_{entity_count[entity]}"][msas] = fileout
-          with open(fileout, 'w') as msas_file:
-            msas_file.write(data["sequences"][seq_ind][entity][msas])
-        # then the templates
-        if not "templates" in data["sequences"][seq_ind][entity] or not data["sequences"][seq_ind][entity]["templates"]:
-          continue
-        templates = data["sequences"][seq_ind][entity]["templates"]
-        msas_templates_paths[f"{entity}_{entity_count[entity]}"]["templates"] = {}
-        for n, template in enumerate(templates):
-          if not template["mmcif"]:
-            continue
-          fileout = os.path.abspath(os.path.join(directory, f"{entity}_{entity_count[entity]}_template_{n}.mmcif"))
-          msas_templates_paths[f"{entity}_{entity_count[entity]}"]["templates"][n] = fileout
-          with open(fileout, 'w') as template_file:
-            template_file.write(data["sequences"][seq_ind][entity]["templates"][n]["mmcif"])
-
-    # reference the .a3m/mmcif paths in the right entities fields
-    entity_count = { list(data["sequences"][nseq].keys())[0]: 0 for nseq in range(len(data["sequences"])) }
-    for seq_ind, seq in enumerate(data["sequences"]):
-      entity = list(seq.keys())[0]
-      entity_count[entity] += 1
-      # first the msas
-      for msas in ["unpairedMsa", "pairedMsa"]:
-        if not msas in data["sequences"][seq_ind][entity] or not data["sequences"][seq_ind][entity][msas]:
-          continue
-        data["sequences"][seq_ind][entity][msas] = ""
-        path_of_msas = os.path.abspath(msas_templates_paths[f"{entity}_{entity_count[entity]}"][msas])
-        data["sequences"][seq_ind][entity][f"{msas}Path"] = path_of_msas
-
-      # then the templates
-      if not "templates" in data["sequences"][seq_ind][entity] or not data["sequences"][seq_ind][entity]["templates"]:
-        continue
-      templates = data["sequences"][seq_ind][entity]["templates"]
-      for n, template in enumerate(templates):
-        # ignore if templates are already indexed
-        if "mmcifPath" in templates[n] and templates[n]["mmcifPath"] and not templates[n]["mmcif"]:
-          continue
-        data["sequences"][seq_ind][entity]["templates"][n]["mmcif"] = ""
-        path_of_mmcif = os.path.abspath(msas_templates_paths[f"{entity}_{entity_count[entity]}"]["templates"][n])
-        data["sequences"][seq_ind][entity]["templates"][n]["mmcifPath"] = path_of_mmcif
-
-    json.dump(data, open(filename, 'w'), indent=4)
-
-    bar_length = 50
-    progress = (file_ind + 1) / total
-    filled = int(progress * bar_length)
-    bar = "█" * filled + "-" * (bar_length - filled)
-    percent = int(progress * 100)
-    print(f"\r|{bar}| {percent:3d}% ({file_ind+1}/{total})", end="", flush=True)
-  print()
+  # all the batches share the msas and templates of the first one
+  with open(os.path.join(directory, json_files[0]), 'r') as batch_file:
+    msas_templates_paths = write_msas_templates(directory, json.load(batch_file))
+
+  tasks = [
+    (os.path.getsize(os.path.join(directory, file)), (os.path.join(directory, file), msas_templates_paths))
+    for file in json_files
+  ]
+  run_bounded(reference_msas_templates, tasks, workers, max_memory)
 
 def format_entry(key: str, value, formats):
+  import numpy as np
   possible_formats = [ "npfloat32", "lst" ]
   formattable_entries = [ "predicted_aligned_error", "plddt" ]
   # no format specified for the key
@@ -134,21 +209,41 @@ def lighten_single_pkl(pkl, directory, parameters):
     pickle.dump(content, pickle_output)
   return content
 
+def lighten_pickle(pkl, directory, parameters, json_dir=None):
+  import numpy as np
+  pkl_content = lighten_single_pkl(pkl, directory, parameters)
+  if json_dir:
+    jsonified = {}
+    for key in pkl_content:
+      if isinstance(pkl_content[key], np.ndarray):
+        jsonified[key] = pkl_content[key].tolist()
+      else:
+        jsonified[key] = pkl_content[key]
+    json.dump(jsonified, open(f"{json_dir}/{pkl.replace('.pkl', '.json')}", 'w'), indent=4)
+
+  # only the scores of the light pickle are sent back from the worker process
+  scores = scalar_scores(pkl_content)
+  scores['pickle'] = pickle_stat(f"{directory}/light_pkl/{pkl}")
+  return pkl, scores
+
+def delete_pickle(path):
+  # with link_mode symlink, the pickle is a link to the one of its batch directory, which holds the data
+  target = os.path.realpath(path) if os.path.islink(path) else None
+  os.remove(path)
+  if target and target.endswith('.pkl') and os.path.isfile(target):
+    os.remove(target)
+
 def delete_pickles(pkl_files, directory):
   total = len(pkl_files)
   print(f"Now deleting {total} pickles in {directory}")
-  for i, pkl in enumerate(pkl_files):
-    os.remove(os.path.join(directory, pkl))
-    # hand-made progress bar
-    bar_length = 50
-    progress = (i + 1) / total
-    filled = int(progress * bar_length)
-    bar = "█" * filled + "-" * (bar_length - filled)
-    percent = int(progress * 100)
-    print(f"\r|{bar}| {percent:3d}% ({i+1}/{total})", end="", flush=True)
+  if not total:
+    return
+  with ThreadPoolExecutor(max_workers=post_treatment_threads()) as executor:
+    for i, _ in enumerate(executor.map(delete_pickle, [ os.path.join(directory, pkl) for pkl in pkl_files ])):
+      print_progress(i + 1, total)
   print()
 
-def lighten_all_pkl(directory, parameters, to_json: bool):
+def lighten_all_pkl(directory, parameters, to_json: bool, workers=1, max_memory=None):
   directory_content = os.listdir(directory)
 
   # delete screening pkls, need a refactor (should be called on each ligand directory instead)
@@ -180,37 +275,55 @@ def lighten_all_pkl(directory, parameters, to_json: bool):
     shutil.rmtree(f'{directory}/light_pkl')
   os.mkdir(f'{directory}/light_pkl')
 
+  json_dir = None
   if to_json:
     json_dir = f'{directory}/json_output'
     if os.path.isdir(json_dir):
       shutil.rmtree(json_dir)
     os.mkdir(json_dir)
-  total = len(pkl_files)
-  for i, pkl in enumerate(pkl_files):
-    pkl_content = lighten_single_pkl(pkl, directory, parameters)
-    jsonified = {}
-    for key in pkl_content:
-      if isinstance(pkl_content[key], np.ndarray):
-        jsonified[key] = pkl_content[key].tolist()
-      else:
-        jsonified[key] = pkl_content[key]
-
-    if to_json:
-      json.dump(jsonified, open(f"{json_dir}/{pkl.replace('.pkl', '.json')}", 'w'), indent=4)
-
-
-    # hand-made progress bar
-    bar_length = 50
-    progress = (i + 1) / total
-    filled = int(progress * bar_length)
-    bar = "█" * filled + "-" * (bar_length - filled)
-    percent = int(progress * 100)
-    print(f"\r|{bar}| {percent:3d}% ({i+1}/{total})", end="", flush=True)
-  print()
+  tasks = [
+    (os.path.getsize(os.path.join(directory, pkl)), (pkl, directory, parameters, json_dir)) for pkl in pkl_files
+  ]
+  light_scores = run_bounded(lighten_pickle, tasks, workers, max_memory)
+  # the scores of the light pickles are read without loading them
+  record_scores(f'{directory}/light_pkl', dict(light_scores))
 
   return pkl_files
 
+def pickle_arrays(pkl, directory, pae_format, precision):
+  with open(f"{directory}/{pkl}", 'rb') as pickle_input:
+    result = pickle.load(pickle_input)
+  scores = scalar_scores(result)
+  if 'max_predicted_aligned_error' in result:
+    scores['max_predicted_aligned_error'] = float(result['max_predicted_aligned_error'])
+  return pkl, prediction_arrays(result, pae_format, precision), scores
+
+def store_all_arrays(directory, pae_format, precision, workers=1, max_memory=None):
+  # the full pickles, or the light ones when they were already lightened
+  pkl_dir = directory
+  pkl_files = [ file for file in os.listdir(pkl_dir) if (file.startswith('result') and file.endswith('.pkl')) ]
+  if not pkl_files and os.path.isdir(f'{directory}/light_pkl'):
+    pkl_dir = f'{directory}/light_pkl'
+    pkl_files = [ file for file in os.listdir(pkl_dir) if (file.startswith('result') and file.endswith('.pkl')) ]
+  if not pkl_files:
+    print(f"No pickle files detected in {directory}")
+    return None, None
+
+  print(f"Storing the pLDDT and PAE of {len(pkl_files)} pickles of {pkl_dir} in {store_path(directory)}")
+  store = create_store(directory, pae_format, precision)
+  def add_pickle(result):
+    pkl, arrays, scores = result
+    add_prediction(store, pkl[len('result_'):-len('.pkl')], arrays, scores)
+    return pkl
+  tasks = [
+    (os.path.getsize(os.path.join(pkl_dir, pkl)), (pkl, pkl_dir, pae_format, precision)) for pkl in pkl_files
+  ]
+  run_bounded(pickle_arrays, tasks, workers, max_memory, add_pickle)
+  close_store(store)
+  return pkl_files, pkl_dir
+
 def pickles_to_json(directory):
+  import numpy as np
   json_dir = f'{directory}/json_output'
   if os.path.isdir(json_dir):
     shutil.rmtree(json_dir)
@@ -231,15 +344,12 @@ def pickles_to_json(directory):
         print(jsonified[key])
 
     json.dump(jsonified, open(f"{json_dir}/{pkl.replace('.pkl', '.json')}", 'w'), indent=4)
-    bar_length = 50
-    progress = (i + 1) / total
-    filled = int(progress * bar_length)
-    bar = "█" * filled + "-" * (bar_length - filled)
-    percent = int(progress * 100)
-    print(f"\r|{bar}| {percent:3d}% ({i+1}/{total})", end="", flush=True)
+    print_progress(i + 1, total)
   print()
 
-def lighten_output(directory, pickle_size, keep_full_pickles, path_to_params, to_json=False):
+def lighten_output(
+    directory, pickle_size, keep_full_pickles, path_to_params, to_json=False, workers=1, max_memory=None,
+    pae_format='float16', pae_precision=0.25):
   default_parameters = {
     "keys": [
         "num_recycles", "predicted_aligned_error", "predicted_lddt",
@@ -255,7 +365,7 @@ def lighten_output(directory, pickle_size, keep_full_pickles, path_to_params, to
   if af3_batch_files:
     print("Detected AlphaFold3 output.")
     print("Reference large input elements out of the af3 batches files")
-    extract_af3_batch_input_msas(directory, af3_batch_files)
+    extract_af3_batch_input_msas(directory, af3_batch_files, workers, max_memory)
 
   # step to lighten (or not) the pickles
   if pickle_size == "full":
@@ -272,10 +382,15 @@ def lighten_output(directory, pickle_size, keep_full_pickles, path_to_params, to
       print(f"Using custom parameters:\n{path_to_params}")
     else:
       used_parameters = default_parameters
-    pickles = lighten_all_pkl(directory, used_parameters, to_json=False)
+    pickles = lighten_all_pkl(directory, used_parameters, to_json=False, workers=workers, max_memory=max_memory)
     if delete_after_lightening and pickles != None:
       delete_pickles(pickles, directory)
 
+  elif pickle_size == "arrays":
+    pickles, pkl_dir = store_all_arrays(directory, pae_format, pae_precision, workers, max_memory)
+    if not keep_full_pickles and pickles:
+      delete_pickles(pickles, pkl_dir)
+
   elif pickle_size == "delete":
     pickles = [ pkl for pkl in os.listdir(directory) if pkl.endswith('.pkl') ]
     delete_pickles(pickles, directory)
@@ -310,7 +425,9 @@ def main():
   target_dirs = detect_directories(output_directory)
 
   for directory in target_dirs:
-    lighten_output(directory, pickle_size, keep_full_pickles, parameters, to_json=False)
+    lighten_output(
+      directory, pickle_size, keep_full_pickles, parameters, to_json=False, workers=args.workers,
+      max_memory=args.max_memory, pae_format=args.pae_format, pae_precision=args.pae_precision)
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,61 @@
+import fcntl
+import os
+import shutil
+
+# how the post treatment places the outputs of the batches in their final layout:
+# - copy: the files are copied, the batch directories are removed at the end
+# - move: the files are renamed, only copied when moved to another filesystem
+# - hardlink, reflink: the files share the data of the batch files, copied when not possible on the filesystem
+# - symlink: the files are links to the batch files, the batch directories are kept
+LINK_MODES = ['copy', 'move', 'hardlink', 'reflink', 'symlink']
+# ioctl cloning the data of a file on copy on write filesystems (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+def kept_source_mode(link_mode):
+  # the source of this file is used again afterwards, it is linked instead of moved
+  return 'hardlink' if link_mode == 'move' else link_mode
+
+def reflink_file(source, destination):
+  with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+    fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+  shutil.copymode(source, destination)
+
+def place_file(source, destination, link_mode='copy'):
+  # same destination as shutil.copy, a file of the same name in a destination directory
+  if os.path.isdir(destination):
+    destination = os.path.join(destination, os.path.basename(source))
+  if link_mode == 'copy':
+    return shutil.copy(source, destination)
+  if not os.path.exists(source):
+    raise FileNotFoundError(f"No such file or directory: '{source}'")
+  if os.path.lexists(destination):
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+      return destination
+    os.remove(destination)
+
+  if link_mode == 'move':
+    shutil.move(source, destination)
+  elif link_mode == 'symlink':
+    os.symlink(os.path.realpath(source), destination)
+  else:
+    try:
+      if link_mode == 'hardlink':
+        os.link(source, destination)
+      else:
+        reflink_file(source, destination)
+    except OSError:
+      # other filesystem, or no hard link or copy on write support
+      shutil.copy(source, destination)
+  return destination
+
+def place_tree(source, destination, link_mode='copy'):
+  if link_mode == 'move' and not os.path.exists(destination):
+    return shutil.move(source, destination)
+  shutil.copytree(
+    source,
+    destination,
+    copy_function=lambda source_file, destination_file: place_file(source_file, destination_file, link_mode),
+    dirs_exist_ok=True)
+  if link_mode == 'move':
+    shutil.rmtree(source)
+  return destination
@@ -2,11 +2,32 @@
 
 import argparse
 from concurrent.futures import ThreadPoolExecutor
+import heapq
 import os
 import json
+import tempfile
 from shutil import copy as cp, rmtree as rm, move as mv
 import sys
 
+from massivefold.parallelization.link_files import LINK_MODES
+from massivefold.parallelization.link_files import place_file
+from massivefold.parallelization.prediction_scores import pickle_stat
+from massivefold.parallelization.prediction_scores import record_scores
+from massivefold.utils import read_json
+from massivefold.utils import write_json
+
+# state of a run whose batches are post treated as soon as they end (massivefold run --incremental_post_treatment)
+INCREMENTAL_STATE = 'incremental_post_treatment.json'
+# one record per converted or added batch, written by the task of the batch and only combined at the end of the run
+INCREMENTAL_RECORDS = 'incremental_batches'
+CONVERTED_RECORD = '.converted.json'
+RANKINGS_RECORD = '.rankings.json'
+RANKING_TYPES = ['debug', 'iptm', 'actifptm', 'ptm']
+# the global rankings are an external merge of the sorted batch rankings: MERGE_FAN_IN runs are merged at once with
+# RUN_BUFFER lines read ahead from each, so that memory does not grow with the number of predictions
+MERGE_FAN_IN = 64
+RUN_BUFFER = 256
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
   '--batches_path',
@@ -16,39 +37,217 @@ parser.add_argument(
   '--nomultithreading',
   action='store_true',
   help='Disable multithreaded prediction, confidence, and pickle copy during post-treatment.')
+parser.add_argument(
+  '--add_batch',
+  default=None,
+  help='Only add this finished batch id to the global ranking of a run post treated incrementally.')
+parser.add_argument(
+  '--link_mode',
+  default='copy',
+  choices=LINK_MODES,
+  help="How the outputs of the batches are placed in the run directory (default: copy). With 'symlink', the batch "
+  "directories are kept.")
+
+def read_batch_rankings(batch_path, jobname):
+  # every ranking of a batch, each sorted by decreasing score
+  rankings = {}
+  for ranking_type in RANKING_TYPES:
+    ranking_path = os.path.join(batch_path, jobname, f'ranking_{ranking_type}.json')
+    if not os.path.isfile(ranking_path):
+      continue
+    with open(ranking_path, 'r') as local_ranking_file:
+      try:
+        local_rank = json.load(local_ranking_file)
+      except Exception as e:
+        print(f"Borken file: {ranking_path}")
+        print(e)
+        sys.exit()
+    score_key = list(local_rank.keys())[0]
+    rankings[ranking_type] = (score_key, sorted(local_rank[score_key].items(), key=lambda item: item[1], reverse=True))
+  return rankings
+
+def read_run(handle, offset, count):
+  # lines of a sorted run, the runs of a same file are read alternately
+  while count:
+    handle.seek(offset)
+    lines = [handle.readline() for _ in range(min(RUN_BUFFER, count))]
+    offset = handle.tell()
+    count -= len(lines)
+    yield from lines
+
+def run_line_score(line):
+  return -float(line.split(b'\t', 1)[0])
+
+def merge_runs(handle, runs):
+  # ties keep the order of the runs
+  return heapq.merge(*[read_run(handle, offset, count) for offset, count in runs], key=run_line_score)
+
+def reduce_runs(runs_path, runs):
+  while len(runs) > MERGE_FAN_IN:
+    merged_path = f"{runs_path}.merged"
+    merged_runs = []
+    with open(runs_path, 'rb') as handle, open(merged_path, 'wb') as output:
+      for first in range(0, len(runs), MERGE_FAN_IN):
+        group = runs[first:first + MERGE_FAN_IN]
+        offset = output.tell()
+        output.writelines(merge_runs(handle, group))
+        merged_runs.append((offset, sum(count for _, count in group)))
+    os.replace(merged_path, runs_path)
+    runs = merged_runs
+  return runs
+
+def write_ranking(ranking_path, score_key, entries):
+  # same content as json.dumps(ranking, indent=4), written as the (score, prediction) entries come
+  with open(ranking_path, 'w') as fileout, tempfile.TemporaryFile('w+') as order_file:
+    fileout.write('{\n    ' + json.dumps(score_key) + ': {')
+    count = 0
+    for score, prediction in entries:
+      fileout.write((',' if count else '') + '\n        ' + json.dumps(prediction) + ': ' + score)
+      order_file.write(prediction + '\n')
+      count += 1
+    fileout.write('\n    },\n    "order": [' if count else '},\n    "order": [')
+    order_file.seek(0)
+    for i, prediction in enumerate(order_file):
+      fileout.write((',' if i else '') + '\n        ' + json.dumps(prediction.rstrip('\n')))
+    fileout.write('\n    ]\n}' if count else ']\n}')
 
-def create_global_ranking(all_batches_path, jobname, ranking_type="debug"):
+def run_entries(lines):
+  for line in lines:
+    score, prediction = line.decode().rstrip('\n').split('\t', 1)
+    yield score, prediction
+
+def create_global_ranking(all_batches_path, jobname):
+  # one pass over the batches writes the sorted runs of each ranking type, then each ranking is merged from them
   map_pred_batch = {}
-  whole_ranking = {}
-  ranking_key_score = ''
-  for batch in os.listdir(all_batches_path):
-    if batch.startswith('batch'):
-      ranking_path = os.path.join(all_batches_path, batch, jobname, f'ranking_{ranking_type}.json')
-      with open(ranking_path, 'r') as local_ranking_file:
-        try:
-          local_rank = json.load(local_ranking_file)
-        except Exception as e:
-          print(f"Borken file: {ranking_path}")
-          print(e)
-          sys.exit()
-        if not ranking_key_score:
-          ranking_key_score = list(local_rank.keys())[0]
-      map_pred_batch.update({pred: batch for pred in local_rank['order']})
-      whole_ranking.update(local_rank[ranking_key_score])
-  sorted_predictions = sorted(whole_ranking.items(), key=lambda x:x[1], reverse=True)
-  iptm_ptm = dict(sorted_predictions)
-  order = sorted(whole_ranking, reverse=True, key=whole_ranking.get)
-  global_ranking = {ranking_key_score: iptm_ptm, 'order': order}
-  with open(f"{all_batches_path}/ranking_{ranking_type}.json", 'w') as fileout:
-    fileout.write(json.dumps(global_ranking, indent=4)) 
+  score_keys, runs = {}, {}
+  batches = sorted(batch for batch in os.listdir(all_batches_path) if batch.startswith('batch'))
+  with tempfile.TemporaryDirectory(dir=all_batches_path, prefix='.ranking_') as runs_dir:
+    runs_files = {}
+    try:
+      for batch in batches:
+        for ranking_type, (score_key, ranked) in read_batch_rankings(os.path.join(all_batches_path, batch), jobname).items():
+          if ranking_type not in runs_files:
+            runs_files[ranking_type] = open(os.path.join(runs_dir, ranking_type), 'wb')
+            score_keys[ranking_type], runs[ranking_type] = score_key, []
+          runs_file = runs_files[ranking_type]
+          runs[ranking_type].append((runs_file.tell(), len(ranked)))
+          runs_file.writelines(f"{json.dumps(score)}\t{prediction}\n".encode() for prediction, score in ranked)
+          if ranking_type == 'debug':
+            map_pred_batch.update({prediction: batch for prediction, _ in ranked})
+    finally:
+      for runs_file in runs_files.values():
+        runs_file.close()
+
+    for ranking_type, ranking_runs in runs.items():
+      runs_path = os.path.join(runs_dir, ranking_type)
+      ranking_runs = reduce_runs(runs_path, ranking_runs)
+      with open(runs_path, 'rb') as handle:
+        write_ranking(
+          f"{all_batches_path}/ranking_{ranking_type}.json",
+          score_keys[ranking_type],
+          run_entries(merge_runs(handle, ranking_runs)))
 
   return map_pred_batch
 
+def incremental_state_path(all_batches_path):
+  return os.path.join(all_batches_path, INCREMENTAL_STATE)
+
+def incremental_records_path(all_batches_path):
+  return os.path.join(all_batches_path, INCREMENTAL_RECORDS)
+
+def create_incremental_state(all_batches_path):
+  os.makedirs(incremental_records_path(all_batches_path), exist_ok=True)
+  write_json(incremental_state_path(all_batches_path), {'records': INCREMENTAL_RECORDS})
+
+def write_batch_record(all_batches_path, batch, suffix, record):
+  # each batch has its own small files, the tasks do not rewrite a state shared by the whole run
+  records_path = incremental_records_path(all_batches_path)
+  os.makedirs(records_path, exist_ok=True)
+  write_json(os.path.join(records_path, f"{batch}{suffix}"), record)
+
+def recorded_batches(all_batches_path, suffix):
+  records_path = incremental_records_path(all_batches_path)
+  if not os.path.isdir(records_path):
+    return []
+  return sorted(record[:-len(suffix)] for record in os.listdir(records_path) if record.endswith(suffix))
+
+def mark_converted(all_batches_path, batch):
+  write_batch_record(all_batches_path, batch, CONVERTED_RECORD, {'batch': batch})
+
+def converted_batches(all_batches_path):
+  return recorded_batches(all_batches_path, CONVERTED_RECORD)
+
+def af3_batch_to_sequence_dir(all_batches_path, batch, jobname, link_mode='copy'):
+  # same layout as the other tools: batch_<n>/<sequence>/
+  batch_dir = os.path.join(all_batches_path, batch)
+  new_location = os.path.join(batch_dir, jobname)
+  os.makedirs(new_location, exist_ok=True)
+  output_files = [ os.path.join(batch_dir, i) for i in os.listdir(batch_dir) if i.endswith('.json') or i.endswith('.cif') or i.endswith('.pkl') ]
+
+  confidence_path = os.path.join(batch_dir, 'confidences')
+  new_confidence_path = os.path.join(new_location, 'confidences')
+
+  os.makedirs(new_confidence_path, exist_ok=True)
+  for confidence_file in os.listdir(confidence_path):
+    place_file(os.path.join(confidence_path, confidence_file), new_confidence_path, link_mode)
+  for file in output_files: 
+    new_file = os.path.join(new_location, os.path.basename(file))
+    place_file(file, new_file, link_mode)
+
+def add_batch(all_batches_path, batch, jobname, is_alphafold3=False, link_mode='copy'):
+  # the rankings of the batch are recorded for the global ones, its pickles do not depend on the ranks
+  if is_alphafold3:
+    af3_batch_to_sequence_dir(all_batches_path, batch, jobname, link_mode)
+  batch_rankings = {}
+  for ranking_type in RANKING_TYPES:
+    ranking_path = os.path.join(all_batches_path, batch, jobname, f'ranking_{ranking_type}.json')
+    if os.path.isfile(ranking_path):
+      with open(ranking_path, 'r') as local_ranking_file:
+        batch_rankings[ranking_type] = json.load(local_ranking_file)
+  if 'debug' not in batch_rankings:
+    print(f"No ranking in {os.path.join(all_batches_path, batch)}, not added to the global ranking.")
+    return False
+
+  write_batch_record(all_batches_path, batch, RANKINGS_RECORD, batch_rankings)
+
+  for prediction in batch_rankings['debug']['order']:
+    pkl_path = os.path.join(all_batches_path, batch, jobname, f"result_{prediction}.pkl")
+    if os.path.isfile(pkl_path):
+      place_file(pkl_path, all_batches_path, link_mode)
+  return True
+
+def write_global_rankings(all_batches_path, batches):
+  # the records of the batches are read once, in the order of the batches
+  rankings, pred_batch_map = {}, {}
+  for batch in batches:
+    batch_rankings = read_json(os.path.join(incremental_records_path(all_batches_path), f"{batch}{RANKINGS_RECORD}"))
+    for ranking_type, local_rank in batch_rankings.items():
+      ranking = rankings.setdefault(ranking_type, {'key': list(local_rank.keys())[0], 'scores': {}})
+      ranking['scores'].update(local_rank[ranking['key']])
+    pred_batch_map.update({pred: batch for pred in batch_rankings['debug']['order']})
+  for ranking_type, ranking in rankings.items():
+    order = sorted(ranking['scores'], reverse=True, key=ranking['scores'].get)
+    entries = ((json.dumps(ranking['scores'][pred]), pred) for pred in order)
+    write_ranking(f"{all_batches_path}/ranking_{ranking_type}.json", ranking['key'], entries)
+  return pred_batch_map
+
+def finalize_incremental_ranking(all_batches_path, jobname, is_alphafold3=False, link_mode='copy'):
+  # the batches whose task did not add them, then the global rankings from the records of all the batches
+  merged = recorded_batches(all_batches_path, RANKINGS_RECORD)
+  remaining = [
+    batch for batch in sorted(os.listdir(all_batches_path))
+    if batch.startswith('batch') and batch not in merged and os.path.isdir(os.path.join(all_batches_path, batch))
+  ]
+  print(f"{len(merged)} batches already added to the global ranking, adding {len(remaining)}")
+  for batch in remaining:
+    add_batch(all_batches_path, batch, jobname, is_alphafold3, link_mode)
+  return write_global_rankings(all_batches_path, recorded_batches(all_batches_path, RANKINGS_RECORD))
+
 def post_treatment_threads():
   cpu_count = os.cpu_count() or 1
   return max(1, min(32, cpu_count * 2))
 
-def copy_prediction_outputs(all_batches_path, pred_batch_map, jobname, rank, prediction):
+def copy_prediction_outputs(all_batches_path, pred_batch_map, jobname, rank, prediction, copy_pkl=True, link_mode='copy'):
   messages = []
 
   # copy the predictions
@@ -74,7 +273,7 @@ def copy_prediction_outputs(all_batches_path, pred_batch_map, jobname, rank, pre
     os.makedirs(global_confidence_path, exist_ok=True)
     new_confidence_path = os.path.join(global_confidence_path, f"ranked_{rank}_{pred_name}.json")
     try:
-      cp(old_confidence_path, new_confidence_path)
+      place_file(old_confidence_path, new_confidence_path, link_mode)
     except FileNotFoundError as e:
       messages.append(str(e))
       messages.append(f"{pred_batch_map[prediction]}/confidences/{pred_new_name.replace('.cif', '.json')} not found")
@@ -83,17 +282,19 @@ def copy_prediction_outputs(all_batches_path, pred_batch_map, jobname, rank, pre
   old_pdb_path = os.path.join(all_batches_path, pred_batch_map[prediction], jobname, pred_new_name)
   new_pdb_path = os.path.join(all_batches_path, f"ranked_{rank}_{pred_new_name}")
   try:
-    cp(old_pdb_path, new_pdb_path)
+    place_file(old_pdb_path, new_pdb_path, link_mode)
   except FileNotFoundError as e:
     messages.append(str(e))
     messages.append(f"{pred_batch_map[prediction]}/ranked_{rank}_{pred_new_name} does not exist, probably score < --min_score.")
 
   # Move pkl files
+  if not copy_pkl:
+    return messages
   pkl_name = f"result_{prediction}.pkl"
   old_pkl_path = os.path.join(all_batches_path, pred_batch_map[prediction], jobname, pkl_name)
   new_pkl_path = os.path.join(all_batches_path, pkl_name)
   try:
-    cp(old_pkl_path, new_pkl_path)
+    place_file(old_pkl_path, new_pkl_path, link_mode)
   except FileNotFoundError:
     messages.append(f"{pred_batch_map[prediction]}/result_{prediction}.pkl does not exist, probably score < --min_score.")
 
@@ -103,13 +304,13 @@ def print_messages(messages):
   for message in messages:
     print(message)
 
-def move_and_rename(all_batches_path, pred_batch_map, jobname, use_multithreading=True):
+def move_and_rename(all_batches_path, pred_batch_map, jobname, use_multithreading=True, copy_pkl=True, link_mode='copy'):
   with open(os.path.join(all_batches_path, 'ranking_debug.json'), 'r') as rank_file:
     global_rank_order = json.load(rank_file)['order']
   first_prediction = global_rank_order[0]
   features = os.path.join(all_batches_path, pred_batch_map[first_prediction], jobname, "features.pkl")
   if os.path.isfile(features):
-    cp(features, os.path.join(all_batches_path, "features.pkl"))
+    place_file(features, os.path.join(all_batches_path, "features.pkl"), link_mode)
   else:
     print('Either using colabfold or error encountered while copying features.pkl')
   files = os.path.join(all_batches_path, pred_batch_map[first_prediction], jobname)
@@ -117,23 +318,47 @@ def move_and_rename(all_batches_path, pred_batch_map, jobname, use_multithreadin
     if file.endswith('coverage.png'):
       coverage_plot = os.path.join(files, file)
       os.mkdir(os.path.join(all_batches_path, "./plots"))
-      cp(coverage_plot, os.path.join(all_batches_path, "./plots/alignment_coverage.png"))
+      place_file(coverage_plot, os.path.join(all_batches_path, "./plots/alignment_coverage.png"), link_mode)
     else:
       print('Either not using colabfold, or coverage plot not found')
 
   if not use_multithreading:
     for i, prediction in enumerate(global_rank_order):
-      print_messages(copy_prediction_outputs(all_batches_path, pred_batch_map, jobname, i, prediction))
+      print_messages(copy_prediction_outputs(
+        all_batches_path, pred_batch_map, jobname, i, prediction, copy_pkl, link_mode))
     return
 
   with ThreadPoolExecutor(max_workers=post_treatment_threads()) as executor:
     futures = [
-      executor.submit(copy_prediction_outputs, all_batches_path, pred_batch_map, jobname, i, prediction)
+      executor.submit(
+        copy_prediction_outputs, all_batches_path, pred_batch_map, jobname, i, prediction, copy_pkl, link_mode)
       for i, prediction in enumerate(global_rank_order)
     ]
     for future in futures:
       print_messages(future.result())
 
+def record_run_scores(all_batches_path):
+  # the scores of the pickles of the run come from its global rankings, the pickles are not loaded
+  rankings = {}
+  for ranking_type in RANKING_TYPES:
+    ranking_path = os.path.join(all_batches_path, f'ranking_{ranking_type}.json')
+    if os.path.isfile(ranking_path):
+      with open(ranking_path, 'r') as ranking_file:
+        ranking = json.load(ranking_file)
+      score_name = 'ranking_confidence' if ranking_type == 'debug' else ranking_type
+      rankings[score_name] = ranking[list(ranking.keys())[0]]
+
+  scores = {}
+  for prediction in rankings.get('ranking_confidence', {}):
+    pkl_name = f"result_{prediction}.pkl"
+    pkl_path = os.path.join(all_batches_path, pkl_name)
+    if os.path.isfile(pkl_path):
+      scores[pkl_name] = {
+        score_name: ranking[prediction] for score_name, ranking in rankings.items() if prediction in ranking
+      }
+      scores[pkl_name]['pickle'] = pickle_stat(pkl_path)
+  record_scores(all_batches_path, scores)
+
 def remove_batch_dirs(all_batches_path):
   batch_dirs = [d for d in os.listdir(all_batches_path) if d.startswith('batch')]
   for batch_dir in batch_dirs:
@@ -145,8 +370,14 @@ def main():
 
   sequence_name = os.path.basename(os.path.dirname(batches_path))
   run_name = os.path.basename(batches_path)
+  is_alphafold3 = os.path.exists(os.path.join(batches_path, "af3_batch_0.json"))
+  incremental = os.path.isfile(incremental_state_path(batches_path))
+
+  if args.add_batch is not None:
+    add_batch(batches_path, f"batch_{args.add_batch}", sequence_name, is_alphafold3, args.link_mode)
+    return
 
-  if os.path.exists(os.path.join(batches_path, "af3_batch_0.json")):
+  if is_alphafold3:
     print("AlphaFold3 output detected")
     batch_0_name = json.load(open(os.path.join(batches_path, "af3_batch_0.json"), 'r'))["name"]
     batch_0 = os.path.join(batches_path, batch_0_name)
@@ -174,7 +405,11 @@ def main():
         if not os.path.exists(single_batch):
           print(f"Batch {single_batch} not existing, skip it.")
           continue
-        old_directories = [ old_dir for old_dir in os.listdir(single_batch) if old_dir.startswith('seed-') ]
+        # the ranked predictions linked with --link_mode symlink are the files of the seed directories
+        old_directories = [
+          old_dir for old_dir in os.listdir(single_batch)
+          if old_dir.startswith('seed-') and args.link_mode != 'symlink'
+        ]
         for old_dir in old_directories:
           rm(os.path.join(single_batch, old_dir))
         unranked_predictions = [ pred for pred in os.listdir(single_batch) if pred.startswith('af3_seed') and pred.endswith('.cif')]
@@ -187,31 +422,34 @@ def main():
 
     for batch in all_batches:
       batch_dir = os.path.join(batches_path, batch)
-      new_location = os.path.join(batch_dir, sequence_name)
-      os.makedirs(new_location, exist_ok=True)
-      output_files = [ os.path.join(batch_dir, i) for i in os.listdir(batch_dir) if i.endswith('.json') or i.endswith('.cif') or i.endswith('.pkl') ]
-
-      confidence_path = os.path.join(batch_dir, 'confidences')
-      new_confidence_path = os.path.join(new_location, 'confidences')
-
-      os.makedirs(new_confidence_path, exist_ok=True)
-      for confidence_file in os.listdir(confidence_path):
-        cp(os.path.join(confidence_path, confidence_file), new_confidence_path)
-      for file in output_files: 
-        new_file = os.path.join(new_location, os.path.basename(file))
-        cp(file, new_file)
+      if not os.path.isdir(batch_dir):
+        # skipped once the stop condition of the run was reached
+        print(f"Batch {batch_dir} not existing, skip it.")
+        continue
+      if not incremental:
+        af3_batch_to_sequence_dir(batches_path, batch, sequence_name, args.link_mode)
 
   batch_0 = os.path.join(batches_path, "batch_0")
   # create ranking json files
-  pred_batch_map = create_global_ranking(batches_path, sequence_name)
-  metrics = ["iptm", "actifptm", "ptm"]
-  for metric in metrics:
-    if os.path.isfile(f"{batches_path}/batch_0/{sequence_name}/ranking_{metric}.json"):
-      create_global_ranking(batches_path, sequence_name, metric)
-
-  # organize output directory
-  move_and_rename(batches_path, pred_batch_map, sequence_name, not args.nomultithreading)
-  remove_batch_dirs(batches_path)
+  if incremental:
+    pred_batch_map = finalize_incremental_ranking(batches_path, sequence_name, is_alphafold3, args.link_mode)
+  else:
+    pred_batch_map = create_global_ranking(batches_path, sequence_name)
+
+  # organize output directory, the pickles of an incremental run are already there
+  move_and_rename(
+    batches_path, pred_batch_map, sequence_name, not args.nomultithreading, copy_pkl=not incremental,
+    link_mode=args.link_mode)
+  record_run_scores(batches_path)
+  # the linked outputs point to the files of the batches
+  if args.link_mode != 'symlink':
+    remove_batch_dirs(batches_path)
+  if incremental:
+    for state_file in [incremental_state_path(batches_path), os.path.join(batches_path, 'queue.lock')]:
+      if os.path.isfile(state_file):
+        os.remove(state_file)
+    if os.path.isdir(incremental_records_path(batches_path)):
+      rm(incremental_records_path(batches_path))
 
 if __name__ == "__main__":
   main()
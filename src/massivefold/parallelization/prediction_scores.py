@@ -0,0 +1,68 @@
+import os
+import pickle
+
+from massivefold.utils import read_json
+from massivefold.utils import write_json
+
+# scores of the result pickles of a directory, read instead of the pickles that also hold the PAE and distograms
+SCORES_FILE = 'prediction_scores.json'
+SCORE_KEYS = ['ptm', 'iptm', 'actifptm', 'ranking_confidence', 'mean_plddt']
+
+def scores_path(directory):
+  return os.path.join(directory, SCORES_FILE)
+
+def pickle_stat(pkl_file):
+  # the scores of a pickle are only used while it keeps the same modification time and size
+  pickle_file_stat = os.stat(pkl_file)
+  return [pickle_file_stat.st_mtime, pickle_file_stat.st_size]
+
+def read_scores(directory):
+  path = scores_path(directory)
+  if not os.path.isfile(path):
+    return {}
+  try:
+    return read_json(path)
+  except ValueError:
+    return {}
+
+def record_scores(directory, scores):
+  # the table only spares loading the pickles, a directory that can not be written is still read
+  if not scores:
+    return
+  table = read_scores(directory)
+  table.update(scores)
+  try:
+    write_json(scores_path(directory), table)
+  except OSError as e:
+    print(f"Scores of the pickles not recorded in {directory}: {e}")
+
+def scalar_scores(result):
+  scores = {}
+  for key in SCORE_KEYS:
+    try:
+      scores[key] = float(result[key])
+    except (KeyError, TypeError, ValueError):
+      continue
+  return scores
+
+def cached_scores(table, pkl_file, required=()):
+  # a record without some of the required scores is not used, the run may not have ranked them
+  entry = table.get(os.path.basename(pkl_file))
+  if not entry or any(key not in entry for key in required):
+    return None
+  if os.path.isfile(pkl_file) and entry.get('pickle') == pickle_stat(pkl_file):
+    return entry
+  return None
+
+def pickle_scores(pkl_file):
+  with open(pkl_file, 'rb') as pkl:
+    result = pickle.load(pkl)
+  scores = scalar_scores(result)
+  scores['pickle'] = pickle_stat(pkl_file)
+  return scores
+
+def load_scores(pkl_file, table=None, required=()):
+  # the recorded scores of the pickle if it did not change since, otherwise the ones of the pickle itself
+  if table is None:
+    table = read_scores(os.path.dirname(pkl_file))
+  return cached_scores(table, pkl_file, required) or pickle_scores(pkl_file)
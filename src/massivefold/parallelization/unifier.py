@@ -4,19 +4,24 @@ import re
 import copy
 import argparse
 
-from pandas._libs.lib import infer_dtype
-from Bio import SeqIO
 import pickle
-from shutil import copy as cp, copytree
-import pandas as pd
 import json
 import sys
 
 from massivefold.install import parse_tool_from_param_basename, resolve_site_default_path
+from massivefold.parallelization import organize_outputs
+from massivefold.parallelization.link_files import LINK_MODES
+from massivefold.parallelization.link_files import kept_source_mode
+from massivefold.parallelization.link_files import place_file
+from massivefold.parallelization.link_files import place_tree
+from massivefold.parallelization.prediction_scores import load_scores
+from massivefold.parallelization.prediction_scores import read_scores
+from massivefold.parallelization.prediction_scores import record_scores
+from massivefold.utils import queue_lock
+from contextlib import nullcontext
 import shutil
 import string
 import random
-import numpy as np
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -41,8 +46,19 @@ parser.add_argument(
   '--batches_file',
   default='',
   help='Path to batches file. If --conversion=output, this file is necessary.')
+parser.add_argument(
+  '--batch_id',
+  default=None,
+  help='With --conversion=output, only convert this batch (run post treated incrementally).')
+parser.add_argument(
+  '--link_mode',
+  default='copy',
+  choices=LINK_MODES,
+  help="With --conversion=output, how the renamed outputs are created from the ones of the tool (default: copy). "
+  "With 'move', the files of the tool are not kept under their original name.")
 
 def convert_colabfold_fasta(fasta_path:str):
+  from Bio import SeqIO
   records = list(SeqIO.parse(fasta_path, "fasta"))
   fasta_dir = os.path.dirname(fasta_path)
   fasta_file = os.path.basename(fasta_path).split('.fa')[0]
@@ -63,6 +79,7 @@ def convert_colabfold_fasta(fasta_path:str):
   print(f"Fasta file has been successfully converted for ColabFold at {output_fasta}\n")
 
 def create_alphafold3_json(fasta_path: str, adapted_input_dir: str, json_params_path):
+  from Bio import SeqIO
   json_params = os.path.realpath(json_params_path)
   assert os.path.exists(json_params) and json_params.endswith('.json'), \
     "Please provide a valid path to a json file with --json_params"
@@ -509,6 +526,7 @@ def af3_add_input_entity(batch_input_json, af3_params):
   return batch_input_json
 
 def ppi_create_base_fasta(file_list, output_dir):
+  import pandas as pd
   fasta_types = ["protein", "dna", "rna"]
   combined_fasta_dir = os.path.join(output_dir, "combined")
   os.makedirs(combined_fasta_dir, exist_ok=True)
@@ -565,6 +583,7 @@ def ppi_create_base_fasta(file_list, output_dir):
   return interactors
 
 def ppi_create_input(receptors, ligands, parameters_file):
+  import pandas as pd
   base_dir = json.load(open(parameters_file, 'r'))["massivefold"]["input_dir"]
   combined_fasta_dir = os.path.join(base_dir, "combined")
   os.makedirs(combined_fasta_dir, exist_ok=True)
@@ -792,11 +811,26 @@ def get_alphafold3_batch_input(input_json: str, params_json: str, batches: str):
     alphafold3_input = os.path.join(output_dir, sequence, run_name, f"af3_batch_{batch}.json")
     json.dump(single_batch, open(alphafold3_input, 'w'), indent=4)
 
+def af3_split_batch_input(run_dir: str, batch_id: str, new_ids: list, batches: dict):
+  """Share the model seeds of af3_batch_<batch_id>.json with the sub-batches created by batching.split_batch."""
+  batch_input = os.path.join(run_dir, f"af3_batch_{batch_id}.json")
+  batch_input_json = json.load(open(batch_input, 'r'))
+  model_seeds = batch_input_json['modelSeeds']
+
+  seed_index = 0
+  for batch in [batch_id] + new_ids:
+    num_seeds = int(batches[batch]['end']) - int(batches[batch]['start']) + 1
+    single_batch = copy.deepcopy(batch_input_json)
+    single_batch['name'] = 'batch_' + batch
+    single_batch['modelSeeds'] = model_seeds[seed_index:seed_index + num_seeds]
+    seed_index += num_seeds
+    json.dump(single_batch, open(os.path.join(run_dir, f"af3_batch_{batch}.json"), 'w'), indent=4)
+
 def prepare_inference(input, params, batches, tool):
   if tool == "AlphaFold3":
     get_alphafold3_batch_input(input, params, batches)
 
-def rename_colabfold_pkl(pkl_files:list, output_path:str, pred_shift:int, sep:str):
+def rename_colabfold_pkl(pkl_files:list, output_path:str, pred_shift:int, sep:str, link_mode='copy'):
   extract = lambda x: int(x.split('_')[-1].replace('.pickle', ''))
   seed = sorted(list(map(extract, pkl_files)))[0]
   if sep == 'multimer':
@@ -809,11 +843,11 @@ _pred_{int(x.split('seed_')[1].split('.')[0]) + pred_shift - seed}.pkl"
   new_names = { old: rename(old) for old in pkl_files }
   for old in pkl_files:
     new = new_names[old]
-    cp(f"{output_path}/{old}", f"{output_path}/{new}")
+    place_file(f"{output_path}/{old}", f"{output_path}/{new}", link_mode)
 
   return new_names
 
-def rename_colabfold_pdb(pdb_files:list, output_path:str, pred_shift:int, sep:str, to_convert: str):
+def rename_colabfold_pdb(pdb_files:list, output_path:str, pred_shift:int, sep:str, to_convert: str, link_mode='copy'):
   extract = lambda x: int(x.split('_')[-1].replace('.pdb', ''))
   seed = sorted(list(map(extract, pdb_files)))[0]
   print(f"Seed used: {seed}")
@@ -827,7 +861,7 @@ _ptm_pred_{int(x.split('seed_')[1].split('.')[0]) + pred_shift - seed}.pdb"
   new_names = { old: rename(old) for old in pdb_files }
   for old in pdb_files:
     new = new_names[old]
-    cp(f"{output_path}/{old}", f"{output_path}/{new}")
+    place_file(f"{output_path}/{old}", f"{output_path}/{new}", link_mode)
 
   map_old_to_new = {
     f"alphafold2{old.split('alphafold2')[1].replace('.pdb', '')}": f"model{new_names[old].split('model')[1].replace('.pdb', '')}"
@@ -835,15 +869,19 @@ _ptm_pred_{int(x.split('seed_')[1].split('.')[0]) + pred_shift - seed}.pdb"
   }
 
   map_file = os.path.join(to_convert, 'unified_map.json')
-  if os.path.isfile(map_file):
-    name_map = json.load(open(map_file, 'r'))
-    name_map.update(map_old_to_new)
-    json.dump(name_map, open(map_file, 'w'), indent=4)
-  else:
-    json.dump(map_old_to_new, open(map_file, 'w'), indent=4)
+  # the batches of an incremental run are converted concurrently
+  incremental = os.path.isfile(organize_outputs.incremental_state_path(to_convert))
+  with queue_lock(to_convert) if incremental else nullcontext():
+    if os.path.isfile(map_file):
+      name_map = json.load(open(map_file, 'r'))
+      name_map.update(map_old_to_new)
+      json.dump(name_map, open(map_file, 'w'), indent=4)
+    else:
+      json.dump(map_old_to_new, open(map_file, 'w'), indent=4)
   return new_names
 
-def create_colabfold_ranking(predictions_to_rank:pd.core.frame.DataFrame, output_path:str, preset:str):
+def create_colabfold_ranking(predictions_to_rank:"pd.DataFrame", output_path:str, preset:str):
+  import pandas as pd
   metrics = ['ptm', 'iptm', 'actifptm', 'iptm+ptm'] if preset == 'multimer' else ['plddts', 'ptm']
 
   for metric in metrics:
@@ -868,7 +906,7 @@ def create_colabfold_ranking(predictions_to_rank:pd.core.frame.DataFrame, output
     ranking_file_content = { metric: scores_dict, 'order': order }
     json.dump(ranking_file_content, open(ranking_file_name, 'w'), indent=4)
 
-def move_output(output_path:str, batch):
+def move_output(output_path:str, batch, link_mode='copy'):
   whole_path = os.path.realpath(output_path)
   sequence = os.path.basename(os.path.dirname(whole_path))
   batch_path = f"{whole_path}/{batch}"
@@ -880,17 +918,21 @@ def move_output(output_path:str, batch):
     source = os.path.join(batch_path, element)
     destination = os.path.join(destination_path, element)
     if os.path.isdir(source):
-      copytree(source, destination, dirs_exist_ok=True)
+      place_tree(source, destination, link_mode)
     else:
-      cp(source, destination)
+      place_file(source, destination, link_mode)
 
 def rank_colabfold_predictions(output_path:str, pdb_files:list, new_pdb_names:list, preset):
+  import pandas as pd
   jobname = [ name for name in os.listdir(output_path) if name.endswith('a3m') ]
   jobname = jobname[0].split('.')[0]
 
   pickle_files = list(map(lambda x: x.replace("_unrelaxed_", "_all_").replace('.pdb', '.pickle'), pdb_files))
   json_files = list(map(lambda x: x.replace("_all_", "_scores_").replace('.pickle', '.json'), pickle_files))
   all_preds = pd.DataFrame()
+  # the scores recorded by a previous conversion of the batch spare loading its pickles again
+  recorded_scores = read_scores(output_path)
+  pickle_scores = {}
 
   for pickle_name, json_name, pdb_name in zip(pickle_files, json_files, new_pdb_names):
     if not os.path.exists(f"{output_path}/{pickle_name}"):
@@ -898,7 +940,8 @@ def rank_colabfold_predictions(output_path:str, pdb_files:list, new_pdb_names:li
     pred_name = f"model_{pdb_name.split('_model_')[1].split('.')[0]}"
 
     # open score files (json & pickle)
-    scores1 = pickle.load(open(f"{output_path}/{pickle_name}", 'rb'))
+    scores1 = load_scores(f"{output_path}/{pickle_name}", recorded_scores, required=['ptm'])
+    pickle_scores[pickle_name] = scores1
     scores2 = json.load(open(f"{output_path}/{json_name}", 'r'))
     content = {"prediction": pred_name, "ptm": scores1["ptm"]}
     if "iptm" in scores1:
@@ -910,9 +953,10 @@ def rank_colabfold_predictions(output_path:str, pdb_files:list, new_pdb_names:li
     new_pred = pd.DataFrame([content])
     all_preds = pd.concat([all_preds, new_pred], ignore_index=True)
   
+  record_scores(output_path, pickle_scores)
   create_colabfold_ranking(all_preds, output_path, preset)
 
-def convert_output(tool, batches_file: str, to_convert: str):
+def convert_output(tool, batches_file: str, to_convert: str, batch_ids=None, link_mode='copy'):
   all_batches_infos = json.load(open(batches_file, 'r'))
 
   if tool == "AlphaFold3":
@@ -933,18 +977,28 @@ def convert_output(tool, batches_file: str, to_convert: str):
     batches = sorted(batches, key=lambda x: int(x.split('_')[1]))
     batches_files = batches
 
+  # an incremental run converts each batch when it ends, only the remaining ones are converted at the end
+  incremental = os.path.isfile(organize_outputs.incremental_state_path(to_convert))
+  converted = organize_outputs.converted_batches(to_convert)
+  to_do = [
+    (file, batch) for file, batch in zip(batches_files, batches)
+    if batch not in converted and (batch_ids is None or batch.split('_')[-1] in batch_ids)
+  ]
+  if incremental and batch_ids is None:
+    print(f"{len(batches) - len(to_do)} batches already converted, converting {len(to_do)}")
+
   working, not_working, error = [], [], []
-  for file, batch in zip(batches_files, batches):
+  for file, batch in to_do:
     if tool == "ColabFold":
       batch_number = batch.split('_')[1]
       batch_shift = int(all_batches_infos[batch_number]['start'])
-      convert_colabfold_output(f"{to_convert}/{batch}", batch_shift, to_convert)
-      move_output(to_convert, batch)
+      convert_colabfold_output(f"{to_convert}/{batch}", batch_shift, to_convert, link_mode)
+      move_output(to_convert, batch, link_mode)
     elif tool == "AlphaFold3":
       batch_number = file.replace('af3_batch_', '').replace('.json', '')
       batch_shift = int(all_batches_infos[batch_number]['start'])
       try:
-        convert_alphafold3_output(f"{to_convert}/{batch}", batch_shift)
+        convert_alphafold3_output(f"{to_convert}/{batch}", batch_shift, link_mode)
         working.append(batch)
       except FileNotFoundError as e:
         not_working.append(batch)
@@ -952,6 +1006,8 @@ def convert_output(tool, batches_file: str, to_convert: str):
     elif tool == "AFmassive":
       sequence_name = os.path.basename(os.path.dirname(os.path.dirname(to_convert)))
       convert_afmassive_output(f"{to_convert}/{batch}/{sequence_name}/")
+    if incremental and batch not in not_working:
+      organize_outputs.mark_converted(to_convert, batch)
 
 
   if not_working:
@@ -959,6 +1015,7 @@ def convert_output(tool, batches_file: str, to_convert: str):
     print(f"{' - '.join(error)}")
 
 def format_colabfold_confidences(path_to_json):
+  import numpy as np
   content = json.load(open(path_to_json, 'r'))
   to_keep = [ 'pairwise_actifptm', 'pairwise_iptm', 'per_chain_ptm', 'actifptm', 'ptm', 'iptm' ]
   content = { i: content[i] for i in content if i in to_keep }
@@ -1027,7 +1084,7 @@ def create_colabfold_confidences(output_path, pdbs, renamed_pdbs):
     confidences_content = format_colabfold_confidences(json_path)
     json.dump(confidences_content, open(renamed_json, 'w'), indent=1)
 
-def convert_colabfold_output(output_path:str, pred_shift:int, to_convert: str):
+def convert_colabfold_output(output_path:str, pred_shift:int, to_convert: str, link_mode='copy'):
   json = [ file for file in os.listdir(output_path) if file.endswith('.json') and 'scores' in file ]
   pkls = [ file for file in os.listdir(output_path) if file.endswith('.pickle') ]
   pdbs = [ file for file in os.listdir(output_path) if file.endswith('.pdb') and 'rank' in file ]
@@ -1039,10 +1096,10 @@ def convert_colabfold_output(output_path:str, pred_shift:int, to_convert: str):
   else:
     raise ValueError('Neither multimer nor monomer_ptm, an error occured somewhere')
   # rename files
-  renamed_pdbs = rename_colabfold_pdb(pdbs, output_path, pred_shift, sep=sep, to_convert=to_convert)
+  renamed_pdbs = rename_colabfold_pdb(pdbs, output_path, pred_shift, sep=sep, to_convert=to_convert, link_mode=link_mode)
   rank_colabfold_predictions(output_path, pdbs, renamed_pdbs.values(), preset=sep)
   create_colabfold_confidences(output_path, pdbs, renamed_pdbs)
-  rename_colabfold_pkl(pkls, output_path, pred_shift, sep=sep)
+  rename_colabfold_pkl(pkls, output_path, pred_shift, sep=sep, link_mode=link_mode)
 
 def create_afmassive_confidences(output_path, pdbs):
   confidence_path = os.path.join(output_path, 'confidences')
@@ -1060,7 +1117,8 @@ def convert_afmassive_output(output_path:str):
   pdbs = [ file for file in os.listdir(output_path) if file.startswith('unrelaxed_') and file.endswith('.pdb') ]
   create_afmassive_confidences(output_path, pdbs)
 
-def convert_alphafold3_output(output_path: str, pred_shift: int):
+def convert_alphafold3_output(output_path: str, pred_shift: int, link_mode='copy'):
+  import pandas as pd
   batch_name = os.path.basename(output_path)
   df_ranking_scores = pd.read_csv(os.path.join(output_path, f"{batch_name}_ranking_scores.csv"))
   seed_dirs = [ os.path.join(output_path, seed) for seed in os.listdir(output_path) if seed.startswith('seed-')]
@@ -1106,7 +1164,7 @@ def convert_alphafold3_output(output_path: str, pred_shift: int):
   df = df.sort_values(all_score_types, ascending=False, ignore_index=True)
   df['rank'] = df.index
   df["ranked_name"] = "ranked_" + df["rank"].astype(str) + "_" + df["prediction_name"] + ".cif"
-  af3_move_and_rename(df, output_path)
+  af3_move_and_rename(df, output_path, link_mode)
 
 def af3_prediction_metrics(input_dir: str, nature: str):
   batch_name = os.path.basename(os.path.dirname(input_dir))
@@ -1119,6 +1177,7 @@ def af3_prediction_metrics(input_dir: str, nature: str):
   return metrics
 
 def plddts_from_cif(cif_filename):
+  import numpy as np
   from Bio.PDB.MMCIFParser import MMCIFParser
   pdb_parser = MMCIFParser(QUIET=True)
   structure = pdb_parser.get_structure(
@@ -1131,7 +1190,7 @@ def plddts_from_cif(cif_filename):
     residues_plddt.append(np.round(np.mean([ i.get_bfactor() for i in res.get_atoms() ]), decimals=2))
   return residues_plddt
 
-def af3_move_and_rename(df, output_dir):
+def af3_move_and_rename(df, output_dir, link_mode='copy'):
   pred_list = df.to_dict(orient="records")
   score_map = { "ranking_score": "debug", "iptm": "iptm", "actifptm": "actifptm", "ptm": "ptm", "mean_plddt": "plddt"  }
   score_types = ['iptm', 'actifptm', 'ptm', 'ranking_score', 'mean_plddt' ]
@@ -1146,17 +1205,17 @@ def af3_move_and_rename(df, output_dir):
 
     model_cif_name = os.path.join(original_dir, f'{prefix}_model.cif')
     new_cif_name = os.path.join(os.path.dirname(original_dir), pred["ranked_name"])
-    cp(model_cif_name, new_cif_name)
+    place_file(model_cif_name, new_cif_name, link_mode)
 
     path_to_confidence = os.path.join(os.path.dirname(original_dir), "confidences")
     if not os.path.exists(path_to_confidence):
       os.makedirs(path_to_confidence)
     model_confidence_file = os.path.join(original_dir, f'{prefix}_summary_confidences.json')
     new_confidence_file = os.path.join(os.path.dirname(original_dir), "confidences", f'{pred["prediction_name"]}.json')
-    cp(model_confidence_file, new_confidence_file)
+    place_file(model_confidence_file, new_confidence_file, link_mode)
 
     model_no_rank = os.path.join(os.path.dirname(original_dir), '_'.join(os.path.basename(new_cif_name).split('_')[2:]))
-    cp(new_cif_name, model_no_rank)
+    place_file(new_cif_name, model_no_rank, kept_source_mode(link_mode))
     for stype in score_types:
       all_scores[score_map[stype]][stype][pred["prediction_name"]] = pred[stype]
       all_scores[score_map[stype]]["order"].append(pred["prediction_name"])
@@ -1166,6 +1225,8 @@ def af3_move_and_rename(df, output_dir):
     json.dump(all_scores[score_ranking], open(ranking_file, 'w'), indent=4)
 
 def af3_extract_plddts_create_pkl(df, output_dir):
+  import numpy as np
+  import pandas as pd
   pred_list = df.to_dict(orient="records")
   for pred in pred_list:
     original_dir = pred["original_dir"]
@@ -1223,14 +1284,15 @@ def main():
   elif conversion == 'output':
     assert batches_file, 'Json batches file (--batches_file) is mandatory for output conversion (--conversion output)'
     print(f"Convert for tool {tool}")
-    convert_output(tool, batches_file, to_convert)
+    convert_output(
+      tool, batches_file, to_convert, None if args.batch_id is None else [args.batch_id], args.link_mode)
 
   elif conversion == "output_singular":
     if tool == "ColabFold":
-      convert_colabfold_output(to_convert, 0, to_convert)
-      move_output(os.path.dirname(os.path.realpath(to_convert)), "batch_0")
+      convert_colabfold_output(to_convert, 0, to_convert, args.link_mode)
+      move_output(os.path.dirname(os.path.realpath(to_convert)), "batch_0", args.link_mode)
     elif tool == "AlphaFold3":
-      convert_alphafold3_output(to_convert, 0)
+      convert_alphafold3_output(to_convert, 0, args.link_mode)
     elif tool == "AFmassive":
       convert_afmassive_output(to_convert)
 
@@ -4,3 +4,4 @@ from .run import run_pipeline
 from .multirun import multirun_pipeline
 from .screen import screening_pipeline
 from .ppi import ppi_pipeline
+from .retry import retry_pipeline
@@ -19,6 +19,13 @@ def run_item_args(args, run_name, run_args, parameters_file):
     "calibrate",
     "calibration_from",
     "wall_time",
+    "pack",
+    "dynamic_tasks",
+    "stop_score",
+    "stop_count",
+    "stop_patience",
+    "incremental_post_treatment",
+    "link_mode",
     "msas_precomputed",
     "top_n_model",
     "recompute_msas",
@@ -39,6 +46,13 @@ def run_item_args(args, run_name, run_args, parameters_file):
     calibrate=run_args.get("calibrate", False),
     calibration_from=run_args.get("calibration_from", None),
     wall_time=run_args.get("wall_time", 20),
+    pack=run_args.get("pack", False),
+    dynamic_tasks=run_args.get("dynamic_tasks", None),
+    stop_score=run_args.get("stop_score", None),
+    stop_count=run_args.get("stop_count", 1),
+    stop_patience=run_args.get("stop_patience", None),
+    incremental_post_treatment=run_args.get("incremental_post_treatment", False),
+    link_mode=run_args.get("link_mode", None),
     msas_precomputed=run_args.get("msas_precomputed", None),
     top_n_model=run_args.get("top_n_model", None),
     recompute_msas=run_args.get("recompute_msas", False),
@@ -53,12 +67,16 @@ def submit_job_with_alignment_capture(
   job_name=None,
   dependency_id=None,
   array_size=None,
+  task_ids=None,
+  array_throttle=None,
 ):
   job_id = submit_job(
     jobfile_content,
     job_name=job_name,
     dependency_id=dependency_id,
     array_size=array_size,
+    task_ids=task_ids,
+    array_throttle=array_throttle,
   )
   if job_name == expected_name:
     captured["alignment_id"] = job_id
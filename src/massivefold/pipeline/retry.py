@@ -0,0 +1,206 @@
+"""Implementation of `massivefold retry`: resubmit the failed tasks of a run's job array."""
+
+import glob
+import json
+import os
+import re
+import shutil
+
+from .run import array_throttle_from_params
+from .run import build_jobfile
+from .run import copy_batches_file
+from .run import detect_tool_code
+from .run import dynamic_jobarray_jobfile
+from .run import move_generated_files_to_logs
+from .run import record_run_job
+from .run import recorded_run_job
+from .run import sequence_name_from_path
+from .run import submit_scheduler_job
+from .run import tool_from_code
+from massivefold.parallelization import batching
+from massivefold.parallelization import claim_batch
+from massivefold.parallelization import early_stop
+from massivefold.parallelization import unifier
+from massivefold.scheduling.base import ACTIVE_STATES
+
+# written by slurmstepd in the task's output when the walltime is reached
+TIMEOUT_MARKER = "DUE TO TIME LIMIT"
+
+def batch_output_dir(tool, output_run_dir, batch_id):
+  if tool == "AlphaFold3":
+    batch_input = json.load(open(os.path.join(output_run_dir, f"af3_batch_{batch_id}.json"), 'r'))
+    return os.path.join(output_run_dir, batch_input["name"])
+  return os.path.join(output_run_dir, f"batch_{batch_id}")
+
+def batch_is_complete(tool, output_run_dir, sequence_name, batch_id):
+  batch_dir = batch_output_dir(tool, output_run_dir, batch_id)
+  if tool == "AFmassive":
+    return os.path.isfile(os.path.join(batch_dir, sequence_name, "ranking_debug.json"))
+  if tool == "ColabFold":
+    return bool(glob.glob(os.path.join(batch_dir, "*.done.txt")))
+  return os.path.isfile(os.path.join(batch_dir, f"{os.path.basename(batch_dir)}_ranking_scores.csv"))
+
+def task_logs(logs_run_dir, batch_id):
+  log_files = [os.path.join(logs_run_dir, f"jobarray_{batch_id}.log")]
+  # SLURM writes its own messages for the tasks of arrays submitted with an offset (see slurm.offset_jobfile)
+  for log_file in glob.glob(os.path.join(logs_run_dir, "jobarray_offset*_*.log")):
+    match = re.match(r"jobarray_offset(\d+)_(\d+)\.log$", os.path.basename(log_file))
+    if match and int(match.group(1)) + int(match.group(2)) == int(batch_id):
+      log_files.append(log_file)
+  return [log_file for log_file in log_files if os.path.isfile(log_file)]
+
+def task_timed_out(logs_run_dir, batch_id):
+  for log_file in task_logs(logs_run_dir, batch_id):
+    with open(log_file, "r", encoding="utf-8", errors="replace") as handle:
+      if any(TIMEOUT_MARKER in line for line in handle):
+        return True
+  return False
+
+def set_aside_failed_outputs(tool, output_run_dir, logs_run_dir, batch_id, attempt):
+  # keep what the failed attempt produced out of the way of the unifier, without deleting it
+  attempt_dir = os.path.join(output_run_dir, "failed_attempts", f"attempt_{attempt}")
+  batch_dir = batch_output_dir(tool, output_run_dir, batch_id)
+  if os.path.exists(batch_dir):
+    os.makedirs(attempt_dir, exist_ok=True)
+    shutil.move(batch_dir, os.path.join(attempt_dir, os.path.basename(batch_dir)))
+  for log_file in task_logs(logs_run_dir, batch_id):
+    os.replace(log_file, f"{log_file}.attempt{attempt}")
+
+def previous_array_is_active(scheduler, logs_run_dir, sequence_name, run_name):
+  # the batches of a job array still queued or running have no output yet but did not fail
+  previous = recorded_run_job(logs_run_dir, sequence_name, run_name, "jobarray", scheduler)
+  if previous is None:
+    return False
+  states = scheduler["job_status"]([previous["id"]])
+  return any(state in ACTIVE_STATES for state in states.values())
+
+def cancel_previous_post_treatment(scheduler, logs_run_dir, sequence_name, run_name):
+  # with SLURM, the post treatment of the previous attempt waits for a job array that failed and never starts
+  previous = recorded_run_job(logs_run_dir, sequence_name, run_name, "post_treatment", scheduler)
+  if previous is None:
+    return
+  try:
+    state = scheduler["job_status"]([previous["id"]]).get(previous["id"])
+    # a running post treatment is left to end, only a pending one waits for the failed job array
+    if state == "PENDING":
+      scheduler["cancel"]([previous["id"]])
+      print(f"Cancelled the post treatment {previous['id']} of the previous attempt")
+  except RuntimeError as error:
+    print(f"The post treatment {previous['id']} of the previous attempt can not be cancelled ({error}), cancel it if it"
+          f" is still pending.")
+
+def retry_pipeline_internal(args, forwarded_args, scheduler):
+  if forwarded_args:
+    print("Ignoring extra arguments:", " ".join(forwarded_args))
+
+  sequence_name = sequence_name_from_path(args.sequence)
+  run_name = args.run_name
+  if not os.path.isfile(args.parameters):
+    print(f"Parameter file '{args.parameters}' not found, exiting.")
+    return 1
+  massivefold_params = json.load(open(args.parameters, 'r')).get("massivefold", {})
+  output_dir = massivefold_params.get("output_dir")
+  logs_dir = massivefold_params.get("logs_dir")
+  if not output_dir or not logs_dir:
+    print("Missing one of massivefold.output_dir|logs_dir in parameter file, exiting.")
+    return 1
+  array_throttle = array_throttle_from_params(massivefold_params)
+
+  tool = tool_from_code(detect_tool_code(args.parameters))
+  logs_run_dir = os.path.join(logs_dir, sequence_name, run_name)
+  output_run_dir = os.path.join(output_dir, sequence_name, run_name)
+  parameters_file = os.path.join(logs_run_dir, f"params_{tool}.json")
+  batches_file = f"{sequence_name}_{run_name}_batches.json"
+  if not os.path.isfile(os.path.join(logs_run_dir, batches_file)):
+    print(f"No batches file for run {run_name} of {sequence_name} in {logs_run_dir}, exiting.")
+    return 1
+  if os.path.isfile(os.path.join(output_run_dir, "ranking_debug.json")):
+    print(f"Run {run_name} of {sequence_name} is already post-treated, nothing to retry.")
+    return 0
+  if previous_array_is_active(scheduler, logs_run_dir, sequence_name, run_name):
+    print(f"The job array of {run_name} is still pending or running, retry once it ended.")
+    return 1
+
+  with open(os.path.join(logs_run_dir, batches_file), "r", encoding="utf-8") as handle:
+    batches = json.load(handle)
+  failed = [
+    batch_id for batch_id in batches
+    if not batch_is_complete(tool, output_run_dir, sequence_name, batch_id)
+  ]
+  if failed and early_stop.stop_reached(early_stop.condition_path(logs_run_dir, sequence_name, run_name)):
+    print(f"The stop condition of {run_name} was reached, the {len(failed)} batches without output are not resubmitted.")
+    failed = []
+  if not failed:
+    print(f"All {len(batches)} batches of {run_name} are complete, only the post treatment is resubmitted.")
+
+  attempts_file = os.path.join(logs_run_dir, "retry_attempts.json")
+  attempts = json.load(open(attempts_file, 'r')) if os.path.isfile(attempts_file) else {}
+  exhausted = [batch_id for batch_id in failed if attempts.get(batch_id, 1) >= args.max_batch_attempts]
+  if exhausted:
+    print(f"Batches {', '.join(exhausted)} already ran {args.max_batch_attempts} times, exiting.")
+    return 1
+
+  to_resubmit = []
+  for batch_id in failed:
+    attempt = attempts.get(batch_id, 1)
+    timed_out = task_timed_out(logs_run_dir, batch_id)
+    set_aside_failed_outputs(tool, output_run_dir, logs_run_dir, batch_id, attempt)
+    new_ids = []
+    if timed_out and args.split > 1 and "id" not in batches[batch_id]:
+      new_ids = batching.split_batch(batches, batch_id, args.split)
+      if tool == "AlphaFold3":
+        unifier.af3_split_batch_input(output_run_dir, batch_id, new_ids, batches)
+      print(f"Batch {batch_id} reached the walltime, split into batches {', '.join([batch_id] + new_ids)}")
+    elif timed_out:
+      print(f"Batch {batch_id} reached the walltime")
+    for batch in [batch_id] + new_ids:
+      attempts[batch] = attempt + 1
+      to_resubmit.append(batch)
+
+  batching.write_batches(batches, batches_file)
+  # the tasks may start before the generated files are moved to the logs
+  copy_batches_file(batches_file, logs_run_dir)
+  with open(attempts_file, "w", encoding="utf-8") as json_output:
+    json.dump(attempts, json_output, indent=4)
+
+  array_id = None
+  if to_resubmit:
+    print(f"Resubmitting batches {', '.join(to_resubmit)} of {run_name}")
+    jobarray_jobfile_content = build_jobfile("jobarray", sequence_name, run_name, parameters_file, tool)
+    array_size, task_ids = len(batches), [int(batch_id) for batch_id in to_resubmit]
+    queue_file = claim_batch.queue_path(logs_run_dir, sequence_name, run_name)
+    if os.path.isfile(queue_file):
+      # run with --dynamic_tasks: the failed batches go back to the queue for a new job array
+      task_number = claim_batch.requeue(queue_file, to_resubmit, batches)
+      jobarray_jobfile_content = dynamic_jobarray_jobfile(
+        jobarray_jobfile_content, logs_run_dir, sequence_name, run_name, queue_file
+      )
+      array_size, task_ids = min(task_number, len(to_resubmit)), None
+    array_id = submit_scheduler_job(
+      scheduler,
+      jobarray_jobfile_content,
+      f"inference-{sequence_name}_{run_name}-{tool}",
+      array_size=array_size,
+      task_ids=task_ids,
+      array_throttle=array_throttle,
+    )
+    record_run_job(logs_run_dir, sequence_name, run_name, "jobarray", scheduler, array_id)
+
+  post_treatment_jobfile_content = build_jobfile("post_treatment", sequence_name, run_name, parameters_file, tool)
+  post_treatment_jobfile_name = f"post_treatment-{sequence_name}_{run_name}-{tool}"
+  cancel_previous_post_treatment(scheduler, logs_run_dir, sequence_name, run_name)
+  post_treatment_id = submit_scheduler_job(
+    scheduler, post_treatment_jobfile_content, post_treatment_jobfile_name, dependency_id=array_id
+  )
+  record_run_job(logs_run_dir, sequence_name, run_name, "post_treatment", scheduler, post_treatment_id)
+
+  move_generated_files_to_logs(sequence_name, run_name, logs_run_dir)
+  return 0
+
+def retry_pipeline(args, forwarded_args, scheduler):
+  try:
+    return retry_pipeline_internal(args, forwarded_args, scheduler)
+  except RuntimeError as error:
+    print(error)
+    print("Exiting.")
+    return 1
@@ -1,14 +1,17 @@
 """Shared implementation of `massivefold run` pipeline."""
 
 import os
-import re
 import glob
 import json
-import math
 import shutil
 from massivefold.parallelization import unifier
 from massivefold.parallelization import batching
+from massivefold.parallelization import claim_batch
 from massivefold.parallelization import create_jobfile
+from massivefold.parallelization import early_stop
+from massivefold.parallelization import organize_outputs
+from massivefold.parallelization.link_files import LINK_MODES
+from massivefold.pipeline import timings
 
 def detect_tool_code(parameters_file):
   data = json.load(open(parameters_file, 'r'))
@@ -53,61 +56,17 @@ def next_run_name(output_dir, sequence_name, run_name, force_name=False):
   print(f"Current run is {candidate}.\n")
   return candidate
 
-def extract_predict_times(log_dir):
-  predict_times = []
-  for log_file in glob.glob(os.path.join(log_dir, "jobarray_*")):
-    if not os.path.isfile(log_file):
-      continue
-    with open(log_file, "r", encoding="utf-8") as handle:
-      for line in handle:
-        if "predict time" not in line:
-          continue
-        match = re.search(r"([0-9]*\.?[0-9]+)s\b", line)
-        if match:
-          predict_times.append(float(match.group(1)))
-  return predict_times
-
-def calibrated_batch_size_from_run(log_dir, wall_time, add_excess=0.1):
-  predict_times = extract_predict_times(log_dir)
-  if not predict_times:
-    return None
-  single_pred_time = math.ceil(max(predict_times))
-  safe_time = math.floor(single_pred_time + (single_pred_time * add_excess))
-  if safe_time <= 0:
-    return None
-  wall_time_seconds = wall_time * 60 * 60
-  return math.floor(wall_time_seconds / safe_time)
-
-def find_calibrated_batch_size(logs_dir, sequence_name, wall_time):
-  sequence_logs_dir = os.path.join(logs_dir, sequence_name)
-  if not os.path.isdir(sequence_logs_dir):
-    return None
-
-  all_runs = [
-    os.path.join(sequence_logs_dir, item)
-    for item in os.listdir(sequence_logs_dir)
-    if os.path.isdir(os.path.join(sequence_logs_dir, item))
-  ]
-  if not all_runs:
-    return None
-
-  print(f"Searching for a completed preliminary run for {sequence_name}")
-  lowest_pred_nb = None
-  for run in all_runs:
-    pred_nb = calibrated_batch_size_from_run(run, wall_time)
-    if pred_nb is None:
-      continue
-    if lowest_pred_nb is None:
-      lowest_pred_nb = pred_nb
-      print(f"Found first batch size candidate: {lowest_pred_nb} at {run}")
-    elif pred_nb <= lowest_pred_nb:
-      lowest_pred_nb = pred_nb
-      print(f"Found new batch size candidate: {lowest_pred_nb} at {run}")
-
-  return lowest_pred_nb
-
-def batch_size_from_specific_run(calibration_path, wall_time):
-  return calibrated_batch_size_from_run(calibration_path, wall_time)
+def calibrated_prediction_times(logs_dir, sequence_file, sequence_name, tool, parameters, calibration_path=None):
+  # the logs of the previous runs are added to the prediction time store of logs_dir, then read from it
+  run_dirs = [calibration_path] if calibration_path else timings.all_run_dirs(logs_dir)
+  store = timings.update_store(logs_dir, run_dirs)
+  length = timings.sequence_length(sequence_file) if sequence_file.endswith(".fasta") else None
+  recycles = timings.recycles_setting(tool, parameters)
+  # the alignments of the sequence are only there when they were computed by a previous run
+  depth = timings.sequence_msa_depth(parameters.get("massivefold", {}).get("output_dir"), sequence_name)
+  return timings.estimate_prediction_times(
+    store, tool, sequence_name, length, recycles, run_dir=calibration_path, depth=depth
+  )
 
 def models_from_run(path_to_run, top_n=5):
   ranking_debug = os.path.join(path_to_run, "ranking_debug.json")
@@ -133,7 +92,8 @@ def copy_inputs(sequence_file, parameters_file, logs_run_dir, tool):
 
 def copy_batches_file(batches_file, logs_run_dir):
   os.makedirs(logs_run_dir, exist_ok=True)
-  shutil.copy2(batches_file, logs_run_dir)
+  for path in [batches_file] + batching.manifest_files(batches_file):
+    shutil.copy2(path, logs_run_dir)
 
 def detect_precomputed_msas(tool, output_dir, sequence_name):
   if tool == "AFmassive":
@@ -214,7 +174,10 @@ def create_batches_file(
   batch_size,
   models_to_use,
   tool,
-  to_screen=""
+  to_screen="",
+  prediction_times=None,
+  wall_time=None,
+  batch_sizes=None
 ):
 
   all_params = json.load(open(parameters_file, 'r'))
@@ -252,16 +215,20 @@ def create_batches_file(
   print(f"Running {predictions_per_model} predictions on each of the {len(model_names)} models")
   print(f"Total prediction number: {predictions_per_model * len(model_names)}")
 
-  if not to_screen:
+  if prediction_times:
+    all_model_batches = batching.pack_batches(predictions_per_model, model_names, prediction_times, wall_time)
+    print(f"Predictions packed in {len(all_model_batches)} batches of at most {wall_time} hours")
+  elif not to_screen:
+    sizes = batching.model_batch_sizes(batch_size, batch_sizes or {}, model_names)
+    if len(set(sizes.values())) > 1:
+      print(f"Batch size per model: {', '.join(f'{model} {size}' for model, size in sizes.items())}")
+      batch_size = sizes
     per_model_batches = batching.batches_per_model(predictions_per_model, batch_size)
     all_model_batches = batching.batches_all_models(per_model_batches, model_names)
   else:
     all_model_batches = batching.batches_per_ligand(to_screen, predictions_per_model)
 
-  batches_file = f"{sequence_name}_{run_name}_batches.json"
-  with open(batches_file, "w", encoding="utf-8") as json_output:
-    json.dump(all_model_batches, json_output, indent=4)
-  return batches_file
+  return batching.write_batches(all_model_batches, f"{sequence_name}_{run_name}_batches.json")
 
 def build_jobfile(
   job_type,
@@ -294,6 +261,7 @@ def build_jobfile(
   all_params[f"{tool_code}_run"] = preset_dict | all_params[f"{tool_code}_run"]
 
   run_params.update(all_params["massivefold"])
+  run_params.setdefault("link_mode", "copy")
   run_params.update(all_params["custom_params"])
   run_params.update(all_params[f"{tool_code}_run"])
   run_params.update(all_params["plots"])
@@ -336,6 +304,43 @@ def build_jobfile(
     run_name,
   )
 
+def dynamic_jobarray_jobfile(jobarray_jobfile_content, logs_run_dir, sequence_name, run_name, queue_file):
+  # each task of the job array runs the batches it claims from the queue, the batch script is the usual
+  # jobarray jobfile with the claimed batch id as task id
+  logs_run_dir = os.path.abspath(logs_run_dir)
+  batch_script = os.path.join(logs_run_dir, f"{sequence_name}_{run_name}_jobarray_batch.sh")
+  early_stop_file = early_stop.condition_path(logs_run_dir, sequence_name, run_name)
+  with open(batch_script, "w", encoding="utf-8") as handle:
+    handle.write(jobarray_jobfile_content)
+
+  lines = jobarray_jobfile_content.splitlines()
+  header_end = next(
+    (index for index, line in enumerate(lines) if line.strip() and not line.startswith("#")),
+    len(lines),
+  )
+  # the batches write their own jobarray_<batch>.log, keep the logs of the tasks apart
+  header = [line.replace("jobarray_%a", "dynamic_task_%a") for line in lines[:header_end]]
+  return "\n".join(header + [
+    "",
+    f'queue_file="{os.path.abspath(queue_file)}"',
+    f'batch_script="{batch_script}"',
+    f'early_stop_file="{early_stop_file}"',
+    "status=0",
+    "while true; do",
+    '  batch_id=$(claim_batch --queue "$queue_file" --task "$SLURM_ARRAY_TASK_ID" --early_stop "$early_stop_file")',
+    "  claim_status=$?",
+    "  [ $claim_status -eq 0 ] || break",
+    f'  SLURM_ARRAY_TASK_ID=$batch_id bash "$batch_script" > "{logs_run_dir}/jobarray_$batch_id.log" 2>&1',
+    "  batch_status=$?",
+    '  claim_batch --queue "$queue_file" --done "$batch_id" --exit_code $batch_status',
+    "  [ $batch_status -eq 0 ] || status=1",
+    "done",
+    "# batches that no task could run in its wall time are left",
+    "[ $claim_status -eq 2 ] && status=1",
+    "exit $status",
+    "",
+  ])
+
 def convert_input_if_needed(sequence_file, parameters_file, tool):
   if tool not in ["ColabFold", "AlphaFold3"]:
     return
@@ -355,8 +360,69 @@ def move_generated_files_to_logs(sequence_name, run_name, logs_run_dir):
         os.remove(target)
     shutil.move(path, logs_run_dir)
 
-def submit_scheduler_job(scheduler, jobfile_content, jobfile_name, dependency_id=None, array_size=None):
-  return scheduler["submit_job"](jobfile_content, job_name=jobfile_name, dependency_id=dependency_id, array_size=array_size)
+def run_job_path(logs_run_dir, sequence_name, run_name, job):
+  return os.path.join(logs_run_dir, f"{sequence_name}_{run_name}_{job}_job.json")
+
+def record_run_job(logs_run_dir, sequence_name, run_name, job, scheduler, job_id):
+  # read by massivefold retry, which checks the job array and cancels the post treatment it replaces
+  if job_id is None:
+    return
+  os.makedirs(logs_run_dir, exist_ok=True)
+  with open(run_job_path(logs_run_dir, sequence_name, run_name, job), "w", encoding="utf-8") as json_output:
+    json.dump({"scheduler": scheduler["name"], "id": job_id}, json_output, indent=4)
+
+def recorded_run_job(logs_run_dir, sequence_name, run_name, job, scheduler):
+  job_file = run_job_path(logs_run_dir, sequence_name, run_name, job)
+  if not os.path.isfile(job_file):
+    return None
+  recorded = json.load(open(job_file, 'r'))
+  # the ids of another scheduler mean nothing to this one
+  return recorded if recorded["scheduler"] == scheduler["name"] else None
+
+def array_throttle_from_params(massivefold_params):
+  # optional "array_throttle" of the massivefold section: maximum number of tasks of a job array running at once
+  value = massivefold_params.get("array_throttle", "")
+  if value in ["", None]:
+    return None
+  try:
+    array_throttle = int(value)
+  except (TypeError, ValueError):
+    raise RuntimeError(f"massivefold.array_throttle should be a number of tasks, not '{value}'")
+  if array_throttle < 1:
+    raise RuntimeError(f"massivefold.array_throttle should be at least 1 (got {array_throttle})")
+  return array_throttle
+
+def link_mode_from_params(massivefold_params):
+  # optional "link_mode" of the massivefold section: how the post treatment places the outputs of the batches
+  link_mode = massivefold_params.get("link_mode", "copy")
+  if link_mode not in LINK_MODES:
+    raise RuntimeError(f"massivefold.link_mode should be one of {', '.join(LINK_MODES)}, not '{link_mode}'")
+  return link_mode
+
+def batch_sizes_from_params(massivefold_params):
+  # optional "batch_sizes" of the massivefold section, e.g. "multimer_v1:10,multimer_v3:20"
+  try:
+    return batching.parse_batch_sizes(massivefold_params.get("batch_sizes", ""))
+  except ValueError as error:
+    raise RuntimeError(f"massivefold.batch_sizes: {error}")
+
+def submit_scheduler_job(
+  scheduler,
+  jobfile_content,
+  jobfile_name,
+  dependency_id=None,
+  array_size=None,
+  task_ids=None,
+  array_throttle=None,
+):
+  return scheduler["submit_job"](
+    jobfile_content,
+    job_name=jobfile_name,
+    dependency_id=dependency_id,
+    array_size=array_size,
+    task_ids=task_ids,
+    array_throttle=array_throttle,
+  )
 
 def run_pipeline_internal(args, forwarded_args, scheduler):
   if forwarded_args:
@@ -376,6 +442,11 @@ def run_pipeline_internal(args, forwarded_args, scheduler):
   force_msas_computation = args.recompute_msas or args.only_msas
   wait_for_jobid = args.jobid
   use_user_request_file = getattr(args, "use_user_request_file", False)
+  dynamic_tasks = getattr(args, "dynamic_tasks", None)
+  stop_score = getattr(args, "stop_score", None)
+  stop_count = getattr(args, "stop_count", 1)
+  stop_patience = getattr(args, "stop_patience", None)
+  link_mode = getattr(args, "link_mode", None)
 
   if not os.path.isfile(sequence_file):
     sequence_name = sequence_name_from_path(sequence_file)
@@ -402,6 +473,17 @@ def run_pipeline_internal(args, forwarded_args, scheduler):
   if not output_dir or not logs_dir:
     print("Missing one of massivefold.output_dir|logs_dir in parameter file, exiting.")
     return 1
+  array_throttle = array_throttle_from_params(massivefold_params)
+  batch_sizes = batch_sizes_from_params(massivefold_params)
+  if link_mode is not None:
+    massivefold_params["link_mode"] = link_mode
+  link_mode_from_params(massivefold_params)
+  if dynamic_tasks is not None and dynamic_tasks < 1:
+    print("--dynamic_tasks should be a positive number of tasks, exiting.")
+    return 1
+  if stop_count < 1 or (stop_patience is not None and stop_patience < 1):
+    print("--stop_count and --stop_patience should be positive numbers, exiting.")
+    return 1
 
   sequence_name = sequence_name_from_path(sequence_file)
   run_name = next_run_name(output_dir, sequence_name, run_name, force_name=use_user_request_file)
@@ -414,25 +496,33 @@ def run_pipeline_internal(args, forwarded_args, scheduler):
   elif calibration_path and not os.path.isdir(calibration_path):
     print(f"{calibration_path} does not exist, exiting.")
     return 1
-  elif calibration:
+  elif calibration or calibration_path:
     print("Calibrating this run's batch size.")
-    lowest_pred_nb = find_calibrated_batch_size(logs_dir, sequence_name, wall_time)
-    if lowest_pred_nb is None:
-      print(f"No preliminary run completed for {sequence_name}, exiting.")
+    calibrated_times = calibrated_prediction_times(
+      logs_dir, sequence_file, sequence_name, tool, parameters, calibration_path=calibration_path)
+    if not calibrated_times:
+      print(f"No prediction time of {tool} found in the logs of {calibration_path or logs_dir}, exiting.")
       return 1
-    batch_size = lowest_pred_nb
-  elif calibration_path:
-    print("Calibrating this run's batch size.")
-    calibrated = batch_size_from_specific_run(calibration_path, wall_time)
-    if calibrated is not None:
-      batch_size = calibrated
+    print(f"Prediction times per model: {', '.join(f'{model} {time}s' for model, time in calibrated_times.items())}")
 
-  if calibration or calibration_path:
-    print(f"Number of prediction under wall time: {batch_size}")
-    if batch_size > predictions_per_model:
-      batch_size = predictions_per_model
-      print(f"Adapting batch size according to -p {predictions_per_model}")
-    print(f"Calibrated batch size: {batch_size}\n")
+  prediction_times = None
+
+  if getattr(args, "pack", False):
+    if tool != "AFmassive":
+      print("--pack is only available with AFmassive, which runs several models in a batch, exiting.")
+      return 1
+    if not calibration and not calibration_path:
+      print("--pack uses the prediction times of previous runs, use it with -c or -C, exiting.")
+      return 1
+    prediction_times = calibrated_times
+  elif calibration or calibration_path:
+    batch_sizes = timings.batch_sizes(calibrated_times, wall_time)
+    print(f"Number of predictions under wall time per model: "
+          f"{', '.join(f'{model} {size}' for model, size in batch_sizes.items())}")
+    batch_sizes = {model: min(size, predictions_per_model) for model, size in batch_sizes.items()}
+    # the models without prediction time use the batch size of the slowest one
+    batch_size = min(batch_sizes.values())
+    print(f"Calibrated batch size: {batch_size} for the slowest model, at most -p {predictions_per_model}\n")
 
   models_to_use = ""
   if path_to_run:
@@ -450,6 +540,10 @@ def run_pipeline_internal(args, forwarded_args, scheduler):
 
   logs_run_dir = os.path.join(logs_dir, sequence_name, run_name)
   new_param_path = copy_inputs(sequence_file, temp_parameters_file, logs_run_dir, tool)
+  if link_mode is not None:
+    # the jobfiles of the run, and of its retries, are created from this copy of the parameters
+    with open(new_param_path, "w", encoding="utf-8") as handle:
+      json.dump(parameters, handle, indent=4)
   args.parameters = new_param_path
   parameters_file = args.parameters
 
@@ -461,6 +555,9 @@ def run_pipeline_internal(args, forwarded_args, scheduler):
     batch_size,
     models_to_use,
     tool,
+    prediction_times=prediction_times,
+    wall_time=wall_time,
+    batch_sizes=batch_sizes,
   )
   copy_batches_file(batches_file, logs_run_dir)
 
@@ -544,6 +641,22 @@ def run_pipeline_internal(args, forwarded_args, scheduler):
   )
 
   array_size = count_batches(batches_file)
+  if stop_score is not None or stop_patience:
+    early_stop_file = early_stop.condition_path(logs_run_dir, sequence_name, run_name)
+    early_stop.create_condition(early_stop_file, stop_score, stop_count, stop_patience)
+    print(f"The remaining batches are skipped once the stop condition {early_stop_file} is reached")
+  if getattr(args, "incremental_post_treatment", False):
+    organize_outputs.create_incremental_state(os.path.join(output_dir, sequence_name, run_name))
+    print("Each batch is post treated as soon as it ends")
+  if dynamic_tasks:
+    queue_file = claim_batch.queue_path(logs_run_dir, sequence_name, run_name)
+    with open(batches_file, "r", encoding="utf-8") as handle:
+      claim_batch.create_queue(json.load(handle), queue_file, wall_time, dynamic_tasks)
+    jobarray_jobfile_content = dynamic_jobarray_jobfile(
+      jobarray_jobfile_content, logs_run_dir, sequence_name, run_name, queue_file
+    )
+    print(f"{dynamic_tasks} tasks run the {array_size} batches from the prediction queue {queue_file}")
+    array_size = min(dynamic_tasks, array_size)
   dependency = alignment_id if waiting_for_alignment else None
   inference_jobfile_name = f"inference-{sequence_name}_{run_name}-{tool}"
   array_id = submit_scheduler_job(
@@ -552,11 +665,16 @@ def run_pipeline_internal(args, forwarded_args, scheduler):
     inference_jobfile_name,
     dependency_id=dependency,
     array_size=array_size,
+    array_throttle=array_throttle,
   )
+  record_run_job(logs_run_dir, sequence_name, run_name, "jobarray", scheduler, array_id)
 
   post_treatment_jobfile_content = build_jobfile("post_treatment", sequence_name, run_name, parameters_file, tool)
   post_treatment_jobfile_name = f"post_treatment-{sequence_name}_{run_name}-{tool}"
-  submit_scheduler_job(scheduler, post_treatment_jobfile_content, post_treatment_jobfile_name, dependency_id=array_id)
+  post_treatment_id = submit_scheduler_job(
+    scheduler, post_treatment_jobfile_content, post_treatment_jobfile_name, dependency_id=array_id
+  )
+  record_run_job(logs_run_dir, sequence_name, run_name, "post_treatment", scheduler, post_treatment_id)
 
   move_generated_files_to_logs(sequence_name, run_name, logs_run_dir)
   return 0
@@ -5,6 +5,7 @@ import shutil
 import json
 
 from .run import alignment_is_needed
+from .run import array_throttle_from_params
 from .run import bool_arg
 from .run import copy_batches_file
 from .run import copy_inputs
@@ -58,6 +59,7 @@ def run_screening_pipeline_internal(args, forwarded_args, scheduler):
   if not output_dir or not logs_dir:
     print("Missing one of massivefold.output_dir|logs_dir in parameter file, exiting.")
     return 1
+  array_throttle = array_throttle_from_params(massivefold_params)
 
   sequence_name = sequence_name_from_path(sequence_file)
   run_name = os.path.splitext(os.path.basename(ligands_file))[0]
@@ -166,6 +168,7 @@ def run_screening_pipeline_internal(args, forwarded_args, scheduler):
     jobfile_name=inference_jobfile_name,
     dependency_id=dependency,
     array_size=array_size,
+    array_throttle=array_throttle,
   )
 
   post_treatment_jobfile_content = build_jobfile("post_treatment", sequence_name, run_name, parameters_file, tool)
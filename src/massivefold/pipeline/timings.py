@@ -0,0 +1,233 @@
+"""Store of the prediction times of the previous runs, used to calibrate the batches of `massivefold run`."""
+
+import argparse
+import glob
+import json
+import math
+import os
+import re
+import sys
+
+from massivefold.utils import queue_lock
+from massivefold.utils import read_json
+from massivefold.utils import write_json
+
+TIMINGS_FILE = "prediction_times.json"
+# parameter of the number of recycles for each tool, prediction times are only compared at equal settings
+RECYCLES_PARAMETER = {"AFmassive": ("AFM_run", "max_recycles"), "ColabFold": ("CF_run", "num_recycle")}
+# "Total JAX model model_1_ptm_pred_0 on H1140 predict time (includes compilation time, see --benchmark): 63.2s"
+PREDICT_TIME = re.compile(r"model (\S+?)_pred_(\d+)\b.*predict time.*?([0-9]*\.?[0-9]+)s\b")
+DEFAULT_QUANTILE = 0.9
+
+parser = argparse.ArgumentParser(
+  description="Add the prediction times of a finished batch to the store of its logs directory (massivefold run -c).")
+parser.add_argument('--run_dir', required=True, help='Logs directory of the run, <logs_dir>/<sequence>/<run>.')
+parser.add_argument('--batch_id', required=True, help='Batch whose jobarray_<batch_id>.log is read.')
+
+def empty_store():
+  # runs: run directories whose batches add their own prediction times, their logs are not scanned again
+  return {"logs": {}, "sequences": {}, "predictions": [], "runs": []}
+
+def load_store(logs_dir):
+  path = os.path.join(logs_dir, TIMINGS_FILE)
+  store = read_json(path) if os.path.isfile(path) else empty_store()
+  # stores written before the batches recorded their times
+  store.setdefault("runs", [])
+  return store
+
+def sequence_length(fasta_file):
+  length = 0
+  with open(fasta_file, "r", encoding="utf-8") as handle:
+    for line in handle:
+      if not line.startswith(">"):
+        length += len(line.strip())
+  return length
+
+def msa_depth(msas_dir):
+  # number of sequences of the a3m alignments, the stockholm ones are too large to be read for each run
+  depth = 0
+  for a3m_file in glob.glob(os.path.join(msas_dir, "**", "*.a3m"), recursive=True):
+    with open(a3m_file, "r", encoding="utf-8", errors="replace") as handle:
+      depth += sum(1 for line in handle if line.startswith(">"))
+  return depth or None
+
+def sequence_msa_depth(output_dir, sequence_name):
+  msas_dir = os.path.join(output_dir or "", sequence_name, "msas")
+  return msa_depth(msas_dir) if output_dir and os.path.isdir(msas_dir) else None
+
+def recycles_setting(tool, parameters):
+  section, key = RECYCLES_PARAMETER.get(tool, (None, None))
+  return parameters.get(section, {}).get(key) if section else None
+
+def run_settings(run_dir):
+  # tool and number of recycles from the parameters copied in the logs of the run
+  parameter_files = glob.glob(os.path.join(run_dir, "params_*.json"))
+  if not parameter_files:
+    return None, None, None
+  tool = os.path.basename(parameter_files[0])[len("params_"):-len(".json")]
+  parameters = json.load(open(parameter_files[0], "r"))
+  return tool, recycles_setting(tool, parameters), parameters.get("massivefold", {}).get("output_dir")
+
+def sequence_features(store, sequence_name, run_dir, output_dir):
+  if sequence_name not in store["sequences"]:
+    fasta_file = os.path.join(run_dir, f"{sequence_name}.fasta")
+    if not os.path.isfile(fasta_file):
+      return None
+    store["sequences"][sequence_name] = {
+      "length": sequence_length(fasta_file),
+      "msa_depth": sequence_msa_depth(output_dir, sequence_name),
+    }
+  return store["sequences"][sequence_name]
+
+def ingest_logs(store, run_dir, log_files):
+  # only the logs written since the last time are read, the records of a log that changed are replaced
+  changed = [log for log in log_files if store["logs"].get(log) != [os.path.getmtime(log), os.path.getsize(log)]]
+  if not changed:
+    return 0
+  tool, recycles, output_dir = run_settings(run_dir)
+  sequence_name = os.path.basename(os.path.dirname(run_dir))
+  features = sequence_features(store, sequence_name, run_dir, output_dir)
+  if tool is None or features is None:
+    return 0
+
+  store["predictions"] = [record for record in store["predictions"] if record["log"] not in changed]
+  added = 0
+  for log_file in changed:
+    store["logs"][log_file] = [os.path.getmtime(log_file), os.path.getsize(log_file)]
+    with open(log_file, "r", encoding="utf-8", errors="replace") as handle:
+      for line in handle:
+        match = PREDICT_TIME.search(line)
+        if not match:
+          continue
+        store["predictions"].append({
+          "tool": tool,
+          "model": match.group(1),
+          "sequence": sequence_name,
+          "length": features["length"],
+          "msa_depth": features["msa_depth"],
+          "recycles": recycles,
+          "prediction": int(match.group(2)),
+          "seconds": float(match.group(3)),
+          "log": log_file,
+        })
+        added += 1
+  return added
+
+def ingest_run(store, run_dir):
+  # fallback for the runs whose batches did not record their prediction times
+  run_dir = os.path.abspath(run_dir)
+  if run_dir in store["runs"]:
+    return 0
+  log_files = [log for log in glob.glob(os.path.join(run_dir, "jobarray_*.log")) if os.path.isfile(log)]
+  return ingest_logs(store, run_dir, log_files)
+
+def record_batch(run_dir, batch_id):
+  # called by the job array task at the end of the batch, the store is in the logs directory of all the runs
+  run_dir = os.path.abspath(run_dir)
+  logs_dir = os.path.dirname(os.path.dirname(run_dir))
+  log_file = os.path.join(run_dir, f"jobarray_{batch_id}.log")
+  with queue_lock(logs_dir):
+    store = load_store(logs_dir)
+    added = ingest_logs(store, run_dir, [log_file] if os.path.isfile(log_file) else [])
+    if run_dir not in store["runs"]:
+      store["runs"].append(run_dir)
+    write_json(os.path.join(logs_dir, TIMINGS_FILE), store)
+  return added
+
+def update_store(logs_dir, run_dirs):
+  with queue_lock(logs_dir):
+    store = load_store(logs_dir)
+    added = sum(ingest_run(store, run_dir) for run_dir in run_dirs)
+    if added:
+      write_json(os.path.join(logs_dir, TIMINGS_FILE), store)
+  if added:
+    print(f"Recorded {added} prediction times in {os.path.join(logs_dir, TIMINGS_FILE)}")
+  return store
+
+def all_run_dirs(logs_dir):
+  return [path for path in glob.glob(os.path.join(logs_dir, "*", "*")) if os.path.isdir(path)]
+
+def quantile(values, fraction):
+  values = sorted(values)
+  return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+def fit_on_length(points, length):
+  # time = a * length^b fitted on the (length, time) of the other sequences
+  xs = [math.log(point_length) for point_length, _ in points]
+  ys = [math.log(point_time) for _, point_time in points]
+  mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+  variance = sum((x - mean_x) ** 2 for x in xs)
+  slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+  return math.exp(mean_y + slope * (math.log(length) - mean_x))
+
+def fit_on_length_and_depth(points, length, depth):
+  # time = a * length^b * depth^c fitted on the (length, depth, time) of the other sequences, None if the lengths and
+  # depths of the sequences are not independent enough to separate their effects
+  xs1 = [math.log(point_length) for point_length, _, _ in points]
+  xs2 = [math.log(point_depth) for _, point_depth, _ in points]
+  ys = [math.log(point_time) for _, _, point_time in points]
+  mean_x1, mean_x2, mean_y = sum(xs1) / len(xs1), sum(xs2) / len(xs2), sum(ys) / len(ys)
+  s11 = sum((x1 - mean_x1) ** 2 for x1 in xs1)
+  s22 = sum((x2 - mean_x2) ** 2 for x2 in xs2)
+  s12 = sum((x1 - mean_x1) * (x2 - mean_x2) for x1, x2 in zip(xs1, xs2))
+  s1y = sum((x1 - mean_x1) * (y - mean_y) for x1, y in zip(xs1, ys))
+  s2y = sum((x2 - mean_x2) * (y - mean_y) for x2, y in zip(xs2, ys))
+  determinant = s11 * s22 - s12 ** 2
+  if determinant <= 1e-9 * max(s11 * s22, 1e-12):
+    return None
+  slope1 = (s22 * s1y - s12 * s2y) / determinant
+  slope2 = (s11 * s2y - s12 * s1y) / determinant
+  return math.exp(mean_y + slope1 * (math.log(length) - mean_x1) + slope2 * (math.log(depth) - mean_x2))
+
+def estimate_prediction_times(store, tool, sequence_name, length, recycles, run_dir=None, fraction=DEFAULT_QUANTILE,
+                              depth=None):
+  # time of a prediction for each model: quantile of the times of this sequence, or interpolated on the length and,
+  # when the alignments of the sequences are known, on their depth
+  records = [record for record in store["predictions"] if record["tool"] == tool and record["seconds"] > 0]
+  if run_dir:
+    records = [record for record in records if os.path.dirname(record["log"]) == os.path.abspath(run_dir)]
+  estimates = {}
+  for model in sorted({record["model"] for record in records}):
+    model_records = [record for record in records if record["model"] == model]
+    same_recycles = [record for record in model_records if record["recycles"] == recycles]
+    model_records = same_recycles or model_records
+    per_sequence = {}
+    for record in model_records:
+      features = (record["length"], record.get("msa_depth"))
+      per_sequence.setdefault(record["sequence"], (features, []))[1].append(record["seconds"])
+    if sequence_name in per_sequence:
+      estimate = quantile(per_sequence[sequence_name][1], fraction)
+    else:
+      points = {features: quantile(times, fraction) for features, times in per_sequence.values()}
+      with_depth = [
+        (point_length, point_depth, time) for (point_length, point_depth), time in points.items() if point_depth
+      ]
+      estimate = None
+      if depth and length and len(with_depth) > 2:
+        estimate = fit_on_length_and_depth(with_depth, length, depth)
+      if estimate is None:
+        per_length = {}
+        for (point_length, _), time in points.items():
+          per_length[point_length] = max(time, per_length.get(point_length, 0))
+        if len(per_length) > 1 and length:
+          estimate = fit_on_length(list(per_length.items()), length)
+        else:
+          estimate = max(points.values())
+    estimates[model] = math.ceil(estimate)
+  return estimates
+
+def batch_sizes(prediction_times, wall_time, add_excess=0.1):
+  # predictions of each model fitting in the wall time
+  return {
+    model: max(1, math.floor(wall_time * 60 * 60 / (time * (1 + add_excess))))
+    for model, time in prediction_times.items()
+  }
+
+def main():
+  args = parser.parse_args()
+  added = record_batch(args.run_dir, args.batch_id)
+  print(f"Batch {args.batch_id}: {added} prediction times recorded", file=sys.stderr)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
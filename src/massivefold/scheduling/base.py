@@ -1,5 +1,11 @@
 """Shared functional scheduler helpers for MassiveFold CLI."""
 
+import time
+
+# job states reported by job_status, whatever the scheduler
+FINISHED_STATES = ["COMPLETED", "FAILED", "TIMEOUT", "CANCELLED"]
+ACTIVE_STATES = ["PENDING", "RUNNING"]
+
 def unsupported_run(scheduler_name):
   def run(args, forwarded_args):
     raise RuntimeError(f"Scheduler '{scheduler_name}' does not implement run.")
@@ -13,11 +19,64 @@ def unsupported_screening(scheduler_name):
   return screening
 
 def unsupported_submit(scheduler_name):
-  def submit(jobfile_content, dependency_id=None, array_size=None):
+  def submit(jobfile_content, job_name=None, dependency_id=None, array_size=None, task_ids=None, array_throttle=None):
     raise RuntimeError(f"Scheduler '{scheduler_name}' does not implement submit_job.")
 
   return submit
 
+def unsupported_job_status(scheduler_name):
+  def job_status(job_ids):
+    raise RuntimeError(f"Scheduler '{scheduler_name}' does not implement job_status.")
+
+  return job_status
+
+def unsupported_cancel(scheduler_name):
+  def cancel(job_ids):
+    raise RuntimeError(f"Scheduler '{scheduler_name}' does not implement cancel.")
+
+  return cancel
+
+def nothing_to_wait():
+  return 0
+
+def combined_state(states):
+  """State of a job from the states of its array tasks."""
+  states = list(states)
+  if not states:
+    return "UNKNOWN"
+  if all(state == "COMPLETED" for state in states):
+    return "COMPLETED"
+  if all(state in FINISHED_STATES for state in states):
+    for state in ["FAILED", "TIMEOUT", "CANCELLED"]:
+      if state in states:
+        return state
+  if any(state != "PENDING" for state in states):
+    return "RUNNING"
+  return "PENDING"
+
+def wait_for_jobs(job_status_fn, job_ids, timeout=None, poll_interval=10, max_poll_interval=300):
+  """Poll job_status_fn until the jobs are finished or timeout seconds passed, return the last states."""
+  deadline = None if timeout is None else time.time() + timeout
+  delay = poll_interval
+  while True:
+    states = job_status_fn(job_ids)
+    # an UNKNOWN job (e.g. purged from the scheduler) cannot be waited for
+    if all(state not in ACTIVE_STATES for state in states.values()):
+      return states
+    if deadline is not None:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return states
+      delay = min(delay, remaining)
+    time.sleep(delay)
+    delay = min(delay * 2, max_poll_interval)
+
+def polling_wait(job_status_fn):
+  def wait(job_ids, timeout=None):
+    return wait_for_jobs(job_status_fn, job_ids, timeout)
+
+  return wait
+
 def make_scheduler(
   name,
   description,
@@ -26,6 +85,10 @@ def make_scheduler(
   run_fn=None,
   screening_fn=None,
   submit_job_fn=None,
+  wait_all_fn=None,
+  job_status_fn=None,
+  wait_fn=None,
+  cancel_fn=None,
   supports_external_dependency=False,
 ):
   if run_fn is None:
@@ -34,6 +97,14 @@ def make_scheduler(
     screening_fn = unsupported_screening(name)
   if submit_job_fn is None:
     submit_job_fn = unsupported_submit(name)
+  if wait_all_fn is None:
+    wait_all_fn = nothing_to_wait
+  if job_status_fn is None:
+    job_status_fn = unsupported_job_status(name)
+  if wait_fn is None:
+    wait_fn = polling_wait(job_status_fn)
+  if cancel_fn is None:
+    cancel_fn = unsupported_cancel(name)
 
   return {
     "name": name,
@@ -43,5 +114,9 @@ def make_scheduler(
     "run": run_fn,
     "screening": screening_fn,
     "submit_job": submit_job_fn,
+    "wait_all": wait_all_fn,
+    "job_status": job_status_fn,
+    "wait": wait_fn,
+    "cancel": cancel_fn,
     "supports_external_dependency": supports_external_dependency,
   }
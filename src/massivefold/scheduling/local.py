@@ -1,19 +1,23 @@
-"""Local scheduler for Linux systems."""
+"""Local scheduler for Linux systems, running jobs as a dependency graph on a worker pool."""
 
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import partial
 import itertools
 import os
 import re
 import subprocess
 import sys
+import threading
+import time
 
+from .base import ACTIVE_STATES
 from .base import make_scheduler
 
 _LOCAL_JOB_COUNTER = itertools.count(start=1)
-
-try:
-  from tqdm import tqdm
-except ImportError:
-  tqdm = None
+_LOCAL_STATE = {"lock": threading.Lock(), "jobs": {}}
+LOCAL_WORKERS_ENV = "MASSIVEFOLD_LOCAL_WORKERS"
+MAX_ATTEMPTS_ENV = "MASSIVEFOLD_MAX_ATTEMPTS"
+RETRY_BACKOFF_ENV = "MASSIVEFOLD_RETRY_BACKOFF"
 
 def is_available():
   return sys.platform.startswith("linux")
@@ -23,6 +27,14 @@ def availability_reason():
     return "Linux platform detected"
   return "Local scheduler currently supports Linux only"
 
+def progress_bar(total, desc):
+  # tqdm is optional and only imported when a job array runs in a terminal
+  try:
+    from tqdm import tqdm
+  except ImportError:
+    return None
+  return tqdm(total=total, desc=desc, unit="task", leave=True)
+
 def parse_sbatch_path(jobfile_content, option_name):
   pattern_inline = re.compile(rf"^\s*#SBATCH\s+--{option_name}=([^\n]+)\s*$", re.MULTILINE)
   match = pattern_inline.search(jobfile_content)
@@ -43,7 +55,7 @@ def resolve_log_path(raw_path, job_number, task_id):
     resolved = resolved.replace("%a", str(task_id))
   return resolved
 
-def run_jobfile_once(jobfile_content, env=None, log_path=None):
+def run_jobfile_once(jobfile_content, env=None, log_path=None, cwd=None):
   command = ["bash", "-c", jobfile_content]
 
   if log_path and os.path.dirname(log_path):
@@ -51,9 +63,9 @@ def run_jobfile_once(jobfile_content, env=None, log_path=None):
 
   if log_path:
     with open(log_path, "w", encoding="utf-8") as output_handle:
-      result = subprocess.run(command, env=env, stdout=output_handle, stderr=subprocess.STDOUT)
+      result = subprocess.run(command, cwd=cwd, env=env, stdout=output_handle, stderr=subprocess.STDOUT)
   else:
-    result = subprocess.run(command, env=env)
+    result = subprocess.run(command, cwd=cwd, env=env)
 
   if result.returncode != 0:
     raise RuntimeError(f"Job content execution failed ({result.returncode})")
@@ -66,57 +78,253 @@ def array_env(base_env, task_id, array_size):
   env["SLURM_ARRAY_TASK_COUNT"] = str(array_size)
   return env
 
-def submit_job(jobfile_content, job_name=None, dependency_id=None, array_size=None):
-  if dependency_id:
-    print(f"Ignoring dependency '{dependency_id}' for local scheduler (synchronous execution)")
+def resolve_local_workers(requested=None):
+  value = requested if requested is not None else os.environ.get(LOCAL_WORKERS_ENV)
+  if value in (None, ""):
+    return 1
+  try:
+    workers = int(value)
+  except (TypeError, ValueError):
+    raise RuntimeError(f"Invalid number of local workers: '{value}'")
+  if workers < 1:
+    raise RuntimeError(f"Number of local workers should be at least 1 (got {workers})")
+  return workers
+
+def resolve_retry_policy(max_attempts=None, backoff=None):
+  max_attempts = max_attempts if max_attempts is not None else os.environ.get(MAX_ATTEMPTS_ENV) or 1
+  backoff = backoff if backoff is not None else os.environ.get(RETRY_BACKOFF_ENV) or 60
+  try:
+    policy = {"max_attempts": int(max_attempts), "backoff": float(backoff)}
+  except (TypeError, ValueError):
+    raise RuntimeError(f"Invalid retry policy: {max_attempts} attempts, {backoff}s backoff")
+  if policy["max_attempts"] < 1 or policy["backoff"] < 0:
+    raise RuntimeError(f"Invalid retry policy: {max_attempts} attempts, {backoff}s backoff")
+  return policy
+
+def retry_delay(retry, attempt):
+  # exponential backoff: backoff, 2*backoff, 4*backoff...
+  return retry["backoff"] * 2 ** (attempt - 1)
+
+def keep_attempt_log(log_path, attempt):
+  if log_path and os.path.isfile(log_path):
+    os.replace(log_path, f"{log_path}.attempt{attempt}")
+
+def task_pool(workers=None):
+  # one pool shared by every job of the scheduler, so dependent jobs of several runs interleave
+  return ThreadPoolExecutor(max_workers=resolve_local_workers(workers), thread_name_prefix="massivefold-local")
 
+def parse_dependency_ids(dependency_id):
+  if not dependency_id:
+    return []
+  if isinstance(dependency_id, (list, tuple, set)):
+    return [job_id for item in dependency_id for job_id in parse_dependency_ids(item)]
+  return [job_id for job_id in re.split(r"[:,]", str(dependency_id)) if job_id]
+
+def dependencies_satisfied(job, dependency_ids):
+  for dependency in dependency_ids:
+    dependency_job = _LOCAL_STATE["jobs"].get(dependency)
+    if dependency_job is None:
+      print(f"Dependency '{dependency}' of {job['id']} is not a local job of this session, assuming it is completed")
+      continue
+    while not dependency_job["done"].wait(timeout=1):
+      if job["cancel"].is_set():
+        return False
+    if dependency_job["status"] != "COMPLETED":
+      return False
+  return True
+
+def run_job_tasks(job, jobfile_content, array_size, task_ids, log_template, pool, retry, show_progress):
+  base_env = os.environ.copy()
+  job_number = job["number"]
+
+  def run_attempt(task_id, attempt, result):
+    # result is the future of the task, set when its last attempt ended
+    if attempt == 1 and not result.set_running_or_notify_cancel():
+      return
+    if job["cancel"].is_set():
+      result.set_exception(RuntimeError("cancelled"))
+      return
+    env = None if task_id is None else array_env(base_env, task_id, array_size)
+    log_path = resolve_log_path(log_template, job_number, task_id=task_id)
+    try:
+      run_jobfile_once(jobfile_content, env=env, log_path=log_path)
+    except RuntimeError as error:
+      if attempt == retry["max_attempts"]:
+        result.set_exception(error)
+        return
+      keep_attempt_log(log_path, attempt)
+      delay = retry_delay(retry, attempt)
+      print(f"{job['name']} ({job['id']}) task {task_id} failed: {error},"
+            f" retrying in {delay:g}s (attempt {attempt + 1}/{retry['max_attempts']})")
+      # the worker is released during the backoff, the next attempt is queued again once it passed
+      timer = threading.Timer(delay, retry_attempt, args=(task_id, attempt + 1, result))
+      timer.daemon = True
+      with _LOCAL_STATE["lock"]:
+        job["retries"][task_id] = (timer, result)
+      timer.start()
+      return
+    except Exception as error:
+      result.set_exception(error)
+      return
+    result.set_result(None)
+
+  def retry_attempt(task_id, attempt, result):
+    with _LOCAL_STATE["lock"]:
+      # cancel() may have ended the task first
+      if job["retries"].pop(task_id, None) is None:
+        return
+    try:
+      pool.submit(run_attempt, task_id, attempt, result)
+    except RuntimeError as error:
+      # the pool is shut down with the interpreter
+      result.set_exception(error)
+
+  if array_size is None:
+    task_ids = [None]
+  elif task_ids is None:
+    task_ids = list(range(array_size))
+  progress = None
+  if show_progress:
+    progress = progress_bar(len(task_ids), job["name"])
+  try:
+    futures = []
+    for task_id in task_ids:
+      result = Future()
+      futures.append(result)
+      pool.submit(run_attempt, task_id, 1, result)
+    job["futures"] = futures
+    for future in as_completed(futures):
+      if future.cancelled():
+        continue
+      error = future.exception()
+      if error is not None:
+        # drop queued tasks, the running ones finish before the error is reported
+        for remaining in futures:
+          remaining.cancel()
+        raise error
+      if progress is not None:
+        progress.update(1)
+    if job["cancel"].is_set():
+      raise RuntimeError("cancelled")
+  finally:
+    if progress is not None:
+      progress.close()
+
+def run_local_job(job, dependency_ids, jobfile_content, array_size, task_ids, log_template, pool, retry, show_progress):
+  try:
+    satisfied = dependencies_satisfied(job, dependency_ids)
+    if job["cancel"].is_set():
+      job["status"] = "CANCELLED"
+      job["error"] = "cancelled"
+      return
+    if not satisfied:
+      job["status"] = "CANCELLED"
+      job["error"] = f"dependency {', '.join(dependency_ids)} did not complete"
+      print(f"Cancelling {job['name']} ({job['id']}): {job['error']}")
+      return
+    job["status"] = "RUNNING"
+    run_job_tasks(job, jobfile_content, array_size, task_ids, log_template, pool, retry, show_progress)
+    job["status"] = "COMPLETED"
+  except Exception as error:
+    job["status"] = "CANCELLED" if job["cancel"].is_set() else "FAILED"
+    job["error"] = str(error)
+    print(f"{job['name']} ({job['id']}) failed: {error}")
+  finally:
+    job["done"].set()
+
+def submit_job(jobfile_content, job_name=None, dependency_id=None, array_size=None, task_ids=None,
+               array_throttle=None, pool=None, max_attempts=None, retry_backoff=None):
+  # array_throttle is not used, the local tasks never run more than the workers concurrently
+  if pool is None:
+    pool = task_pool()
+  retry = resolve_retry_policy(max_attempts, retry_backoff)
   job_number = next(_LOCAL_JOB_COUNTER)
   output_template = parse_sbatch_path(jobfile_content, "output")
   error_template = parse_sbatch_path(jobfile_content, "error")
   log_template = output_template or error_template
-  progress_label = job_name if job_name else "local-job"
-  show_progress = tqdm is not None and sys.stderr.isatty()
+  show_progress = sys.stderr.isatty()
 
-  if array_size is None:
-    if show_progress:
-      with tqdm(total=1, desc=progress_label, unit="task", leave=True) as progress:
-        run_jobfile_once(
-          jobfile_content,
-          log_path=resolve_log_path(log_template, job_number, task_id=None),
-        )
-        progress.update(1)
-    else:
-      run_jobfile_once(
-        jobfile_content,
-        log_path=resolve_log_path(log_template, job_number, task_id=None),
-      )
-  else:
-    base_env = os.environ.copy()
-    if show_progress:
-      with tqdm(total=array_size, desc=progress_label, unit="task", leave=True) as progress:
-        for task_id in range(array_size):
-          run_jobfile_once(
-            jobfile_content,
-            env=array_env(base_env, task_id, array_size),
-            log_path=resolve_log_path(log_template, job_number, task_id=task_id),
-          )
-          progress.update(1)
-    else:
-      for task_id in range(array_size):
-        run_jobfile_once(
-          jobfile_content,
-          env=array_env(base_env, task_id, array_size),
-          log_path=resolve_log_path(log_template, job_number, task_id=task_id),
-        )
-
-  return f"local-{job_number}"
-
-def get_scheduler():
+  job = {
+    "id": f"local-{job_number}",
+    "number": job_number,
+    "name": job_name if job_name else "local-job",
+    "status": "PENDING",
+    "error": None,
+    "done": threading.Event(),
+    "cancel": threading.Event(),
+    "futures": [],
+    "retries": {},
+  }
+  dependency_ids = parse_dependency_ids(dependency_id)
+  with _LOCAL_STATE["lock"]:
+    _LOCAL_STATE["jobs"][job["id"]] = job
+
+  thread = threading.Thread(
+    target=run_local_job,
+    args=(job, dependency_ids, jobfile_content, array_size, task_ids, log_template, pool, retry, show_progress),
+    name=job["id"],
+  )
+  thread.start()
+  return job["id"]
+
+def wait_all():
+  """Block until every submitted local job ended, return 1 if one of them did not complete."""
+  with _LOCAL_STATE["lock"]:
+    jobs = list(_LOCAL_STATE["jobs"].values())
+  for job in jobs:
+    job["done"].wait()
+  failed = [job for job in jobs if job["status"] != "COMPLETED"]
+  for job in failed:
+    print(f"Local job {job['name']} ({job['id']}) {job['status'].lower()}: {job['error']}")
+  return 1 if failed else 0
+
+def local_jobs(job_ids):
+  with _LOCAL_STATE["lock"]:
+    return {job_id: _LOCAL_STATE["jobs"].get(job_id) for job_id in parse_dependency_ids(job_ids)}
+
+def job_status(job_ids):
+  return {job_id: job["status"] if job else "UNKNOWN" for job_id, job in local_jobs(job_ids).items()}
+
+def wait(job_ids, timeout=None):
+  deadline = None if timeout is None else time.time() + timeout
+  for job in local_jobs(job_ids).values():
+    if job is not None:
+      job["done"].wait(None if deadline is None else max(0, deadline - time.time()))
+  return job_status(job_ids)
+
+def cancel(job_ids):
+  for job_id, job in local_jobs(job_ids).items():
+    if job is None or job["status"] not in ACTIVE_STATES:
+      continue
+    job["cancel"].set()
+    # queued tasks are dropped, running tasks finish
+    for future in job["futures"]:
+      future.cancel()
+    # the tasks waiting for their next attempt end now
+    with _LOCAL_STATE["lock"]:
+      retries = list(job["retries"].values())
+      job["retries"].clear()
+    for timer, result in retries:
+      timer.cancel()
+      result.set_exception(RuntimeError("cancelled"))
+    print(f"Cancelling {job['name']} ({job_id})")
+
+def get_scheduler(options=None):
+  options = options or {}
   return make_scheduler(
     name="local",
     description="Run locally without SLURM",
     is_available_fn=is_available,
     availability_reason_fn=availability_reason,
-    submit_job_fn=submit_job,
-    supports_external_dependency=False,
+    submit_job_fn=partial(
+      submit_job,
+      pool=task_pool(options.get("local_workers")),
+      max_attempts=options.get("max_attempts"),
+      retry_backoff=options.get("retry_backoff"),
+    ),
+    wait_all_fn=wait_all,
+    job_status_fn=job_status,
+    wait_fn=wait,
+    cancel_fn=cancel,
+    supports_external_dependency=True,
   )
@@ -2,11 +2,13 @@
 
 from .local import get_scheduler as get_local_scheduler
 from .slurm import get_scheduler as get_slurm_scheduler
+from .shared_queue import get_scheduler as get_queue_scheduler
 
 def scheduler_factories():
   return {
     "local": get_local_scheduler,
     "slurm": get_slurm_scheduler,
+    "queue": get_queue_scheduler,
   }
 
 def list_schedulers():
@@ -21,24 +23,24 @@ def list_schedulers():
     }
   return schedulers
 
-def auto_select_scheduler():
+def auto_select_scheduler(options=None):
   # default: slurm, fall back to local if not available 
   for candidate in ["slurm", "local"]:
-    scheduler = scheduler_factories()[candidate]()
+    scheduler = scheduler_factories()[candidate](options)
     if scheduler["is_available"]():
       return scheduler
-  return scheduler_factories()["local"]()
+  return scheduler_factories()["local"](options)
 
-def resolve_scheduler(requested):
+def resolve_scheduler(requested, options=None):
   if requested == "auto":
-    return auto_select_scheduler(), None
+    return auto_select_scheduler(options), None
 
   factories = scheduler_factories()
   if requested not in factories:
     choices = ", ".join(["auto"] + sorted(factories.keys()))
     return None, f"Unknown scheduler '{requested}'. Available schedulers: {choices}."
 
-  scheduler = factories[requested]()
+  scheduler = factories[requested](options)
   if not scheduler["is_available"]():
     return None, f"Scheduler '{requested}' is not available: {scheduler['availability_reason']()}."
 
@@ -0,0 +1,439 @@
+"""Work queue scheduler on a shared filesystem, served by `massivefold worker` processes.
+
+Queue layout:
+  <queue_dir>/queue.lock                    lock serializing every queue update
+  <queue_dir>/next_id                       job id counter
+  <queue_dir>/jobs/<job_id>/job.json        job record (name, submission directory, dependencies, array tasks,
+                                            throttle, retry policy)
+  <queue_dir>/jobs/<job_id>/jobfile.sh      rendered jobfile
+  <queue_dir>/jobs/<job_id>/tasks/<n>.json  task record (state, worker, attempt, heartbeat, exit status)
+  <queue_dir>/jobs/<job_id>/summary.json    pending and running task ids, number of ended tasks per state, updated
+                                            with the task records so that a claim does not read all of them
+  <queue_dir>/jobs/<job_id>/state.json      final state of the job, written once all its tasks are finished
+"""
+
+from functools import partial
+import os
+import socket
+import sys
+import threading
+import time
+
+from .base import FINISHED_STATES
+from .base import combined_state
+from .base import make_scheduler
+from .base import wait_for_jobs
+from .local import array_env
+from .local import keep_attempt_log
+from .local import parse_dependency_ids
+from .local import parse_sbatch_path
+from .local import resolve_log_path
+from .local import resolve_retry_policy
+from .local import retry_delay
+from .local import run_jobfile_once
+from massivefold.utils import queue_lock
+from massivefold.utils import read_json
+from massivefold.utils import write_json
+
+QUEUE_DIR_ENV = "MASSIVEFOLD_QUEUE_DIR"
+# a running task refreshes its heartbeat every HEARTBEAT_INTERVAL seconds, after LEASE_TIMEOUT seconds without it
+# its worker is considered lost (killed, out of memory, node rebooted) and the attempt failed
+HEARTBEAT_INTERVAL = 60
+LEASE_TIMEOUT = 600
+
+def resolve_queue_dir(requested=None):
+  queue_dir = requested or os.environ.get(QUEUE_DIR_ENV)
+  if not queue_dir:
+    return None
+  return os.path.abspath(os.path.expanduser(queue_dir))
+
+def jobs_dir(queue_dir):
+  return os.path.join(queue_dir, "jobs")
+
+def task_path(queue_dir, job_id, task_id):
+  return os.path.join(jobs_dir(queue_dir), job_id, "tasks", f"{task_id}.json")
+
+def state_path(queue_dir, job_id):
+  return os.path.join(jobs_dir(queue_dir), job_id, "state.json")
+
+def summary_path(queue_dir, job_id):
+  return os.path.join(jobs_dir(queue_dir), job_id, "summary.json")
+
+def next_job_id(queue_dir):
+  counter_path = os.path.join(queue_dir, "next_id")
+  job_number = 1
+  if os.path.isfile(counter_path):
+    with open(counter_path, "r", encoding="utf-8") as handle:
+      job_number = int(handle.read().strip() or 1)
+  with open(counter_path, "w", encoding="utf-8") as handle:
+    handle.write(str(job_number + 1))
+  return job_number
+
+def is_available(queue_dir):
+  return sys.platform.startswith("linux") and queue_dir is not None
+
+def availability_reason(queue_dir):
+  if not sys.platform.startswith("linux"):
+    return "Queue scheduler currently supports Linux only"
+  if queue_dir is None:
+    return f"No queue directory, use --queue-dir or set ${QUEUE_DIR_ENV}"
+  return f"Queue directory {queue_dir}"
+
+def submit_job(jobfile_content, job_name=None, dependency_id=None, array_size=None, task_ids=None,
+               array_throttle=None, queue_dir=None, max_attempts=None, retry_backoff=None):
+  if queue_dir is None:
+    raise RuntimeError(f"No queue directory, use --queue-dir or set ${QUEUE_DIR_ENV}.")
+  retry = resolve_retry_policy(max_attempts, retry_backoff)
+
+  with queue_lock(queue_dir):
+    job_number = next_job_id(queue_dir)
+    job_id = f"queue-{job_number}"
+    job_dir = os.path.join(jobs_dir(queue_dir), job_id)
+    os.makedirs(os.path.join(job_dir, "tasks"), exist_ok=True)
+    with open(os.path.join(job_dir, "jobfile.sh"), "w", encoding="utf-8") as handle:
+      handle.write(jobfile_content)
+
+    if array_size is None:
+      task_ids = [0]
+    elif task_ids is None:
+      task_ids = list(range(array_size))
+    for task_id in task_ids:
+      write_json(task_path(queue_dir, job_id, task_id), {"state": "PENDING", "attempt": 1})
+    # pending tasks are [task id, time from which it can be claimed]
+    write_json(summary_path(queue_dir, job_id), {
+      "pending": [[int(task_id), 0] for task_id in task_ids],
+      "running": [],
+      "ended": {},
+    })
+    write_json(os.path.join(job_dir, "job.json"), {
+      "id": job_id,
+      "number": job_number,
+      "name": job_name if job_name else "queue-job",
+      # the relative paths of the parameters and of the jobfile are resolved from the submission directory
+      "workdir": os.getcwd(),
+      "dependencies": parse_dependency_ids(dependency_id),
+      "array_size": array_size,
+      "task_ids": [int(task_id) for task_id in task_ids],
+      "array_throttle": array_throttle,
+      "retry": retry,
+      "submitted": time.time(),
+    })
+
+  print(f"Queued {job_name} as {job_id} in {queue_dir}")
+  return job_id
+
+def read_job(queue_dir, job_id):
+  job_file = os.path.join(jobs_dir(queue_dir), job_id, "job.json")
+  # job.json is written last, its absence means the submission is not complete
+  return read_json(job_file) if os.path.isfile(job_file) else None
+
+def finished_job_state(queue_dir, job_id):
+  path = state_path(queue_dir, job_id)
+  return read_json(path)["state"] if os.path.isfile(path) else None
+
+def job_tasks(queue_dir, job):
+  return {task_id: read_json(task_path(queue_dir, job["id"], task_id)) for task_id in job["task_ids"]}
+
+def end_task(summary, task_id, record):
+  # move the task out of the running ones, back to the pending ones when it is retried
+  summary["running"] = [running_id for running_id in summary["running"] if running_id != task_id]
+  if record["state"] == "PENDING":
+    summary["pending"].append([task_id, record.get("not_before", 0)])
+  else:
+    summary["ended"][record["state"]] = summary["ended"].get(record["state"], 0) + 1
+
+def read_summary(queue_dir, job):
+  path = summary_path(queue_dir, job["id"])
+  if os.path.isfile(path):
+    return read_json(path)
+  # jobs queued before the summaries, built once from their tasks
+  summary = {"pending": [], "running": [], "ended": {}}
+  for task_id, task in job_tasks(queue_dir, job).items():
+    if task["state"] == "RUNNING":
+      summary["running"].append(task_id)
+    else:
+      end_task(summary, task_id, task)
+  write_json(path, summary)
+  return summary
+
+def summary_state(summary):
+  states = [state for state, count in summary["ended"].items() if count]
+  if summary["pending"]:
+    states.append("PENDING")
+  if summary["running"]:
+    states.append("RUNNING")
+  return combined_state(states)
+
+def load_queue(queue_dir):
+  """Return the unfinished jobs, their task summaries and the state of every job, the tasks are not read."""
+  jobs, summaries, states = [], {}, {}
+  if not os.path.isdir(jobs_dir(queue_dir)):
+    return jobs, summaries, states
+  for job_id in os.listdir(jobs_dir(queue_dir)):
+    state = finished_job_state(queue_dir, job_id)
+    if state is not None:
+      states[job_id] = state
+      continue
+    job = read_job(queue_dir, job_id)
+    if job is not None:
+      jobs.append(job)
+      summaries[job_id] = read_summary(queue_dir, job)
+  return sorted(jobs, key=lambda job: job["number"]), summaries, states
+
+def record_finished_jobs(queue_dir, jobs, states):
+  # the tasks of a job are no longer read once its final state is recorded, to be called with the lock held
+  for job in jobs:
+    if states[job["id"]] in FINISHED_STATES:
+      write_json(state_path(queue_dir, job["id"]), {"state": states[job["id"]]})
+
+def dependency_state(job, states):
+  for dependency in job["dependencies"]:
+    # ids unknown to the queue (e.g. from another scheduler) are considered completed
+    state = states.get(dependency, "COMPLETED")
+    if state in ["FAILED", "TIMEOUT", "CANCELLED"]:
+      return "BROKEN"
+    if state != "COMPLETED":
+      return "WAITING"
+  return "READY"
+
+def failed_attempt(job, task, error):
+  record = {
+    "state": "FAILED",
+    "worker": task.get("worker"),
+    "attempt": task.get("attempt", 1),
+    "started": task.get("started"),
+    "ended": time.time(),
+    "error": error,
+  }
+  if record["attempt"] < job["retry"]["max_attempts"]:
+    # only this task goes back to the queue, the other tasks of the array are left as they are
+    record = {
+      "state": "PENDING",
+      "attempt": record["attempt"] + 1,
+      "not_before": time.time() + retry_delay(job["retry"], record["attempt"]),
+      "last_error": error,
+    }
+  return record
+
+def expire_leases(queue_dir, job, summary, now):
+  """Fail the running tasks of lost workers, which would otherwise never finish, return whether any was found."""
+  expired = False
+  for task_id in list(summary["running"]):
+    task = read_json(task_path(queue_dir, job["id"], task_id))
+    if task["state"] != "RUNNING" or task.get("heartbeat", task.get("started", now)) > now - LEASE_TIMEOUT:
+      continue
+    error = f"worker {task.get('worker')} lost, no heartbeat for {LEASE_TIMEOUT}s"
+    record = failed_attempt(job, task, error)
+    write_json(task_path(queue_dir, job["id"], task_id), record)
+    end_task(summary, task_id, record)
+    expired = True
+    print(f"{job['name']} ({job['id']}) task {task_id}: {error}")
+  return expired
+
+def cancel_pending_tasks(queue_dir, job, summary, reason):
+  for task_id, _ in summary["pending"]:
+    write_json(task_path(queue_dir, job["id"], task_id), {"state": "CANCELLED", "reason": reason})
+  summary["ended"]["CANCELLED"] = summary["ended"].get("CANCELLED", 0) + len(summary["pending"])
+  summary["pending"] = []
+  write_json(summary_path(queue_dir, job["id"]), summary)
+
+def claim_task(queue_dir, worker_id):
+  """Mark the first runnable task as RUNNING for this worker, return (job, task_id, attempt) or None."""
+  now = time.time()
+  with queue_lock(queue_dir):
+    jobs, summaries, states = load_queue(queue_dir)
+    for job in jobs:
+      if expire_leases(queue_dir, job, summaries[job["id"]], now):
+        write_json(summary_path(queue_dir, job["id"]), summaries[job["id"]])
+      states[job["id"]] = summary_state(summaries[job["id"]])
+    record_finished_jobs(queue_dir, jobs, states)
+    for job in jobs:
+      if states[job["id"]] in FINISHED_STATES:
+        continue
+      summary = summaries[job["id"]]
+      readiness = dependency_state(job, states)
+      if readiness == "BROKEN":
+        cancel_pending_tasks(queue_dir, job, summary, "dependency failed")
+        states[job["id"]] = summary_state(summary)
+        record_finished_jobs(queue_dir, [job], states)
+        print(f"Cancelled {job['name']} ({job['id']}): dependency failed")
+        continue
+      if readiness == "WAITING":
+        continue
+      if job.get("array_throttle") and len(summary["running"]) >= job["array_throttle"]:
+        continue
+      for index, (task_id, not_before) in enumerate(summary["pending"]):
+        # a retried task waits for its backoff delay before being claimed again
+        if not_before <= now:
+          attempt = read_json(task_path(queue_dir, job["id"], task_id)).get("attempt", 1)
+          write_json(task_path(queue_dir, job["id"], task_id), {
+            "state": "RUNNING",
+            "worker": worker_id,
+            "attempt": attempt,
+            "started": now,
+            "heartbeat": now,
+          })
+          del summary["pending"][index]
+          summary["running"].append(task_id)
+          write_json(summary_path(queue_dir, job["id"]), summary)
+          return job, task_id, attempt
+  return None
+
+def holds_lease(task, attempt, worker_id):
+  return task["state"] == "RUNNING" and task.get("worker") == worker_id and task.get("attempt") == attempt
+
+def keep_lease(queue_dir, job, task_id, attempt, worker_id, stop):
+  # refresh the heartbeat of the task until stop is set or another worker took the task over
+  path = task_path(queue_dir, job["id"], task_id)
+  while not stop.wait(HEARTBEAT_INTERVAL):
+    try:
+      with queue_lock(queue_dir):
+        task = read_json(path)
+        if not holds_lease(task, attempt, worker_id):
+          return
+        task["heartbeat"] = time.time()
+        write_json(path, task)
+    except (OSError, ValueError) as error:
+      # the next heartbeat may succeed, the lease only expires after LEASE_TIMEOUT
+      print(f"[{worker_id}] heartbeat of {job['id']} task {task_id} not recorded: {error}")
+
+def record_task_end(queue_dir, job, task_id, attempt, worker_id, started, error=None, log_path=None):
+  """Record the end of the attempt, return the new task record or None if the lease of the task expired."""
+  path = task_path(queue_dir, job["id"], task_id)
+  with queue_lock(queue_dir):
+    task = read_json(path)
+    if not holds_lease(task, attempt, worker_id):
+      return None
+    if error:
+      record = failed_attempt(job, task, error)
+    else:
+      record = {
+        "state": "COMPLETED",
+        "worker": worker_id,
+        "attempt": attempt,
+        "started": started,
+        "ended": time.time(),
+        "error": None,
+      }
+    if record["state"] == "PENDING":
+      # set the log aside before the task is visible again to the other workers
+      keep_attempt_log(log_path, attempt)
+    write_json(path, record)
+    summary = read_summary(queue_dir, job)
+    end_task(summary, task_id, record)
+    write_json(summary_path(queue_dir, job["id"]), summary)
+  return record
+
+def run_claimed_task(queue_dir, job, task_id, attempt, worker_id):
+  job_dir = os.path.join(jobs_dir(queue_dir), job["id"])
+  with open(os.path.join(job_dir, "jobfile.sh"), "r", encoding="utf-8") as handle:
+    jobfile_content = handle.read()
+  log_template = parse_sbatch_path(jobfile_content, "output") or parse_sbatch_path(jobfile_content, "error")
+
+  env = None
+  array_task_id = None
+  if job["array_size"] is not None:
+    env = array_env(os.environ.copy(), task_id, job["array_size"])
+    array_task_id = task_id
+
+  started = time.time()
+  # jobs queued before the submission directory was recorded run in the directory of the worker
+  workdir = job.get("workdir")
+  log_path = resolve_log_path(log_template, job["number"], task_id=array_task_id)
+  if log_path and workdir:
+    log_path = os.path.join(workdir, log_path)
+  print(f"[{worker_id}] running {job['name']} ({job['id']}) task {task_id} (attempt {attempt})")
+  error = None
+  stop_heartbeat = threading.Event()
+  heartbeat = threading.Thread(
+    target=keep_lease, args=(queue_dir, job, task_id, attempt, worker_id, stop_heartbeat), daemon=True
+  )
+  heartbeat.start()
+  try:
+    run_jobfile_once(jobfile_content, env=env, log_path=log_path, cwd=workdir)
+  except (RuntimeError, OSError) as run_error:
+    # a log that can not be written or bash that can not start fails the task, not the worker
+    error = str(run_error)
+  finally:
+    stop_heartbeat.set()
+    heartbeat.join()
+  record = record_task_end(queue_dir, job, task_id, attempt, worker_id, started, error, log_path)
+  if record is None:
+    print(f"[{worker_id}] {job['id']} task {task_id}: lease expired, the task was taken over, result not recorded")
+  elif record["state"] == "PENDING":
+    delay = record["not_before"] - time.time()
+    print(f"[{worker_id}] {job['id']} task {task_id}: failed ({error}), requeued for attempt"
+          f" {record['attempt']}/{job['retry']['max_attempts']} in {max(delay, 0):.0f}s")
+  else:
+    print(f"[{worker_id}] {job['id']} task {task_id}: {'failed (' + error + ')' if error else 'completed'}")
+
+def queue_is_drained(queue_dir):
+  with queue_lock(queue_dir):
+    jobs, summaries, states = load_queue(queue_dir)
+    for job in jobs:
+      states[job["id"]] = summary_state(summaries[job["id"]])
+    record_finished_jobs(queue_dir, jobs, states)
+  # jobs waiting on a broken dependency are cancelled by the next claim, not counted as work
+  return all(
+    states[job["id"]] in FINISHED_STATES or dependency_state(job, states) == "BROKEN"
+    for job in jobs
+  )
+
+def single_job_state(queue_dir, job_id):
+  state = finished_job_state(queue_dir, job_id)
+  if state is not None:
+    return state
+  job = read_job(queue_dir, job_id)
+  return summary_state(read_summary(queue_dir, job)) if job is not None else "UNKNOWN"
+
+def job_status(job_ids, queue_dir=None):
+  job_ids = parse_dependency_ids(job_ids)
+  with queue_lock(queue_dir):
+    return {job_id: single_job_state(queue_dir, job_id) for job_id in job_ids}
+
+def wait(job_ids, timeout=None, queue_dir=None):
+  return wait_for_jobs(partial(job_status, queue_dir=queue_dir), job_ids, timeout)
+
+def cancel(job_ids, queue_dir=None):
+  job_ids = parse_dependency_ids(job_ids)
+  with queue_lock(queue_dir):
+    for job_id in job_ids:
+      job = read_job(queue_dir, job_id)
+      if job is None or finished_job_state(queue_dir, job_id) is not None:
+        continue
+      # tasks already running on a worker finish, the others are never claimed
+      cancel_pending_tasks(queue_dir, job, read_summary(queue_dir, job), "cancelled")
+      print(f"Cancelled {job['name']} ({job['id']})")
+
+def run_worker(queue_dir, poll_interval=10, exit_when_empty=False):
+  worker_id = f"{socket.gethostname()}:{os.getpid()}"
+  print(f"Worker {worker_id} serving {queue_dir}")
+  while True:
+    claimed = claim_task(queue_dir, worker_id)
+    if claimed is not None:
+      run_claimed_task(queue_dir, *claimed, worker_id)
+      continue
+    if exit_when_empty and queue_is_drained(queue_dir):
+      print(f"Worker {worker_id}: queue is empty, exiting.")
+      return 0
+    time.sleep(poll_interval)
+
+def get_scheduler(options=None):
+  options = options or {}
+  queue_dir = resolve_queue_dir(options.get("queue_dir"))
+  return make_scheduler(
+    name="queue",
+    description="Queue jobs on a shared filesystem for `massivefold worker` processes",
+    is_available_fn=partial(is_available, queue_dir),
+    availability_reason_fn=partial(availability_reason, queue_dir),
+    submit_job_fn=partial(
+      submit_job,
+      queue_dir=queue_dir,
+      max_attempts=options.get("max_attempts"),
+      retry_backoff=options.get("retry_backoff"),
+    ),
+    job_status_fn=partial(job_status, queue_dir=queue_dir),
+    wait_fn=partial(wait, queue_dir=queue_dir),
+    cancel_fn=partial(cancel, queue_dir=queue_dir),
+    supports_external_dependency=True,
+  )
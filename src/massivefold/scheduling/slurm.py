@@ -1,8 +1,33 @@
 """SLURM scheduler using simple-slurm for submissions."""
 
+import math
+import os
+import re
 import shutil
-from simple_slurm import Slurm
+import subprocess
+import time
+from .base import FINISHED_STATES
+from .base import combined_state
 from .base import make_scheduler
+from .base import wait_for_jobs
+from .local import parse_dependency_ids
+from .local import parse_sbatch_path
+
+MAX_ARRAY_SIZE_ENV = "MASSIVEFOLD_SLURM_MAX_ARRAY_SIZE"
+# SLURM default when MaxArraySize is not set in slurm.conf
+DEFAULT_MAX_ARRAY_SIZE = 1001
+_SLURM_CONFIG = {}
+# squeue/sacct results reused for this number of seconds, finished jobs are never queried again
+STATUS_CACHE_SECONDS = 30
+_STATUS_CACHE = {}
+SLURM_STATES = {
+  "PENDING": ["PENDING", "REQUEUED", "REQUEUE_FED", "REQUEUE_HOLD", "RESV_DEL_HOLD"],
+  "RUNNING": ["RUNNING", "COMPLETING", "CONFIGURING", "RESIZING", "SIGNALING", "STAGE_OUT", "STOPPED", "SUSPENDED"],
+  "COMPLETED": ["COMPLETED"],
+  "FAILED": ["FAILED", "BOOT_FAIL", "DEADLINE", "NODE_FAIL", "OUT_OF_MEMORY", "PREEMPTED", "SPECIAL_EXIT"],
+  "TIMEOUT": ["TIMEOUT"],
+  "CANCELLED": ["CANCELLED", "REVOKED"],
+}
 
 def is_available():
   return shutil.which("sbatch") is not None
@@ -11,27 +36,208 @@ def availability_reason():
   if shutil.which("sbatch") is None:
     return "Missing executable 'sbatch' in PATH"
 
-def slurm_keyworded_args(job_name=None, dependency_id=None, array_size=None):
+def max_array_size():
+  # task ids of an array must be lower than MaxArraySize, read once from the cluster configuration
+  if "max_array_size" not in _SLURM_CONFIG:
+    value = os.environ.get(MAX_ARRAY_SIZE_ENV)
+    if not value:
+      try:
+        config = subprocess.run(["scontrol", "show", "config"], capture_output=True, text=True, check=True).stdout
+      except (OSError, subprocess.CalledProcessError):
+        config = ""
+      match = re.search(r"^MaxArraySize\s*=\s*(\d+)", config, re.MULTILINE)
+      value = match.group(1) if match else DEFAULT_MAX_ARRAY_SIZE
+    _SLURM_CONFIG["max_array_size"] = int(value)
+  return _SLURM_CONFIG["max_array_size"]
+
+def format_array(task_ids, array_throttle=None):
+  # e.g. [0, 1, 2, 3, 7, 9, 10] with a throttle of 50 -> 0-3,7,9-10%50
+  ranges = []
+  for task_id in sorted(task_ids):
+    if ranges and task_id == ranges[-1][1] + 1:
+      ranges[-1][1] = task_id
+    else:
+      ranges.append([task_id, task_id])
+  array = ",".join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+  return f"{array}%{array_throttle}" if array_throttle else array
+
+def array_chunks(task_ids, chunk_size):
+  # [(offset, task ids relative to offset), ...] with relative ids lower than chunk_size
+  chunks = {}
+  for task_id in task_ids:
+    offset = task_id // chunk_size * chunk_size
+    chunks.setdefault(offset, []).append(task_id - offset)
+  return sorted(chunks.items())
+
+def offset_jobfile(jobfile_content, offset):
+  """Shift SLURM_ARRAY_TASK_ID by offset, return the jobfile and the SLURM log paths of the shifted submission."""
+  lines = jobfile_content.splitlines()
+  # #SBATCH options are only read before the first command
+  first_command = next(
+    (i for i, line in enumerate(lines) if line.strip() and not line.lstrip().startswith("#")),
+    len(lines),
+  )
+  shift = [
+    f"# task ids of this submission start at {offset}",
+    f"export SLURM_ARRAY_TASK_ID=$((SLURM_ARRAY_TASK_ID + {offset}))",
+  ]
+  log_paths = {}
+  for option_name, descriptor in [("output", ""), ("error", "2")]:
+    log_path = parse_sbatch_path(jobfile_content, option_name)
+    if not log_path:
+      continue
+    # the task logs keep their name, SLURM only writes its own messages to the offset log
+    log_paths[option_name] = log_path.replace("%a", f"offset{offset}_%a")
+    task_log = (
+      log_path.replace("%a", "${SLURM_ARRAY_TASK_ID}")
+      .replace("%A", "${SLURM_ARRAY_JOB_ID}")
+      .replace("%j", "${SLURM_JOB_ID}")
+    )
+    shift.append(f'exec {descriptor}>> "{task_log}"')
+  lines[first_command:first_command] = shift + [""]
+  return "\n".join(lines) + "\n", log_paths
+
+def disable_sbatch_options(jobfile_content, option_names):
+  # sbatch keeps the last value of an option, so the jobfile header would override the submission's
+  pattern = re.compile(rf"^(\s*)#SBATCH(\s+--(?:{'|'.join(option_names)})\b)", re.MULTILINE)
+  return pattern.sub(r"\1##SBATCH\2", jobfile_content)
+
+def slurm_keyworded_args(job_name=None, dependency_id=None, array=None):
   kwargs = {}
   if job_name:
     kwargs["job_name"] = job_name
   if dependency_id:
     kwargs["dependency"] = {"afterok": dependency_id}
-  if array_size is not None:
-    kwargs["array"] = range(array_size)
+  if array is not None:
+    kwargs["array"] = array
   return kwargs
 
-def submit_job(jobfile_content, job_name, dependency_id=None, array_size=None):
-  slurm = Slurm(**slurm_keyworded_args(dependency_id=dependency_id, array_size=array_size, job_name=job_name))
-  job_id = slurm.sbatch(jobfile_content)
-  return str(job_id)
+def submit_job(jobfile_content, job_name, dependency_id=None, array_size=None, task_ids=None, array_throttle=None):
+  # only needed to submit, the other schedulers don't require simple_slurm
+  from simple_slurm import Slurm
+  if array_size is None and task_ids is None:
+    slurm = Slurm(**slurm_keyworded_args(job_name=job_name, dependency_id=dependency_id))
+    return str(slurm.sbatch(jobfile_content))
+
+  if task_ids is None:
+    task_ids = range(array_size)
+  chunks = array_chunks(task_ids, max_array_size())
+  # the chunks run side by side, each with its share of the throttle (rounded up) so that it holds for the whole array
+  chunk_throttle = math.ceil(array_throttle / len(chunks)) if array_throttle else None
+  job_ids = []
+  for offset, chunk_task_ids in chunks:
+    content, log_paths = jobfile_content, {}
+    if offset:
+      content, log_paths = offset_jobfile(jobfile_content, offset)
+    kwargs = slurm_keyworded_args(
+      job_name=job_name,
+      dependency_id=dependency_id,
+      array=format_array(chunk_task_ids, chunk_throttle),
+    )
+    kwargs.update(log_paths)
+    content = disable_sbatch_options(content, ["array"] + list(log_paths))
+    job_ids.append(str(Slurm(**kwargs).sbatch(content)))
+  if len(job_ids) > 1:
+    print(f"{job_name}: {len(task_ids)} tasks submitted as {len(job_ids)} arrays ({', '.join(job_ids)})")
+  # afterok:<id1>:<id2> waits for all the chunks
+  return ":".join(job_ids)
+
+def run_slurm_command(command):
+  try:
+    return subprocess.run(command, capture_output=True, text=True, check=True).stdout
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def normalize_state(raw_state):
+  # e.g. "CANCELLED by 1234", "COMPLETED+"
+  words = raw_state.split()
+  slurm_state = words[0].rstrip("+") if words else ""
+  for state, slurm_states in SLURM_STATES.items():
+    if slurm_state in slurm_states:
+      return state
+  return "UNKNOWN"
+
+def split_job_id(raw_id):
+  """'123' -> ('123', [None]), '123_4' -> ('123', ['4']), '123_[4-6%2]' -> ('123', ['4', '5', '6'])"""
+  job_id, _, tasks = raw_id.partition("_")
+  if not tasks:
+    return job_id, [None]
+  tasks = tasks.strip("[]").split("%")[0]
+  task_ids = []
+  for task_range in tasks.split(","):
+    first, _, last = task_range.partition("-")
+    task_ids.extend(str(task_id) for task_id in range(int(first), int(last or first) + 1))
+  return job_id, task_ids
+
+def parse_job_states(output, separator):
+  states = {}
+  for line in output.splitlines():
+    if separator not in line:
+      continue
+    raw_id, raw_state = line.strip().split(separator, 1)
+    # job steps (123.batch, 123_4.0) have the state of their job
+    if "." in raw_id:
+      continue
+    job_id, task_ids = split_job_id(raw_id)
+    for task_id in task_ids:
+      states.setdefault(job_id, {})[task_id] = normalize_state(raw_state)
+  return states
+
+def query_task_states(job_ids):
+  """One squeue call for the jobs still queued, one sacct call for the others."""
+  states = {}
+  output = run_slurm_command(
+    ["squeue", "--noheader", "--array", f"--jobs={','.join(job_ids)}", "--format=%i %T"]
+  )
+  if output:
+    states.update(parse_job_states(output, " "))
+  missing = [job_id for job_id in job_ids if job_id not in states]
+  if missing:
+    output = run_slurm_command(
+      ["sacct", "--noheader", "--parsable2", "--allocations", f"--jobs={','.join(missing)}", "--format=JobID,State"]
+    )
+    if output:
+      states.update(parse_job_states(output, "|"))
+  return states
+
+def task_status(job_ids, max_age=STATUS_CACHE_SECONDS):
+  job_ids = parse_dependency_ids(job_ids)
+  now = time.time()
+  to_query = [
+    job_id for job_id in job_ids
+    if job_id not in _STATUS_CACHE
+    or (_STATUS_CACHE[job_id]["state"] not in FINISHED_STATES and now - _STATUS_CACHE[job_id]["checked"] >= max_age)
+  ]
+  if to_query:
+    states = query_task_states(to_query)
+    for job_id in to_query:
+      tasks = states.get(job_id, {})
+      _STATUS_CACHE[job_id] = {"checked": now, "tasks": tasks, "state": combined_state(tasks.values())}
+  return {job_id: _STATUS_CACHE[job_id]["tasks"] for job_id in job_ids}
+
+def job_status(job_ids, max_age=STATUS_CACHE_SECONDS):
+  task_status(job_ids, max_age)
+  return {job_id: _STATUS_CACHE[job_id]["state"] for job_id in parse_dependency_ids(job_ids)}
+
+def wait(job_ids, timeout=None):
+  return wait_for_jobs(job_status, job_ids, timeout, poll_interval=STATUS_CACHE_SECONDS)
+
+def cancel(job_ids):
+  job_ids = parse_dependency_ids(job_ids)
+  if run_slurm_command(["scancel"] + job_ids) is None:
+    raise RuntimeError(f"scancel failed for job(s) {', '.join(job_ids)}")
+  for job_id in job_ids:
+    _STATUS_CACHE.pop(job_id, None)
 
-def get_scheduler():
+def get_scheduler(options=None):
   return make_scheduler(
     name="slurm",
     description="Run on a SLURM cluster",
     is_available_fn=is_available,
     availability_reason_fn=availability_reason,
     submit_job_fn=submit_job,
+    job_status_fn=job_status,
+    wait_fn=wait,
+    cancel_fn=cancel,
     supports_external_dependency=True
   )
@@ -0,0 +1,29 @@
+"""JSON records and locks shared by the processes of a run, possibly on several nodes of a shared filesystem."""
+
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import socket
+
+def read_json(path):
+  with open(path, "r", encoding="utf-8") as handle:
+    return json.load(handle)
+
+def write_json(path, payload):
+  # write then rename so that a reader on another node never sees a partial record
+  temporary_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+  with open(temporary_path, "w", encoding="utf-8") as handle:
+    json.dump(payload, handle, indent=2)
+  os.replace(temporary_path, path)
+
+@contextmanager
+def queue_lock(queue_dir):
+  os.makedirs(queue_dir, exist_ok=True)
+  with open(os.path.join(queue_dir, "queue.lock"), "a+") as lock_handle:
+    # POSIX record locks, unlike flock, are honoured across NFS clients
+    fcntl.lockf(lock_handle, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.lockf(lock_handle, fcntl.LOCK_UN)
@@ -0,0 +1,345 @@
+"""Fake SLURM commands running the jobs on this machine, to try the slurm scheduler without a cluster.
+
+  python tools/fake_slurm.py install <bin_dir>
+  export PATH=<bin_dir>:$PATH
+
+installs sbatch, squeue, sacct and scancel in bin_dir. Jobs are recorded in $MASSIVEFOLD_FAKE_SLURM_DIR
+(default: ~/.massivefold_fake_slurm) and each one is run by a background process honouring --array (and its
+%N throttle), --dependency (afterok, afterany), --output, --error and --time. A job whose afterok dependency
+failed is cancelled, as with SLURM's kill_invalid_depend.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import massivefold
+from massivefold.scheduling.base import ACTIVE_STATES
+from massivefold.scheduling.base import FINISHED_STATES
+from massivefold.scheduling.base import combined_state
+from massivefold.scheduling.shared_queue import next_job_id
+from massivefold.utils import queue_lock
+from massivefold.utils import read_json
+from massivefold.utils import write_json
+
+FAKE_SLURM_DIR_ENV = "MASSIVEFOLD_FAKE_SLURM_DIR"
+FAKE_SLURM_TASKS_ENV = "MASSIVEFOLD_FAKE_SLURM_TASKS"
+COMMANDS = ["sbatch", "squeue", "sacct", "scancel"]
+# key of the single task of a job submitted without --array
+SINGLE_TASK = "-"
+# record locks do not exclude the task threads of a same runner from each other
+_TASKS_LOCK = threading.Lock()
+
+def state_dir():
+  return os.path.abspath(os.path.expanduser(os.environ.get(FAKE_SLURM_DIR_ENV, "~/.massivefold_fake_slurm")))
+
+def job_path(job_id):
+  return os.path.join(state_dir(), "jobs", f"{job_id}.json")
+
+def read_job(job_id):
+  return read_json(job_path(job_id)) if os.path.isfile(job_path(job_id)) else None
+
+def all_jobs():
+  jobs_dir = os.path.join(state_dir(), "jobs")
+  if not os.path.isdir(jobs_dir):
+    return []
+  jobs = [read_json(os.path.join(jobs_dir, name)) for name in os.listdir(jobs_dir) if name.endswith(".json")]
+  return sorted(jobs, key=lambda job: int(job["id"]))
+
+def update_tasks(job_id, task_updates):
+  with _TASKS_LOCK, queue_lock(state_dir()):
+    job = read_job(job_id)
+    for task_id, update in task_updates.items():
+      job["tasks"][task_id].update(update)
+    write_json(job_path(job_id), job)
+  return job
+
+def parse_array(spec):
+  # 0-9,12%2 -> ([0, ..., 9, 12], 2)
+  spec, _, throttle = spec.partition("%")
+  task_ids = []
+  for task_range in spec.split(","):
+    first, _, last = task_range.partition("-")
+    task_ids.extend(range(int(first), int(last or first) + 1))
+  return task_ids, int(throttle) if throttle else None
+
+def parse_time(spec):
+  # minutes, minutes:seconds, hours:minutes:seconds, days-hours[:minutes[:seconds]]
+  if not spec or spec in ["infinite", "UNLIMITED"]:
+    return None
+  days, _, clock = spec.rpartition("-")
+  parts = [int(part) for part in clock.split(":")]
+  if days:
+    parts = parts + [0] * (3 - len(parts))
+    return int(days) * 86400 + parts[0] * 3600 + parts[1] * 60 + parts[2]
+  if len(parts) == 1:
+    return parts[0] * 60
+  if len(parts) == 2:
+    return parts[0] * 60 + parts[1]
+  return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+def parse_dependency(spec):
+  # afterok:1:2,afterany:3 -> [("afterok", ["1", "2"]), ("afterany", ["3"])]
+  dependencies = []
+  for condition in re.split(r"[,?]", spec or ""):
+    if condition:
+      kind, *job_ids = condition.split(":")
+      dependencies.append((kind, [job_id.split("_")[0] for job_id in job_ids]))
+  return dependencies
+
+def script_options(script):
+  options = {}
+  for line in script.splitlines():
+    match = re.match(r"^\s*#SBATCH\s+--([\w-]+)(?:=|\s+)?(.*)$", line)
+    if match:
+      # as with sbatch, the last occurrence of an option is kept
+      options[match.group(1).replace("-", "_")] = match.group(2).strip()
+  return options
+
+def job_state(job):
+  return combined_state(task["state"] for task in job["tasks"].values())
+
+def sbatch(argv):
+  parser = argparse.ArgumentParser(prog="sbatch")
+  for option in ["array", "dependency", "job-name", "output", "error", "time"]:
+    parser.add_argument(f"--{option}")
+  parser.add_argument("--parsable", action="store_true")
+  parser.add_argument("script", nargs="?")
+  args, _ = parser.parse_known_args(argv)
+  if args.script:
+    with open(args.script, "r", encoding="utf-8") as handle:
+      script = handle.read()
+  else:
+    script = sys.stdin.read()
+
+  options = script_options(script)
+  # command line options override the script ones
+  options.update({key: value for key, value in vars(args).items() if value is not None and key != "script"})
+  task_ids, throttle = parse_array(options["array"]) if options.get("array") else ([SINGLE_TASK], None)
+  default_output = "slurm-%A_%a.out" if options.get("array") else "slurm-%j.out"
+
+  with queue_lock(state_dir()):
+    job_id = str(next_job_id(state_dir()))
+    os.makedirs(os.path.join(state_dir(), "jobs"), exist_ok=True)
+    script_path = os.path.join(state_dir(), "jobs", f"{job_id}.sh")
+    with open(script_path, "w", encoding="utf-8") as handle:
+      handle.write(script)
+    write_json(job_path(job_id), {
+      "id": job_id,
+      "name": options.get("job_name") or os.path.basename(args.script or "sbatch"),
+      "script": script_path,
+      "workdir": os.getcwd(),
+      "array": bool(options.get("array")),
+      "throttle": throttle,
+      "dependency": parse_dependency(options.get("dependency")),
+      "output": options.get("output") or default_output,
+      "error": options.get("error") or options.get("output") or default_output,
+      "time_limit": parse_time(options.get("time")),
+      "tasks": {str(task_id): {"state": "PENDING"} for task_id in task_ids},
+    })
+
+  subprocess.Popen(
+    [sys.executable, os.path.abspath(__file__), "run", job_id],
+    stdin=subprocess.DEVNULL,
+    stdout=subprocess.DEVNULL,
+    stderr=subprocess.DEVNULL,
+    start_new_session=True,
+  )
+  print(job_id if args.parsable else f"Submitted batch job {job_id}")
+  return 0
+
+def dependencies_state(job):
+  """READY, WAITING or NEVER (afterok dependency that did not complete)."""
+  for kind, job_ids in job["dependency"]:
+    for job_id in job_ids:
+      dependency = read_job(job_id)
+      # unknown ids are considered completed
+      state = job_state(dependency) if dependency else "COMPLETED"
+      if state in ACTIVE_STATES:
+        return "WAITING"
+      if kind == "afterok" and state != "COMPLETED":
+        return "NEVER"
+  return "READY"
+
+def log_path(pattern, job, task_id):
+  array_task = "" if task_id == SINGLE_TASK else task_id
+  path = (
+    pattern.replace("%A", job["id"]).replace("%a", array_task)
+    .replace("%j", job["id"]).replace("%x", job["name"])
+  )
+  return os.path.join(job["workdir"], path)
+
+def run_task(job, task_id):
+  if read_job(job["id"])["tasks"][task_id]["state"] != "PENDING":
+    return
+  env = dict(os.environ, SLURM_JOB_ID=job["id"], SLURM_JOB_NAME=job["name"])
+  if task_id != SINGLE_TASK:
+    env.update(SLURM_ARRAY_JOB_ID=job["id"], SLURM_ARRAY_TASK_ID=task_id)
+  output_path = log_path(job["output"], job, task_id)
+  error_path = log_path(job["error"], job, task_id)
+  for path in {output_path, error_path}:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+  with open(output_path, "w") as output_handle, open(error_path, "a") as error_handle:
+    process = subprocess.Popen(
+      ["bash", job["script"]],
+      cwd=job["workdir"],
+      env=env,
+      stdout=output_handle,
+      stderr=subprocess.STDOUT if error_path == output_path else error_handle,
+      start_new_session=True,
+    )
+    update_tasks(job["id"], {task_id: {"state": "RUNNING", "pid": process.pid, "start": time.time()}})
+    try:
+      returncode = process.wait(timeout=job["time_limit"])
+      state = "COMPLETED" if returncode == 0 else "FAILED"
+    except subprocess.TimeoutExpired:
+      os.killpg(process.pid, signal.SIGKILL)
+      process.wait()
+      error_handle.write(
+        f"slurmstepd: error: *** JOB {job['id']} ON {socket.gethostname()} CANCELLED AT"
+        f" {time.strftime('%Y-%m-%dT%H:%M:%S')} DUE TO TIME LIMIT ***\n"
+      )
+      state, returncode = "TIMEOUT", None
+
+  if read_job(job["id"])["tasks"][task_id].get("cancelled"):
+    state = "CANCELLED"
+  update_tasks(job["id"], {task_id: {"state": state, "exit_code": returncode, "end": time.time()}})
+
+def run_job(job_id):
+  job = read_job(job_id)
+  while True:
+    dependencies = dependencies_state(job)
+    if dependencies != "WAITING" or job_state(read_job(job_id)) not in ACTIVE_STATES:
+      break
+    time.sleep(0.5)
+  if dependencies == "NEVER":
+    update_tasks(job_id, {task_id: {"state": "CANCELLED"} for task_id in job["tasks"]})
+    return 0
+
+  workers = job["throttle"] or int(os.environ.get(FAKE_SLURM_TASKS_ENV, 4))
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    list(executor.map(lambda task_id: run_task(job, task_id), job["tasks"]))
+  return 0
+
+def format_job_id(job, task_id):
+  return job["id"] if task_id == SINGLE_TASK else f"{job['id']}_{task_id}"
+
+def selected_jobs(job_ids):
+  if not job_ids:
+    return all_jobs()
+  wanted = {job_id.split("_")[0] for job_id in job_ids.split(",")}
+  return [job for job in all_jobs() if job["id"] in wanted]
+
+def squeue(argv):
+  parser = argparse.ArgumentParser(prog="squeue")
+  parser.add_argument("-j", "--jobs")
+  parser.add_argument("-o", "--format", default="%i %j %T")
+  parser.add_argument("-h", "--noheader", action="store_true")
+  parser.add_argument("-r", "--array", action="store_true")
+  args, _ = parser.parse_known_args(argv)
+
+  jobs = selected_jobs(args.jobs)
+  if args.jobs and not jobs:
+    print("slurm_load_jobs error: Invalid job id specified", file=sys.stderr)
+    return 1
+  if not args.noheader:
+    print(args.format.replace("%i", "JOBID").replace("%j", "NAME").replace("%T", "STATE"))
+  for job in jobs:
+    for task_id, task in job["tasks"].items():
+      if task["state"] in ACTIVE_STATES:
+        print(
+          args.format.replace("%i", format_job_id(job, task_id))
+          .replace("%j", job["name"]).replace("%T", task["state"])
+        )
+  return 0
+
+def sacct(argv):
+  parser = argparse.ArgumentParser(prog="sacct")
+  parser.add_argument("-j", "--jobs")
+  parser.add_argument("-o", "--format", default="JobID,JobName,State,ExitCode")
+  parser.add_argument("-n", "--noheader", action="store_true")
+  parser.add_argument("-P", "--parsable2", action="store_true")
+  parser.add_argument("-X", "--allocations", action="store_true")
+  args, _ = parser.parse_known_args(argv)
+
+  fields = [field.strip() for field in args.format.split(",")]
+  separator = "|" if args.parsable2 else " "
+  if not args.noheader:
+    print(separator.join(fields))
+  for job in selected_jobs(args.jobs):
+    for task_id, task in job["tasks"].items():
+      values = {
+        "JobID": format_job_id(job, task_id),
+        "JobName": job["name"],
+        "State": task["state"],
+        "ExitCode": f"{task.get('exit_code') or 0}:0",
+      }
+      print(separator.join(values.get(field, "") for field in fields))
+  return 0
+
+def scancel(argv):
+  for raw_id in argv:
+    job_id, _, task_id = raw_id.partition("_")
+    pids = []
+    with queue_lock(state_dir()):
+      job = read_job(job_id)
+      if job is None:
+        print(f"scancel: error: Invalid job id {raw_id}", file=sys.stderr)
+        continue
+      for current_id, task in job["tasks"].items():
+        if task_id and current_id != task_id or task["state"] in FINISHED_STATES:
+          continue
+        if task["state"] == "RUNNING":
+          task["cancelled"] = True
+          pids.append(task["pid"])
+        else:
+          task["state"] = "CANCELLED"
+      write_json(job_path(job_id), job)
+    # the runner must see the cancelled flag once the task ends
+    for pid in pids:
+      try:
+        os.killpg(pid, signal.SIGTERM)
+      except ProcessLookupError:
+        pass
+  return 0
+
+def install(bin_dir):
+  os.makedirs(bin_dir, exist_ok=True)
+  # the commands run this script with the massivefold package it was installed with
+  package_parent = os.path.dirname(os.path.dirname(os.path.abspath(massivefold.__file__)))
+  for command in COMMANDS:
+    path = os.path.join(bin_dir, command)
+    with open(path, "w", encoding="utf-8") as handle:
+      handle.write("#!/bin/sh\n")
+      handle.write(f'export PYTHONPATH="{package_parent}${{PYTHONPATH:+:$PYTHONPATH}}"\n')
+      handle.write(f'exec "{sys.executable}" "{os.path.abspath(__file__)}" {command} "$@"\n')
+    os.chmod(path, 0o755)
+  print(f"Fake SLURM commands installed in {bin_dir}, jobs are recorded in {state_dir()}")
+  return 0
+
+def main(argv=None):
+  argv = sys.argv[1:] if argv is None else argv
+  if not argv:
+    print(__doc__)
+    return 1
+  command, command_args = argv[0], argv[1:]
+  if command == "install":
+    return install(command_args[0] if command_args else "fake_slurm_bin")
+  if command == "run":
+    return run_job(command_args[0])
+  commands = {"sbatch": sbatch, "squeue": squeue, "sacct": sacct, "scancel": scancel}
+  if command not in commands:
+    print(f"Unknown command '{command}', use one of install, {', '.join(COMMANDS)}")
+    return 1
+  return commands[command](command_args)
+
+if __name__ == "__main__":
+  raise SystemExit(main())